@@ -34,6 +34,11 @@ TESTROU ;
  s fails=fails+$$TestGoto()
  s fails=fails+$$TestGotoLoop()
  s fails=fails+$$TestForLoops()
+ s fails=fails+$$TestGlobals()
+ s fails=fails+$$TestTransactions()
+ s fails=fails+$$TestMerge()
+ s fails=fails+$$TestQuery()
+ s fails=fails+$$TestFlatLocals()
  s fails=fails+$$TestSockets()
  ;
  ; Report the results
@@ -198,6 +203,12 @@ TestPointerArgs() ;
  s name("MI")="L"
  i $$testPtrArgs4(.name) s fail=fail+1
  ;
+ ; Test that a pointer to an undefined variable defines it for the caller,
+ ; even when the called tag NEWs a variable with the same name
+ k made
+ d testPtrArgs5(.made)
+ i $g(made)'="outer" s fail=fail+1
+ ;
  d ReportResults(fail)
  q +fail
  ;
@@ -218,6 +229,10 @@ testPtrArgs4(arg) ;
  q:(arg("Last","Suffix")'="Jr") 1
  q:(arg("MI")'="L") 1
  q 0
+testPtrArgs5(arg) ;
+ n made
+ s made="inner",arg="outer"
+ q
  ;
  ;**************************
  ;* Expression Tests
@@ -244,6 +259,19 @@ TestArithmetic() ;
  d EvalTest(-"+++---+--+3.5",3.5,.fail,msg)
  d EvalTest(-"+++---+--+3.5.5",3.5,.fail,msg)
  ;
+ ; Test integers with too many digits to convert exactly
+ s msg=" - A very long integer failed"
+ s res=$tr($j("",5000)," ",1)
+ d EvalTest(res>5,1,.fail,msg)
+ d EvalTest(res+0>5,1,.fail,msg)
+ d EvalTest('res,0,.fail,msg)
+ ;
+ ; Test exponents beyond the range of numbers
+ s msg=" - A number with a very large exponent failed"
+ d EvalTest("1E999999999">1,1,.fail,msg)
+ d EvalTest("1E-999999999"+0,0,.fail,msg)
+ d EvalTest("-25E-1"+0,-2.5,.fail,msg)
+ ;
  ; Test addition
  s msg=" - An addition operation failed"
  d EvalTest(1+4,5,.fail,msg)
@@ -349,7 +377,7 @@ TestStringOp() ;
  ;* Intrinsic Tests
  ;**************************
 TestIntrinsic() ;
- n val,msg,fail,var
+ n val,msg,fail,var,sub
  w !,"Testing intrinsic functions..."
  ;
  ; Test $ASCII function
@@ -387,6 +415,11 @@ TestIntrinsic() ;
  d EvalTest($E("Chris",3,3),"r",.fail,msg)
  d EvalTest($E("Chris",2,4),"hri",.fail,msg)
  d EvalTest($E("Chris",2,10),"hris",.fail,msg)
+ s var="Chris",$E(var)="K",$E(var,3,4)="-"
+ d EvalTest(var,"Kh-s",.fail,msg)
+ s $E(var,6)="!"
+ d EvalTest(var,"Kh-s !",.fail,msg)
+ k var
  ;
  ; Test $FIND function
  s msg=" - $FIND intrinsic failed."
@@ -425,6 +458,24 @@ TestIntrinsic() ;
  d EvalTest($O(var("age"),-1),"",.fail,msg)
  k var
  ;
+ ; Subscripts collate canonical numbers first, in numeric order, and then
+ ; other strings
+ s msg=" - $ORDER collation failed."
+ f sub=10,2,"b",-1,"10a",1.5 s var(sub)=""
+ d EvalTest($O(var("")),-1,.fail,msg)
+ d EvalTest($O(var(2)),10,.fail,msg)
+ d EvalTest($O(var(10)),"10a",.fail,msg)
+ d EvalTest($O(var(""),-1),"b",.fail,msg)
+ d EvalTest($O(var("10a"),-1),10,.fail,msg)
+ d EvalTest($O(var(1.5),-1),-1,.fail,msg)
+ ;
+ ; Integers with more digits than the collation exponent can count
+ s sub=$TR($J("",40000)," ",9),var(sub)=1
+ d EvalTest($D(var(sub)),1,.fail,msg)
+ d EvalTest($O(var(10))=sub,1,.fail,msg)
+ d EvalTest($O(var(sub)),"10a",.fail,msg)
+ k var
+ ;
  ; Test $PIECE function
  s msg=" - $PIECE instrinsic failed."
  d EvalTest($P("",","),"",.fail,msg)
@@ -433,6 +484,12 @@ TestIntrinsic() ;
  d EvalTest($P("Arya,Jon,Sansa",","),"Arya",.fail,msg)
  d EvalTest($P("Arya,Jon,Sansa",",",2),"Jon",.fail,msg)
  d EvalTest($P("Arya,Jon,Sansa",",",4),"",.fail,msg)
+ d EvalTest($P("Arya,Jon,Sansa",",",2,3),"Jon,Sansa",.fail,msg)
+ d EvalTest($P("Arya,Jon,Sansa",",",0,1),"Arya",.fail,msg)
+ d EvalTest($P("Arya,Jon,Sansa",",",3,2),"",.fail,msg)
+ s var="Arya,Jon",$P(var,",",2)="Bran",$P(var,",",4)="Rickon"
+ d EvalTest(var,"Arya,Bran,,Rickon",.fail,msg)
+ k var
  ; #TODO: Finish the $PIECE function tests
  ;
  ; Test $REVERSE function
@@ -637,6 +694,271 @@ TestForLoops() ;
  q +fail
  ;
  ;**************************
+ ;* Global Variable Tests
+ ;**************************
+ ; Globals are set in a new temporary database, so the tests neither
+ ; depend on nor change the globals in the database file in use.
+TestGlobals() ;
+ n val,sub,fail,msg
+ w !,"Testing global variables..."
+ v "DATABASE":""
+ ;
+ ; SET, $GET and $DATA
+ s msg=" - Setting a global failed"
+ s ^TEST=1,^TEST(1)="one",^TEST(1,2)="two",^TEST("a","b")="ab"
+ d EvalTest(^TEST,1,.fail,msg)
+ d EvalTest(^TEST(1,2),"two",.fail,msg)
+ d EvalTest(^TEST("a","b"),"ab",.fail,msg)
+ s msg=" - $GET of a global failed"
+ d EvalTest($g(^TEST(1)),"one",.fail,msg)
+ d EvalTest($g(^TEST(2)),"",.fail,msg)
+ d EvalTest($g(^TEST(2),"none"),"none",.fail,msg)
+ s msg=" - $DATA of a global failed"
+ d EvalTest($d(^TEST),11,.fail,msg)
+ d EvalTest($d(^TEST(1)),11,.fail,msg)
+ d EvalTest($d(^TEST(1,2)),1,.fail,msg)
+ d EvalTest($d(^TEST("a")),10,.fail,msg)
+ d EvalTest($d(^TEST(3)),0,.fail,msg)
+ ;
+ ; Subscripts collate canonical numbers first, in numeric order, and then
+ ; other strings
+ s msg=" - $ORDER of a global failed"
+ k ^TEST
+ f sub=10,2,-1,1.5,"b","a","10a" s ^TEST(sub)=""
+ s val="",sub="" f  s sub=$o(^TEST(sub)) q:sub=""  s val=val_sub_","
+ d EvalTest(val,"-1,1.5,2,10,10a,a,b,",.fail,msg)
+ s val="",sub="" f  s sub=$o(^TEST(sub),-1) q:sub=""  s val=val_sub_","
+ d EvalTest(val,"b,a,10a,10,2,1.5,-1,",.fail,msg)
+ d EvalTest($o(^TEST(2)),10,.fail,msg)
+ d EvalTest($o(^TEST("b")),"",.fail,msg)
+ ;
+ ; KILL removes a node and its descendants
+ s msg=" - Killing a global failed"
+ s ^TEST(2,1)=1
+ k ^TEST(2)
+ d EvalTest($d(^TEST(2)),0,.fail,msg)
+ d EvalTest($d(^TEST(2,1)),0,.fail,msg)
+ d EvalTest($o(^TEST(1.5)),10,.fail,msg)
+ k ^TEST
+ d EvalTest($d(^TEST),0,.fail,msg)
+ ;
+ v "DATABASE"
+ d ReportResults(fail)
+ q +fail
+ ;
+ ;**************************
+ ;* Transaction Tests
+ ;**************************
+TestTransactions() ;
+ n val,cnt,lvl,tries,fail,msg
+ w !,"Testing transactions..."
+ v "DATABASE":""
+ ;
+ ; Nested transactions only commit with the outermost TCOMMIT
+ s msg=" - Committing a transaction failed"
+ s lvl=$tl
+ ts  s lvl=lvl_$tl,^TEST(1)=1 ts  s lvl=lvl_$tl tc  s lvl=lvl_$tl
+ d EvalTest(^TEST(1),1,.fail,msg)
+ tc  s lvl=lvl_$tl
+ d EvalTest(lvl,"01210",.fail,msg)
+ d EvalTest(^TEST(1),1,.fail,msg)
+ ;
+ ; TROLLBACK discards every change made in the open transactions
+ s msg=" - Rolling back a transaction failed"
+ ts  s ^TEST(1)=2,^TEST(2)=2 ts  s ^TEST(3)=3 tro
+ d EvalTest($tl,0,.fail,msg)
+ d EvalTest(^TEST(1),1,.fail,msg)
+ d EvalTest($d(^TEST(2))+$d(^TEST(3)),0,.fail,msg)
+ ;
+ ; TRESTART discards the changes of the transaction and runs it again
+ ; from its TSTART command, not from the start of its line
+ s msg=" - Restarting a transaction failed"
+ k cnt,val s cnt=$g(cnt)+1 ts  s val=$g(val)+1,^TEST(4)=val tre:val<3  tc
+ d EvalTest(cnt,1,.fail,msg)
+ d EvalTest(val,3,.fail,msg)
+ d EvalTest(^TEST(4),3,.fail,msg)
+ ts  s ^TEST(5)=$g(^TEST(5))+1,tries=$tre tre:tries<2  tc
+ d EvalTest(tries,2,.fail,msg)
+ d EvalTest(^TEST(5),1,.fail,msg)
+ d EvalTest($tre,0,.fail,msg)
+ ;
+ v "DATABASE"
+ d ReportResults(fail)
+ q +fail
+ ;
+ ;**************************
+ ;* Merge Tests
+ ;**************************
+TestMerge() ;
+ n a,b,c,fail,msg
+ w !,"Testing merge..."
+ v "DATABASE":""
+ ;
+ ; MERGE copies the value and every descendant of the source
+ s msg=" - Merging a local into a local failed"
+ s a=1,a(1)=2,a(1,2)=3,a("x")="y"
+ m b=a
+ d EvalTest(b,1,.fail,msg)
+ d EvalTest(b(1),2,.fail,msg)
+ d EvalTest(b(1,2),3,.fail,msg)
+ d EvalTest(b("x"),"y",.fail,msg)
+ m b(3)=a(1)
+ d EvalTest(b(3),2,.fail,msg)
+ d EvalTest(b(3,2),3,.fail,msg)
+ d EvalTest($d(b(3,"x")),0,.fail,msg)
+ ;
+ ; Merged nodes replace existing ones; other existing nodes are kept
+ s msg=" - Merging into an existing subtree failed"
+ s c(1)=9,c(1,2)=9,c(1,5)=5,c(2)=4
+ m c(1)=a(1)
+ d EvalTest(c(1),2,.fail,msg)
+ d EvalTest(c(1,2),3,.fail,msg)
+ d EvalTest(c(1,5),5,.fail,msg)
+ d EvalTest(c(2),4,.fail,msg)
+ ;
+ ; Locals and globals merge into each other
+ s msg=" - Merging between a local and a global failed"
+ m ^TEST(1)=a
+ d EvalTest(^TEST(1),1,.fail,msg)
+ d EvalTest(^TEST(1,1,2),3,.fail,msg)
+ d EvalTest(^TEST(1,"x"),"y",.fail,msg)
+ k c m c=^TEST(1,1)
+ d EvalTest(c,2,.fail,msg)
+ d EvalTest(c(2),3,.fail,msg)
+ d EvalTest($d(c(1)),0,.fail,msg)
+ m ^TEST(2)=^TEST(1,1)
+ d EvalTest(^TEST(2,2),3,.fail,msg)
+ ;
+ ; Merging a variable with its own descendant is an error, which stops
+ ; the job running the MERGE before it records that the MERGE finished
+ s msg=" - Merging a variable into its descendant did not fail"
+ j MergeOverlap:("device"="/dev/null"):60
+ d EvalTest($g(^TEST(3)),"started",.fail,msg)
+ ;
+ v "DATABASE"
+ d ReportResults(fail)
+ q +fail
+ ;
+MergeOverlap ;
+ n a
+ s a(1)=1,^TEST(3)="started"
+ m a(1)=a
+ s ^TEST(3)="merged"
+ q
+ ;
+ ;**************************
+ ;* $QUERY Tests
+ ;**************************
+TestQuery() ;
+ n a,ref,val,fail,msg
+ w !,"Testing $QUERY..."
+ v "DATABASE":""
+ ;
+ ; Passing each reference back to $QUERY walks every node with a value
+ s msg=" - Walking a local with $QUERY failed"
+ s a=0,a(1)=1,a(1,2,3)=123,a(1,"x")="1x",a(5,1,1,1)=5,a("z")="z"
+ s ref="a",val="" f  x "s ref=$q("_ref_")" q:ref=""  s val=val_ref_";"
+ d EvalTest(val,"a(1);a(1,2,3);a(1,""x"");a(5,1,1,1);a(""z"");",.fail,msg)
+ ;
+ ; $QUERY resumes from any reference, whether or not that node exists
+ s msg=" - Resuming $QUERY from a reference failed"
+ d EvalTest($q(a(1,2,3)),"a(1,""x"")",.fail,msg)
+ d EvalTest($q(a(1,2)),"a(1,2,3)",.fail,msg)
+ d EvalTest($q(a(0)),"a(1)",.fail,msg)
+ d EvalTest($q(a(5,1)),"a(5,1,1,1)",.fail,msg)
+ s a(1,5)=15
+ d EvalTest($q(a(1,2,3)),"a(1,5)",.fail,msg)
+ k a(1,5),a(1,"x")
+ d EvalTest($q(a(1,2,3)),"a(5,1,1,1)",.fail,msg)
+ s ref=$q(a(1)) k a(1) s a(1,"y")=1
+ d EvalTest($q(a(1,2,3)),"a(1,""y"")",.fail,msg)
+ ;
+ ; $QUERY returns null after the last node
+ s msg=" - $QUERY did not stop at the end of the array"
+ d EvalTest($q(a("z")),"",.fail,msg)
+ d EvalTest($q(a("zz",1)),"",.fail,msg)
+ k a
+ d EvalTest($q(a),"",.fail,msg)
+ ;
+ ; Globals
+ s msg=" - $QUERY of a global failed"
+ s ^TEST(2,"b")=1,^TEST(10)=2,^TEST(10,1,1)=3
+ s ref="^TEST",val="" f  x "s ref=$q("_ref_")" q:ref=""  s val=val_ref_";"
+ d EvalTest(val,"^TEST(2,""b"");^TEST(10);^TEST(10,1,1);",.fail,msg)
+ d EvalTest($q(^TEST(3)),"^TEST(10)",.fail,msg)
+ d EvalTest($q(^TEST(10,1,1)),"",.fail,msg)
+ ;
+ v "DATABASE"
+ d ReportResults(fail)
+ q +fail
+ ;
+ ;**************************
+ ;* Flat Local Variable Tests
+ ;**************************
+ ; Locals created after VIEW "LOCALS":"FLAT" keep all of their nodes in one
+ ; sorted map; they must behave exactly like the locals of the other tests.
+TestFlatLocals() ;
+ n fail,msg
+ w !,"Testing flat local variables..."
+ v "DATABASE":"","LOCALS":"FLAT"
+ s fail=$$FlatLocals(.msg)
+ v "LOCALS","DATABASE"
+ d ReportResults(fail)
+ q +fail
+ ;
+FlatLocals(msg) ;
+ n a,b,ref,val,sub,fail
+ ;
+ s msg=" - Setting a flat local failed"
+ s a=0,a(1)=1,a(1,2,3)=123,a(1,"x")="1x",a(10)="ten",a(-1)="neg"
+ d EvalTest(a,0,.fail,msg)
+ d EvalTest(a(1,2,3),123,.fail,msg)
+ d EvalTest($g(a(1,2)),"",.fail,msg)
+ d EvalTest($g(a(2),"none"),"none",.fail,msg)
+ ;
+ s msg=" - $DATA of a flat local failed"
+ d EvalTest($d(a),11,.fail,msg)
+ d EvalTest($d(a(1)),11,.fail,msg)
+ d EvalTest($d(a(1,2)),10,.fail,msg)
+ d EvalTest($d(a(1,2,3)),1,.fail,msg)
+ d EvalTest($d(a(2)),0,.fail,msg)
+ ;
+ s msg=" - $ORDER of a flat local failed"
+ s val="",sub="" f  s sub=$o(a(sub)) q:sub=""  s val=val_sub_","
+ d EvalTest(val,"-1,1,10,",.fail,msg)
+ s val="",sub="" f  s sub=$o(a(sub),-1) q:sub=""  s val=val_sub_","
+ d EvalTest(val,"10,1,-1,",.fail,msg)
+ d EvalTest($o(a(1,"")),2,.fail,msg)
+ ;
+ s msg=" - $QUERY of a flat local failed"
+ s ref="a",val="" f  x "s ref=$q("_ref_")" q:ref=""  s val=val_ref_";"
+ d EvalTest(val,"a(-1);a(1);a(1,2,3);a(1,""x"");a(10);",.fail,msg)
+ ;
+ s msg=" - Killing a flat local failed"
+ k a(1)
+ d EvalTest($d(a(1)),0,.fail,msg)
+ d EvalTest($d(a(1,2,3)),0,.fail,msg)
+ d EvalTest($o(a(-1)),10,.fail,msg)
+ ;
+ s msg=" - Merging a flat local failed"
+ s a(1,2)=12
+ m b=a
+ d EvalTest(b(1,2),12,.fail,msg)
+ d EvalTest(b(10),"ten",.fail,msg)
+ m ^TEST=a,b(5)=^TEST(1)
+ d EvalTest(^TEST(1,2),12,.fail,msg)
+ d EvalTest(b(5,2),12,.fail,msg)
+ ;
+ s msg=" - Passing a flat local by reference failed"
+ d EvalTest($$CountNodes(.b),4,.fail,msg)
+ q +fail
+ ;
+CountNodes(arr) ;
+ n ref,cnt
+ s ref="arr",cnt=0 f  x "s ref=$q("_ref_")" q:ref=""  s cnt=cnt+1
+ q cnt
+ ;
+ ;**************************
  ;* Socket Device test
  ;**************************
 TestSockets() ;
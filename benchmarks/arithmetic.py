@@ -0,0 +1,93 @@
+"""MUMPy Arithmetic Benchmark
+
+Compares the cost of evaluating arithmetic expressions with non-integer
+numbers held as floats (the default) and as the exact MUMPSDecimals of the
+exact arithmetic mode (`mumpy -x`). Each expression is evaluated once per
+iteration of a loop which sets its variable, as it would be in the body of
+a FOR loop. Numbers in the expressions are converted when they are parsed,
+so each expression is parsed again in each mode.
+
+Expressions on whole numbers are computed with Python ints in either mode,
+so they should cost about the same.
+
+Run from the repository root:
+
+    python benchmarks/arithmetic.py [-n ITERATIONS] [-r REPEAT]
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import argparse
+import os
+import sys
+import time
+
+# Benchmark the MUMPy package in this repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mumpy
+import mumpy.tree as tree
+
+
+# Expressions evaluated in the loop, each in terms of the variable `i`
+EXPRESSIONS = (
+    'i+1',
+    'i*3-(i\\2)+(i#7)',
+    'i+0.1',
+    'i*1.05',
+    'i/3',
+    'i*0.01+(i/8)-0.125',
+    '"1.25"*i',
+)
+
+
+def parse_expr(parser, src):
+    """Return the syntax tree of the expression `src`."""
+    line = parser.parse_tree("w {}".format(src), is_rou=False)
+    return line.commands[0].args[0]
+
+
+def run(expr, env, n):
+    """Return the time taken to evaluate the bound expression `expr` for
+    `n` values of `i`."""
+    ident = mumpy.MUMPSIdentifier("i", env)
+    start = time.perf_counter()
+    for i in range(1, n+1):
+        env.set(ident, i)
+        str(expr)
+    return time.perf_counter() - start
+
+
+def timed(env, p, src, exact, opts):
+    """Return the best time taken to evaluate `src` in the given mode and
+    its value for `i=17`."""
+    mumpy.set_exact_arithmetic(exact)
+    expr = tree.bind(parse_expr(p, src), env, p)
+    t = min(run(expr, env, opts.iterations) for _ in range(opts.repeat))
+    env.set(mumpy.MUMPSIdentifier("i", env), 17)
+    return t, str(expr)
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("-n", "--iterations", type=int, default=100000,
+                      help="The number of loop iterations per expression")
+    args.add_argument("-r", "--repeat", type=int, default=3,
+                      help="The number of times to repeat each timing")
+    opts = args.parse_args()
+
+    env = mumpy.MUMPSEnvironment()
+    p = mumpy.MUMPSParser(env)
+
+    print("{:<22}{:>11}{:>11}{:>8}   {}".format(
+        "expression", "float (s)", "exact (s)", "cost", "values at i=17"))
+    for src in EXPRESSIONS:
+        f, fval = timed(env, p, src, False, opts)
+        x, xval = timed(env, p, src, True, opts)
+        print("{:<22}{:>11.3f}{:>11.3f}{:>7.2f}x   {} / {}".format(
+            src, f, x, x / f, fval, xval))
+    mumpy.set_exact_arithmetic(False)
+
+
+if __name__ == "__main__":
+    main()
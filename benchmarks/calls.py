@@ -0,0 +1,140 @@
+"""MUMPy Extrinsic Call Benchmark
+
+Times the overhead of calling an empty extrinsic function, `$$F()`, which
+only quits with a value. A routine is written to a temporary directory with
+two loops of the same length:
+
+    base    s x=1 in each iteration
+    call    s x=$$F() in each iteration
+
+The difference between their times, divided by the number of iterations,
+is the cost of a call, including pushing and popping its stack frame. A
+call to a function with two arguments, one of them passed by reference,
+is timed in the same way.
+
+Each call loop is also timed as a baseline with call sites which are not
+kept between calls, so that every call looks up the tag in its routine and
+checks its arguments against the tag's argument list, as calls did before
+each call site kept them. Stack frames are still taken from the pool in
+the baseline; to compare against the stack frames calls used before, run
+this benchmark against an older tree with `-t`.
+
+Run from the repository root:
+
+    python benchmarks/calls.py [-n ITERATIONS] [-r REPEAT] [-t TREE]
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+
+def arguments():
+    """Return the command-line options of the benchmark."""
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("-n", "--iterations", type=int, default=100000,
+                      help="The number of calls in each loop")
+    args.add_argument("-r", "--repeat", type=int, default=3,
+                      help="The number of times to repeat each timing")
+    args.add_argument("-t", "--tree",
+                      help="The directory holding the MUMPy package to "
+                           "benchmark (this repository by default)")
+    return args.parse_args()
+
+
+# Benchmark the MUMPy package in this repository, or in the tree given with
+# -t, which must be on the path before MUMPy is imported
+OPTS = arguments()
+sys.path.insert(0, os.path.abspath(OPTS.tree) if OPTS.tree else
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mumpy
+import mumpy.runtime as rt
+
+
+# The benchmark routine; each loop runs `n` times
+ROUTINE = """CALLBNCH ; extrinsic call benchmark
+BASE ;
+ f i=1:1:n s x=1
+ q
+CALL ;
+ f i=1:1:n s x=$$F()
+ q
+ARGS ;
+ f i=1:1:n s x=$$G(i,.y)
+ q
+F() ;
+ q 1
+G(a,b) ;
+ q a
+"""
+
+# The loops which are timed, by label, and the tag of each
+LOOPS = (
+    ('base', 'BASE'),
+    ('$$F()', 'CALL'),
+    ('$$G(i,.y)', 'ARGS'),
+)
+
+
+def uncached(call):
+    """Return a version of the runtime call function `call` which makes
+    each call from a new call site, so that nothing is kept between calls
+    from one place in a routine."""
+    def uncached_call(env, parser, site, args=None):
+        site = mumpy.lang.MUMPSCallSite(site.tag, site.rou, site.is_func,
+                                        site.nargs)
+        return call(env, parser, site, args)
+    return uncached_call
+
+
+def run(p, f, tag, n):
+    """Return the time taken to run the loop at `tag` of the routine `f`
+    with `n` iterations."""
+    p.env.set(rt.ident("n"), n)
+    start = time.perf_counter()
+    p.parse_file(f, tag=tag)
+    return time.perf_counter() - start
+
+
+def main():
+    # The routine is compiled into the directory it is read from, and its
+    # intermediate representation is imported from there
+    tmp = tempfile.mkdtemp()
+    with open(os.path.join(tmp, "CALLBNCH.m"), "w") as rou:
+        rou.write(ROUTINE)
+    os.chdir(tmp)
+    sys.path.insert(0, tmp)
+    f = mumpy.MUMPSFile("CALLBNCH")
+
+    env = mumpy.MUMPSEnvironment()
+    p = mumpy.MUMPSParser(env)
+
+    # Trees older than call sites have no baseline
+    call = rt.call if hasattr(rt, "call_site") else None
+    timings = [("", call)]
+    if call is not None:
+        timings.insert(0, ("baseline ", uncached(call)))
+
+    print("{:<20}{:>10}{:>14}".format("loop", "time (s)", "per call (us)"))
+    base = min(run(p, f, "BASE", OPTS.iterations)
+               for _ in range(OPTS.repeat))
+    print("{:<20}{:>10.3f}{:>14}".format("base", base, ""))
+    for label, tag in LOOPS[1:]:
+        for prefix, func in timings:
+            if func is not None:
+                rt.call = func
+            t = min(run(p, f, tag, OPTS.iterations)
+                    for _ in range(OPTS.repeat))
+            print("{:<20}{:>10.3f}{:>14.2f}".format(
+                prefix + label, t, (t - base) / OPTS.iterations * 1e6))
+    if call is not None:
+        rt.call = call
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""MUMPy Control Flow Benchmark
+
+Compares the two ways in which the interpreter can carry out the commands
+which change the flow of execution (QUIT, GOTO, a false IF and FOR): by
+returning a status to the line executing them (the default), or by raising
+a Python exception as earlier versions did (`mumpy -i -ex`). Routines are
+interpreted line by line in both modes.
+
+Each test tag of the unit test routine TESTROU.m is run as a function, with
+its output discarded. The socket tests start a second process, so they are
+skipped. A loop of conditional commands is timed in the same way:
+
+    loop    i i#2 s x=x+1  with  i i<n g L  on the following line
+
+Run from the repository root:
+
+    python benchmarks/control.py [-n ITERATIONS] [-r REPEAT]
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+# Benchmark the MUMPy package in this repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mumpy
+import mumpy.runtime as rt
+
+
+# The conditional loop routine; the loop runs `n` times
+ROUTINE = """CTLBNCH ; control flow benchmark
+LOOP ;
+ s i=0,x=0
+L s i=i+1 i i#2 s x=x+1
+ i i<n g L
+ q
+"""
+
+# Test tags of TESTROU.m which are not run
+SKIPPED = ('TestSockets',)
+
+
+def test_tags():
+    """Return the names of the test tags of TESTROU.m, in order."""
+    with open(os.path.join(ROOT, "TESTROU.m")) as rou:
+        tags = re.findall(r"^(Test\w+)\(\)", rou.read(), re.MULTILINE)
+    return [tag for tag in tags if tag not in SKIPPED]
+
+
+def parser(exceptions):
+    """Return an interpreting parser in a new environment which uses
+    exceptions for control flow if `exceptions` is True."""
+    env = mumpy.MUMPSEnvironment()
+    env.open(os.devnull)
+    env.use(os.devnull)
+    return mumpy.MUMPSParser(env, compiled=False, exceptions=exceptions)
+
+
+def run_test(p, tag):
+    """Return the time taken to run the TESTROU.m test tag `tag`."""
+    start = time.perf_counter()
+    p.parse_repl("s r=$${}^TESTROU()".format(tag))
+    return time.perf_counter() - start
+
+
+def run_loop(p, f, n):
+    """Return the time taken to run the conditional loop `n` times."""
+    p.env.set(rt.ident("n"), n)
+    start = time.perf_counter()
+    p.parse_file(f, tag="LOOP")
+    return time.perf_counter() - start
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("-n", "--iterations", type=int, default=10000,
+                      help="The number of iterations of the loop")
+    args.add_argument("-r", "--repeat", type=int, default=3,
+                      help="The number of times to repeat each timing")
+    opts = args.parse_args()
+
+    # Routines are compiled into the directory they are read from, and
+    # their intermediate representations are imported from there
+    tmp = tempfile.mkdtemp()
+    shutil.copy(os.path.join(ROOT, "TESTROU.m"), tmp)
+    with open(os.path.join(tmp, "CTLBNCH.m"), "w") as rou:
+        rou.write(ROUTINE)
+    os.chdir(tmp)
+    sys.path.insert(0, tmp)
+    f = mumpy.MUMPSFile("CTLBNCH")
+
+    status, exceptions = parser(False), parser(True)
+    timings = [(tag, lambda p, tag=tag: run_test(p, tag))
+               for tag in test_tags()]
+    timings.append(("loop", lambda p: run_loop(p, f, opts.iterations)))
+
+    print("{:<26}{:>12}{:>16}{:>9}".format(
+        "test", "status (s)", "exceptions (s)", "cost"))
+    totals = [0, 0]
+    for label, run in timings:
+        s = min(run(status) for _ in range(opts.repeat))
+        x = min(run(exceptions) for _ in range(opts.repeat))
+        print("{:<26}{:>12.4f}{:>16.4f}{:>8.2f}x".format(label, s, x, x / s))
+        if label != "loop":
+            totals[0] += s
+            totals[1] += x
+    print("{:<26}{:>12.4f}{:>16.4f}{:>8.2f}x".format(
+        "TESTROU.m", totals[0], totals[1], totals[1] / totals[0]))
+
+
+if __name__ == "__main__":
+    main()
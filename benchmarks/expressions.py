@@ -0,0 +1,98 @@
+"""MUMPy Expression Benchmark
+
+Compares the evaluation of arithmetic-heavy expressions as chains of
+deferred MUMPSExpression thunks (built from the operator overloads in
+`mumpy.lang`) against the single closures built by `mumpy.tree`. Each
+expression is evaluated once per iteration of a loop which sets its
+variable, as it would be in the body of a FOR loop.
+
+Run from the repository root:
+
+    python benchmarks/expressions.py [-n ITERATIONS]
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import argparse
+import os
+import sys
+import time
+
+# Benchmark the MUMPy package in this repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mumpy
+import mumpy.lang as lang
+import mumpy.tree as tree
+
+
+# Expressions evaluated in the loop, each in terms of the variable `i`
+EXPRESSIONS = (
+    'i+1',
+    'i*2+1',
+    '(i*3)+(i#7)-(i\\3)',
+    'i*i-(i*2)+(i/4)',
+    '(i>10)&(i<1000)',
+    '"N"_i_"-"_(i+1)',
+)
+
+
+def thunk(node, env, parser):
+    """Bind the expression `node` as a chain of deferred expressions, the
+    way expressions were bound before they were compiled to closures."""
+    if isinstance(node, tree.BinaryNode):
+        left = lang.MUMPSExpression(thunk(node.left, env, parser))
+        right = thunk(node.right, env, parser)
+        return tree._binary_ops[node.op](left, right)
+    elif isinstance(node, tree.UnaryNode):
+        operand = lang.MUMPSExpression(thunk(node.operand, env, parser))
+        return tree._unary_ops[node.op](operand)
+    return node.bind(env, parser)
+
+
+def parse_expr(parser, src):
+    """Return the syntax tree of the expression `src`."""
+    line = parser.parse_tree("w {}".format(src), is_rou=False)
+    return line.commands[0].args[0]
+
+
+def run(expr, env, n):
+    """Return the time taken to evaluate the bound expression `expr` for
+    `n` values of `i`."""
+    ident = mumpy.MUMPSIdentifier("i", env)
+    start = time.perf_counter()
+    for i in range(1, n+1):
+        env.set(ident, i)
+        str(expr)
+    return time.perf_counter() - start
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("-n", "--iterations", type=int, default=100000,
+                      help="The number of loop iterations per expression")
+    args.add_argument("-r", "--repeat", type=int, default=3,
+                      help="The number of times to repeat each timing")
+    opts = args.parse_args()
+
+    env = mumpy.MUMPSEnvironment()
+    p = mumpy.MUMPSParser(env)
+
+    print("{:<24}{:>12}{:>12}{:>10}".format("expression", "thunks (s)",
+                                            "closure (s)", "speedup"))
+    for src in EXPRESSIONS:
+        node = parse_expr(p, src)
+        thunks = thunk(node, env, p)
+        closure = tree.bind(node, env, p)
+
+        # Both forms must compute the same value
+        env.set(mumpy.MUMPSIdentifier("i", env), 17)
+        assert str(thunks) == str(closure), src
+
+        t = min(run(thunks, env, opts.iterations) for _ in range(opts.repeat))
+        c = min(run(closure, env, opts.iterations) for _ in range(opts.repeat))
+        print("{:<24}{:>12.3f}{:>12.3f}{:>9.1f}x".format(src, t, c, t / c))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""MUMPy $ORDER Benchmark
+
+Times walking the subscripts of large local arrays with `$ORDER`, one call
+per subscript as a MUMPS loop would make, and with the `order_iter`
+traversal of MUMPSLocal. Both are timed over arrays of each size for two
+loops:
+
+    walk    visits each subscript in turn
+    filter  kills every other subscript before finding the next one, so
+            the starting subscript of half of the `$ORDER` calls is no
+            longer in the array
+
+Each `$ORDER` call bisects the sorted subscripts. The filter loop is also
+timed with the linear key scan which `$ORDER` used before it did so. A scan
+from a missing subscript reads every key before it, so that loop takes time
+quadratic in the size of the array; it is only run over the first
+subscripts of the array and its time for the whole array is extrapolated.
+
+Run from the repository root:
+
+    python benchmarks/order.py [-n SIZE ...] [-l LINEAR_STEPS]
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import argparse
+import os
+import sys
+import time
+
+# Benchmark the MUMPy package in this repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mumpy
+import mumpy.runtime as rt
+
+
+def linear_next_key(d, key):
+    """Return the key after `key` in the SortedDict `d` the way `$ORDER`
+    did before it bisected the keys, scanning the keys in turn when `key`
+    is not present."""
+    keys = d.keys()
+    try:
+        i = 1 if key == "" and "" in keys else keys.index(key) + 1
+        return keys[i]
+    except ValueError:
+        for k in keys:
+            if k > key:
+                return k
+        return ""
+    except IndexError:
+        return ""
+
+
+def build(env, n):
+    """Replace the local array `a` in `env` with one of `n` numeric
+    subscripts."""
+    env.kill(rt.ident("a"))
+    for i in range(1, n+1):
+        env.set(rt.ident("a", str(i)), i)
+
+
+def walk(env):
+    """Visit every subscript of `a` with `$ORDER`."""
+    k = rt.order(env, rt.ident("a", ""))
+    while k != "":
+        k = rt.order(env, rt.ident("a", k))
+
+
+def walk_iter(env):
+    """Visit every subscript of `a` with `order_iter`."""
+    var = env.get(rt.ident("a"), get_var=True)
+    for _ in var.order_iter(rt.ident("a", "")):
+        pass
+
+
+def filter(env):
+    """Kill every other subscript of `a`, finding each with `$ORDER`."""
+    k = rt.order(env, rt.ident("a", ""))
+    odd = True
+    while k != "":
+        if odd:
+            env.kill(rt.ident("a", k))
+        odd = not odd
+        k = rt.order(env, rt.ident("a", k))
+
+
+def filter_linear(env, steps):
+    """Kill every other subscript of the first `steps` subscripts of `a`,
+    finding each with the linear key scan."""
+    d = env.get(rt.ident("a"), get_var=True)._b
+    k = linear_next_key(d, "")
+    for i in range(steps):
+        if k == "":
+            break
+        if i % 2 == 0:
+            del d[k]
+        k = linear_next_key(d, k)
+
+
+def timed(func, *args):
+    """Return the time taken by `func(*args)`."""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("-n", "--sizes", type=int, nargs="+",
+                      default=[100000, 1000000],
+                      help="The numbers of subscripts in the arrays")
+    args.add_argument("-l", "--linear-steps", type=int, default=5000,
+                      help="The number of filter steps timed for the linear "
+                           "key scan")
+    opts = args.parse_args()
+
+    print("{:>10}{:>12}{:>12}{:>12}{:>14}".format(
+        "subscripts", "walk (s)", "iter (s)", "filter (s)", "linear (s)"))
+    # Every timing shares an environment, since an environment closes the
+    # standard output when it is collected
+    env = mumpy.MUMPSEnvironment()
+    for n in opts.sizes:
+        build(env, n)
+        w = timed(walk, env)
+        i = timed(walk_iter, env)
+        f = timed(filter, env)
+
+        # The linear scan takes time proportional to the square of the
+        # number of subscripts filtered
+        steps = min(n, opts.linear_steps)
+        build(env, n)
+        linear = timed(filter_linear, env, steps) * (n / steps) ** 2
+
+        print("{:>10}{:>12.3f}{:>12.3f}{:>12.3f}{:>13.1f}*".format(
+            n, w, i, f, linear))
+    print("* extrapolated from the first {} subscripts".format(
+        opts.linear_steps))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,18 +10,31 @@ from mumpy.interpreter import main
 from mumpy.lang import (MUMPSArgumentList,
                         MUMPSCommand,
                         MUMPSCommandEnd,
+                        MUMPSDecimal,
                         MUMPSExpression,
+                        MUMPSFlatLocal,
                         MUMPSGotoLine,
                         MUMPSFuncSubCall,
                         MUMPSIdentifier,
                         MUMPSLine,
                         MUMPSLocal,
+                        MUMPSLocalVariable,
                         MUMPSPointerIdentifier,
                         MUMPSReturn,
                         MUMPSSyntaxError,
+                        MUMPSTransactionRestart,
                         mumps_false,
                         mumps_null,
-                        mumps_true)
+                        mumps_true,
+                        set_exact_arithmetic)
+from mumpy.locks import MUMPSLockTable
 from mumpy.parser import (MUMPSParser,
                           trampoline)
-from mumpy.tokenizer import MUMPSLexer
\ No newline at end of file
+from mumpy.storage import (MUMPSGlobal,
+                           MUMPSGlobalStore,
+                           MUMPSJournal,
+                           MUMPSNodeMap,
+                           MUMPSStorageError,
+                           MUMPSTransaction)
+from mumpy.tokenizer import MUMPSLexer
+from mumpy.tree import MUMPSNode
\ No newline at end of file
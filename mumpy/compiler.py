@@ -2,14 +2,26 @@
 
 The MUMPy compiler converts a MUMPS routine into a Python intermediate
 module form that the interpreter can interact with using more standard
-Python idioms.
+Python idioms. Each tag in the routine is compiled to a Python function,
+so the routine runs as Python bytecode rather than being parsed and
+interpreted line by line.
 
 Licensed under a BSD license. See LICENSE for more information.
 
 Author: Christopher Rink"""
 import importlib
+import importlib.util
+import os
 import os.path
+import sys
 import mumpy
+import mumpy.lang as lang
+import mumpy.tree as tree
+
+
+# Version of the intermediate representation written by this compiler.
+# Intermediate files written by other versions are recompiled when loaded.
+_int_version = 7
 
 
 class MUMPSFile:
@@ -44,9 +56,14 @@ class MUMPSFile:
         # Compile the routine and import the new intermediate rep
         if not recompile and os.path.isfile(self.int_path):
             self.inter = importlib.import_module(self.rou)
+
+            # Recompile intermediate files which are out of date
+            if self._is_stale():
+                self._compile()
+                self.inter = _reimport(self.rou)
         elif os.path.isfile(self.rou_path):
             self._compile()
-            self.inter = importlib.import_module(self.rou)
+            self.inter = _reimport(self.rou)
         else:
             raise MUMPSCompileError("'{}' is not a valid file. Please specify "
                                     "either a routine or an "
@@ -57,12 +74,30 @@ class MUMPSFile:
     def __repr__(self):
         return "MUMPSFile(^{rou}, {path})".format(rou=self.rou, path=self.path)
 
+    def _is_stale(self):
+        """Return True if the intermediate representation was written by
+        another version of the compiler or is older than the routine."""
+        if not os.path.isfile(self.rou_path):
+            return False
+        if getattr(self.inter, 'version', None) != _int_version:
+            return True
+        return (os.path.getmtime(self.rou_path) >
+                os.path.getmtime(self.int_path))
+
     def _compile(self):
         """Compile a MUMPS routine into a MUMPy intermediate representation.
-        Very little syntax checking is done by this stage of compilation."""
+        Lines which cannot be parsed are compiled to raise their syntax
+        error when they are executed."""
         lines, tags = self._read_rou()
         self._write_int(tags, lines)
 
+        # Make sure a cached bytecode file for a previous version of the
+        # intermediate representation is never used in place of this one
+        try:
+            os.remove(importlib.util.cache_from_source(self.int_path))
+        except OSError:
+            pass
+
     def _read_rou(self):
         """Read in the Routine and return lines and tags."""
         # Set up some data structures that we'll use to represent a routine
@@ -120,10 +155,20 @@ class MUMPSFile:
                 # And the list of lines
                 lines.append(_process_line(line))
 
+        # The body of each tag runs up to the next tag (or the end of the
+        # routine); tags are found in line order
+        starts = [t['line'] for t in tags.values()]
+        for t, end in zip(tags.values(), starts[1:] + [len(lines)]):
+            t['end'] = end
+
         return lines, tags
 
     def _write_int(self, tags, lines):
         """Write out the intermediate file."""
+        # Generate the code for each tag before writing anything out
+        gen = _CodeGenerator(mumpy.MUMPSParser(debug=self.debug))
+        code = gen.routine(tags, lines)
+
         # Output the intermediate representation
         with open(self.int_path, mode='w', encoding='UTF-8') as f:
             # Write out the header
@@ -131,9 +176,15 @@ class MUMPSFile:
                     '\n'
                     'This file was automatically compiled by MUMPy. '
                     'Do not modify!"""\n'
+                    'import mumpy.runtime as rt\n'
+                    '{nodes}'
+                    '\n'
+                    'version = {version}\n'
                     '\n'
                     'name = "{rou}"\n'
-                    '\n'.format(rou=self.rou)
+                    '\n'.format(rou=self.rou,
+                                 version=_int_version,
+                                 nodes=gen.node_imports())
                     )
 
             # Output the tag index
@@ -141,6 +192,7 @@ class MUMPSFile:
             for tag, data in tags.items():
                 f.write("    '{tag}': {{\n".format(tag=tag))
                 f.write("        'line': {line},\n".format(line=data['line']))
+                f.write("        'end': {end},\n".format(end=data['end']))
                 f.write("        'args': {args},\n".format(args=data['args']))
                 f.write("    },\n")
             f.write('}\n\n')
@@ -151,6 +203,10 @@ class MUMPSFile:
                 f.write("    r'''{line}''',\n".format(line=line))
             f.write(']\n')
 
+            # Output the compiled code
+            for line in code:
+                f.write("{}\n".format(line))
+
     def name(self):
         """Return the routine name."""
         return self.inter.name
@@ -167,14 +223,19 @@ class MUMPSFile:
         """Return the argument list for the specified tag."""
         return self.inter.tags[str(tag)]['args']
 
+    def tag_func(self, tag):
+        """Return the compiled function for the specified tag, or None if
+        the intermediate representation has no compiled code for it."""
+        try:
+            return self.inter.funcs[str(tag)]
+        except (AttributeError, KeyError):
+            return None
+
     def tag_body(self, tag):
-        """Return the tag body of the given tag."""
-        lntag = sorted([v['line'] for _, v in self.inter.tags.items()])
-        start = lntag.index(self.inter.tags[str(tag)]['line'])
-        #try:
-        #    return self.inter.lines[lntag[start]:lntag[start+1]]
-        #except IndexError:
-        return self.inter.lines[lntag[start]:]
+        """Return the tag body of the given tag, which runs from its line up
+        to the next tag."""
+        t = self.inter.tags[str(tag)]
+        return self.inter.lines[t['line']:t['end']]
 
     def lines(self):
         """Return the list of routine lines."""
@@ -185,6 +246,15 @@ class MUMPSFile:
         return self.inter.lines[ln]
 
 
+def _reimport(name):
+    """Import the named intermediate module, reloading it if an earlier
+    version of it was already imported."""
+    importlib.invalidate_caches()
+    if name in sys.modules:
+        return importlib.reload(sys.modules[name])
+    return importlib.import_module(name)
+
+
 def _build_arg_list(tokens):
     """Given a list of Tokens for a line, return an argument list. A
     tag with no arguments which includes parentheses should be returned
@@ -219,6 +289,465 @@ def _process_line(line):
     return line
 
 
+class _CodeGenerator:
+    """Generates Python source code for the tags of a MUMPS routine.
+
+    Each tag is compiled to a function of the environment and parser which
+    executes the lines from that tag up to the next one. The function
+    returns the same values as the parser's `_parse_tag`: the value of a
+    QUIT (None for an argumentless QUIT), or a function for the parser's
+    trampoline to call for a GOTO or to fall through into the next tag.
+
+    Commands become Python statements operating on plain values through
+    `mumpy.runtime`. IF and ELSE wrap the rest of their line in a Python
+    `if` block and FOR wraps the rest of its line in a Python loop. Commands
+    without a compiled form are executed from their syntax tree."""
+    def __init__(self, parser):
+        self.parser = parser
+
+        # Module level constants (such as identifiers), by source code
+        self._consts = {}
+
+        # True if the code executes any syntax tree nodes directly
+        self._nodes = False
+
+        # The number and commands of the routine line being compiled
+        self._num = None
+        self._cmds = ()
+
+    def node_imports(self):
+        """Return the import statement needed for the syntax tree nodes
+        in the generated code, if there are any."""
+        if not self._nodes:
+            return ''
+        names = sorted(
+            k for k, v in vars(tree).items()
+            if isinstance(v, type) and issubclass(v, tree.MUMPSNode)
+        )
+        return 'from mumpy.tree import ({})\n'.format(', '.join(names))
+
+    def routine(self, tags, lines):
+        """Return the lines of Python source code for the routine with the
+        tag index `tags` and list of source lines `lines`."""
+        funcs = []
+        for i, (tag, data) in enumerate(tags.items()):
+            start, end = data['line'], data['end']
+            funcs.append(self._tag(i, tag, lines[start:end], start,
+                                   last=(end == len(lines))))
+
+        code = ['']
+        for src, name in self._consts.items():
+            code.append('{} = {}'.format(name, src))
+
+        for func in funcs:
+            code.append('')
+            code.append('')
+            code.extend(func)
+
+        code.append('')
+        code.append('')
+        code.append('funcs = {')
+        for i, tag in enumerate(tags):
+            code.append("    '{tag}': _tag_{i},".format(tag=tag, i=i))
+        code.append('}')
+        return code
+
+    def _tag(self, i, tag, lines, start, last=False):
+        """Return the source code of the function for one tag."""
+        code = ['def _tag_{i}(env, p):'.format(i=i),
+                '    """{tag}"""'.format(tag=tag)]
+
+        for num, line in enumerate(lines, start=start):
+            code.append('    # {num}: {line}'.format(num=num,
+                                                     line=line.strip()))
+            self._num = num
+            code.extend(self._line(line))
+
+        # Fall through into the next tag, if there is one
+        if last:
+            code.append('    return None')
+        else:
+            code.append('    return lambda: _tag_{i}(env, p)'.format(i=i+1))
+        return code
+
+    def _line(self, line):
+        """Return the source code for one line of the routine. Lines which
+        cannot be parsed raise their syntax error when executed."""
+        try:
+            node = self.parser.parse_tree(line)
+        except mumpy.MUMPSSyntaxError as e:
+            return ['    rt.fail({msg!r}, {err!r})'.format(msg=e.msg,
+                                                          err=e.err_type)]
+
+        if node is None:
+            return []
+        self._cmds = node.commands
+        return self._commands(node.commands, 1, 0)
+
+    def _commands(self, cmds, ind, loops):
+        """Return the source code for a sequence of commands on a line at
+        indentation level `ind`, inside `loops` nested FOR loops."""
+        code = []
+        pad = '    ' * ind
+        for i, cmd in enumerate(cmds):
+            rest = cmds[i+1:]
+
+            # IF, ELSE and FOR take over the rest of the line
+            if cmd.name in ('IF', 'ELSE'):
+                if cmd.name == 'ELSE':
+                    cond = 'not rt.test(env)'
+                elif cmd.args is None:
+                    cond = 'rt.test(env)'
+                else:
+                    cond = 'rt.if_test(env, {})'.format(' and '.join(
+                        'rt.truth({})'.format(self._expr(a)) for a in cmd.args
+                    ))
+
+                if not rest:
+                    if cmd.args is not None:
+                        code.append(pad + cond)
+                    return code
+
+                code.append('{pad}if {cond}:'.format(pad=pad, cond=cond))
+                code.extend(self._commands(rest, ind+1, loops))
+                return code
+            elif cmd.name == 'FOR':
+                code.extend(self._for(cmd, rest, ind, loops))
+                return code
+
+            # Commands without a compiled form handle their own
+            # post-conditionals
+            if cmd.name in _node_commands:
+                self._nodes = True
+                code.append('{pad}rt.command(env, p, {node})'.format(
+                    pad=pad, node=self._const(repr(cmd))
+                ))
+                continue
+
+            stmts, stop = self._command(cmd, loops)
+            if cmd.post is not None:
+                code.append('{pad}if rt.truth({post}):'.format(
+                    pad=pad, post=self._expr(cmd.post)
+                ))
+                code.extend('{pad}    {s}'.format(pad=pad, s=s) for s in stmts)
+            else:
+                code.extend('{pad}{s}'.format(pad=pad, s=s) for s in stmts)
+
+                # Nothing after an unconditional QUIT or GOTO is executed
+                if stop:
+                    return code
+        return code
+
+    def _for(self, cmd, rest, ind, loops):
+        """Return the source code for a FOR loop over the rest of a line."""
+        pad = '    ' * ind
+        if cmd.args is None:
+            code = ['{pad}while True:'.format(pad=pad)]
+        else:
+            var = '_for{}'.format(loops)
+            args = cmd.args
+            others = args.get('others', ())
+            code = [
+                '{pad}for {var} in rt.for_values({start}, {inc}, {end}, '
+                '{others}):'.format(
+                    pad=pad, var=var,
+                    start=self._expr(args['start']),
+                    inc=self._expr(args.get('inc')),
+                    end=self._expr(args.get('end')),
+                    others=_tuple(self._expr(o) for o in others),
+                ),
+                '{pad}    env.set({ident}, {var})'.format(
+                    pad=pad, ident=self._ident(args['var']), var=var
+                ),
+            ]
+
+        body = self._commands(rest, ind+1, loops+1)
+        code.extend(body if body or cmd.args is not None
+                    else ['{pad}    pass'.format(pad=pad)])
+        return code
+
+    def _command(self, cmd, loops):
+        """Return the statements for a single command and whether execution
+        of the line stops after them."""
+        name = cmd.name
+        args = () if cmd.args is None else cmd.args
+        if name == 'SET':
+            return [self._set(var, e) for var, e in args], False
+        elif name == 'MERGE':
+            return ['env.merge({}, {})'.format(self._ident(dst),
+                                               self._ident(src))
+                    for dst, src in args], False
+        elif name == 'NEW':
+            return ['env.new({})'.format(self._ident(v)) for v in args], False
+        elif name == 'KILL':
+            if cmd.args is None:
+                return ['env.kill_all()'], False
+            return ['env.kill({})'.format(self._ident(v)) for v in args], False
+        elif name == 'WRITE':
+            if cmd.args is None:
+                return ['env.print()'], False
+            return ['env.write({})'.format(self._write_arg(a))
+                    for a in args], False
+        elif name == 'READ':
+            return self._read(args), False
+        elif name == 'DO':
+            stmts = []
+            for call in args:
+                stmt = self._call(call)
+                if call.post is None:
+                    stmts.append(stmt)
+                else:
+                    stmts.append('if rt.truth({}):'.format(
+                        self._expr(call.post)))
+                    stmts.append('    {}'.format(stmt))
+            return stmts, False
+        elif name == 'GOTO':
+            stmts = []
+            for call in args:
+                stmt = 'return rt.goto(env, p, {tag!r}, {rou!r})'.format(
+                    tag=call.tag, rou=call.rou
+                )
+                if call.post is None:
+                    stmts.append(stmt)
+                    return stmts, True
+                stmts.append('if rt.truth({}):'.format(self._expr(call.post)))
+                stmts.append('    {}'.format(stmt))
+            return stmts, False
+        elif name == 'QUIT':
+            # QUIT terminates the innermost FOR loop, if there is one
+            if loops > 0:
+                if cmd.args is not None:
+                    return ['rt.fail("Cannot QUIT with value from FOR loop", '
+                            '"ILLEGAL QUIT ARG")'], True
+                return ['break'], True
+            if cmd.args is None:
+                return ['return None'], True
+            return ['return {}'.format(self._expr(args[0]))], True
+        elif name == 'HALT':
+            return ['rt.halt()'], True
+        elif name == 'HANG':
+            return ['rt.hang({})'.format(self._expr(args[0]))], False
+        elif name == 'XECUTE':
+            return ['p._parse_xecute({}, env)'.format(
+                _tuple(self._expr(a) for a in args)
+            )], False
+        elif name == 'OPEN':
+            return ['env.open({}, opts={})'.format(self._expr(dev),
+                                                   self._opts(opts))
+                    for dev, opts in args], False
+        elif name == 'CLOSE':
+            return ['env.close({})'.format(self._expr(dev))
+                    for dev, _ in args], False
+        elif name == 'USE':
+            return ['env.use({})'.format(self._expr(args[0][0]))], False
+        elif name == 'TSTART':
+            # Transactions restart from their TSTART command
+            i = next(i for i, c in enumerate(self._cmds) if c is cmd)
+            return ['env.tstart((env.get_current_rou(), {}, {}))'.format(
+                self._num, tree.restart_command(self._cmds[:i])
+            )], False
+        elif name == 'TCOMMIT':
+            return ['env.tcommit()'], False
+        elif name == 'TROLLBACK':
+            return ['env.trollback()'], False
+        elif name == 'TRESTART':
+            return ['env.trestart()'], True
+
+        raise MUMPSCompileError("Cannot compile command '{}'.".format(name),
+                                err_type="INVALID COMMAND")
+
+    def _read(self, args):
+        """Return the statements for the arguments of a READ command."""
+        stmts = []
+        read_last = False
+        for item in args:
+            if isinstance(item, tree.ValueNode):
+                var = item.var
+                stmts.append('rt.read(env, {ident}, {max}, {timeout})'.format(
+                    ident=self._ident(var),
+                    max=self._expr(var.max),
+                    timeout=self._expr(var.timeout),
+                ))
+                read_last = True
+            else:
+                stmts.append('env.write({})'.format(self._write_arg(item)))
+                read_last = False
+
+        # If we did not read last, output an extra newline
+        if not read_last:
+            stmts.append("env.write('\\n')")
+        return stmts
+
+    def _write_arg(self, node):
+        """Return the expression for one WRITE argument."""
+        if isinstance(node, tree.ColumnNode):
+            return 'rt.column(env, {})'.format(self._expr(node.offset))
+        return self._expr(node)
+
+    def _opts(self, opts):
+        """Return the expression for a dict of device parameters."""
+        if opts is None:
+            return 'None'
+        return '{{{}}}'.format(', '.join(
+            '{!r}: {}'.format(k, self._expr(v)) for k, v in opts.items()
+        ))
+
+    def _const(self, src):
+        """Return the name of a module level constant with the value of the
+        source code `src`."""
+        try:
+            return self._consts[src]
+        except KeyError:
+            name = '_c{}'.format(len(self._consts))
+            self._consts[src] = name
+            return name
+
+    def _set(self, target, expr):
+        """Return the statement setting the target of a SET command to the
+        value of the expression `expr`."""
+        if not isinstance(target, tree.SetTargetNode):
+            return 'env.set({}, {})'.format(self._ident(target),
+                                            self._expr(expr))
+
+        # Omitted optional arguments are passed as None
+        args = list(target.args)
+        while args and args[-1] is None:
+            args.pop()
+        return 'rt.{func}(env, {ident}, {value}, {args})'.format(
+            func=tree._rt_set_targets[target.name],
+            ident=self._ident(target.var),
+            value=self._expr(expr),
+            args=', '.join(self._expr(a) for a in args),
+        )
+
+    def _ident(self, var):
+        """Return the expression for the identifier of variable `var`."""
+        if var.subscripts is None:
+            return self._const('rt.ident({!r})'.format(var.name))
+        return 'rt.ident({name!r}, {subs})'.format(
+            name=var.name,
+            subs=', '.join(self._expr(s) for s in var.subscripts),
+        )
+
+    def _call(self, call):
+        """Return the expression for a function or subroutine call."""
+        if call.args is None or call.args == ():
+            args = repr(call.args)
+        else:
+            args = _tuple(
+                self._const('rt.pointer({!r})'.format(a.name))
+                if isinstance(a, tree.PointerNode) else self._expr(a)
+                for a in call.args
+            )
+
+        site = self._const(
+            'rt.call_site({tag!r}, {rou!r}, {func}, {nargs})'.format(
+                tag=call.tag,
+                rou=call.rou,
+                func=call.is_func,
+                nargs=None if call.args is None else len(call.args),
+            ))
+        return 'rt.call(env, p, {site}, {args})'.format(site=site, args=args)
+
+    def _expr(self, node):
+        """Return the Python expression for the expression node `node`."""
+        if node is None:
+            return 'None'
+        elif isinstance(node, tree.LiteralNode):
+            if type(node.value) is str or type(node.value) is int:
+                return repr(node.value)
+            # Other numbers are converted when the routine is loaded, as
+            # floats or exact decimals depending on the arithmetic mode
+            return self._const('rt.num({!r})'.format(str(node.value)))
+        elif isinstance(node, tree.ValueNode):
+            return 'rt.get(env, {})'.format(self._ident(node.var))
+        elif isinstance(node, tree.UnaryNode):
+            return 'rt.{op}({a})'.format(
+                op=tree._rt_unary_ops[node.op],
+                a=self._expr(node.operand),
+            )
+        elif isinstance(node, tree.BinaryNode):
+            return 'rt.{op}({a}, {b})'.format(
+                op=tree._rt_binary_ops[node.op],
+                a=self._expr(node.left),
+                b=self._expr(node.right),
+            )
+        elif isinstance(node, tree.IntrinsicNode):
+            return self._intrinsic(node)
+        elif isinstance(node, tree.SpecialVarNode):
+            return _special_vars[node.name]
+        elif isinstance(node, tree.CallNode):
+            return self._call(node)
+
+        raise MUMPSCompileError("Cannot compile expression "
+                                "'{}'.".format(node),
+                                err_type="INVALID EXPRESSION")
+
+    def _intrinsic(self, node):
+        """Return the Python expression for an intrinsic function call."""
+        name, args = node.name, node.args
+        if name == 'CHAR':
+            return 'rt.char({})'.format(
+                ', '.join(self._expr(a) for a in args[0])
+            )
+        elif name == 'DATA':
+            return 'rt.data(env, {})'.format(self._ident(args[0]))
+        elif name == 'GET':
+            return 'rt.get_defined(env, {ident}, {default})'.format(
+                ident=self._ident(args[0]), default=self._expr(args[1])
+            )
+        elif name == 'NAME':
+            return repr(args[0].name)
+        elif name == 'ORDER':
+            return 'rt.order(env, {ident}, {rev})'.format(
+                ident=self._ident(args[0]), rev=self._expr(args[1])
+            )
+        elif name == 'QUERY':
+            return 'rt.query(env, {})'.format(self._ident(args[0]))
+        elif name == 'SELECT':
+            # Only the arguments up to the first true one are evaluated
+            return '({}rt.select_error())'.format(''.join(
+                '{v} if rt.truth({c}) else '.format(c=self._expr(c),
+                                                    v=self._expr(v))
+                for c, v in args[0]
+            ))
+
+        # Omitted optional arguments are passed as None
+        args = list(args)
+        while args and args[-1] is None:
+            args.pop()
+        return 'rt.{func}({args})'.format(
+            func=tree._rt_intrinsics[name],
+            args=', '.join(self._expr(a) for a in args),
+        )
+
+
+def _tuple(items):
+    """Return the source code for a tuple of the expressions `items`."""
+    items = list(items)
+    if len(items) == 1:
+        return '({},)'.format(items[0])
+    return '({})'.format(', '.join(items))
+
+
+# Commands which are executed from their syntax tree rather than compiled
+_node_commands = ('JOB', 'LOCK', 'VIEW')
+
+# Python expressions for each special variable
+_special_vars = {
+    'HOROLOG': 'rt.horolog()',
+    'IO': 'str(env.current_device())',
+    'JOB': 'rt.job()',
+    'PRINCIPAL': 'str(env.default_device())',
+    'TEST': "rt.value(env.get('$T'))",
+    'TLEVEL': 'env.tlevel()',
+    'TRESTART': 'env.trestarts()',
+    'X': 'env.device_x()',
+    'Y': 'env.device_y()',
+    'ZJOB': "rt.value(env.get('$ZJ'))",
+}
+
+
 class MUMPSCompileError(Exception):
     """Raised if there was an error compiling a routine to intermediate form."""
     def __init__(self, msg, line=None, err_type=None):
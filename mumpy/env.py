@@ -7,12 +7,15 @@ devices.
 Licensed under a BSD license. See LICENSE for more information.
 
 Author: Christopher Rink"""
+import atexit
 import codecs
 import io
 import os
 import select
+import shutil
 import socket
 import sys
+import tempfile
 import urllib.parse as urlparse
 import mumpy
 
@@ -33,17 +36,43 @@ _socket_chunk_max = 4096
 # Default $PRINCIPAL file
 _default_device = 'STANDARD'
 
+# The number of times a conflicting transaction is restarted before the
+# conflict is raised as an error
+_max_restarts = 10
+
 
 class MUMPSEnvironment:
     """A MUMPy execution stack."""
-    def __init__(self, device='STANDARD'):
+    def __init__(self, device='STANDARD', database=None,
+                 commit_records=None, commit_interval=None,
+                 flat_locals=False, shared_database=False):
         # Default I/O device
         self._def_x = 0
         self._def_y = 0
 
-        # Current stack level and variable stack
+        # Current stack level and the symbol table. The table is shallow
+        # bound: it maps each variable name to the local variable visible
+        # under that name, so a variable is found in one lookup however
+        # deep the stack is. Arguments passed by reference are bound to the
+        # caller's variable itself. Each stack frame maps the names bound at
+        # that level to the variable they hid (None if the name was unbound),
+        # which is restored when the frame is popped. Frames which have
+        # been popped are kept to be pushed again.
         self._cur = 0
-        self._stack = [{}]
+        self._symbols = {}
+        self._frames = [MUMPSFrame()]
+        self._pool = []
+
+        # The value of $TEST, which is held apart from the symbol table
+        # since it is stacked by every extrinsic function call, and the
+        # true value it starts each call with
+        self._test = None
+        self._true = mumpy.mumps_true()
+
+        # The type of new local variables; flat locals keep all of their
+        # nodes in one sorted map rather than a dict for each node
+        self._local = mumpy.MUMPSFlatLocal if flat_locals else mumpy.MUMPSLocal
+        self._local_default = self._local
         self._init_sys_vars()
 
         # Create the $PRINCIPAL device
@@ -73,6 +102,31 @@ class MUMPSEnvironment:
         # A list of routines that the environment has already loaded
         self._routines = {}
 
+        # The global database file, which is opened when first used, how
+        # often its journal is committed and whether it is shared with
+        # other processes
+        self._db_path = database
+        self._db_commit = (commit_records, commit_interval)
+        self._db_shared = shared_database
+        self._db = None
+
+        # The database file the environment was created with, and the
+        # directory of the temporary database in use, if any
+        self._db_default = database
+        self._db_temp = None
+
+        # The lock table shared by processes using the database, which is
+        # opened when a name is first locked
+        self._locks = None
+
+        # The open transaction, its nesting level ($TLEVEL), the number of
+        # times it has been restarted ($TRESTART) and the point it restarts
+        # from
+        self._txn = None
+        self._tlevel = 0
+        self._trestart = 0
+        self._restart = None
+
     def __repr__(self):
         """String representation of this environment."""
         return "Environment({lvl}, {rou})".format(
@@ -123,7 +177,7 @@ class MUMPSEnvironment:
     def get_current_rou(self):
         """Return the current environment routine."""
         if len(self._call_stack) > 0:
-            return self._call_stack[self._cur-1][1]
+            return self._call_stack[-1][1]
         return None
 
     def set_current_rou(self, rou, tag=None):
@@ -168,29 +222,9 @@ class MUMPSEnvironment:
         if args is None:
             return
 
-        # Push the argument list on the stack
+        # Bind the argument list names on the current stack frame
         for i, arg in enumerate(args):
-            # Convert the tag argument name to an identifier
-            # This is the new name of the symbol on the current stack frame
-            ident = mumpy.MUMPSIdentifier(arg, self)
-
-            # Try to get the matching value from the input list
-            # If we can't find it, that's fine; MUMPS functions do not
-            # require any or all parameters to be input - just set it null.
-            #
-            # Check for TypeError in case the input argument list is None.
-            try:
-                # Create the pointer if necessary
-                v = in_args[i]
-                in_arg = str(mumpy.MUMPSExpression(v))
-            except (IndexError, TypeError):
-                in_arg = mumpy.mumps_null()
-
-            # New the argument list name
-            self.new(ident)
-
-            # Set the new value
-            self._set(ident, in_arg)
+            self._bind(arg, self._argument(in_args, i))
 
     def push_func_to_stack(self, func):
         """Given a MUMPS Function or Subroutine call, push the necessary
@@ -201,209 +235,457 @@ class MUMPSEnvironment:
             raise TypeError(
                 "Expecting Function call, got {}".format(type(func)))
 
+        # Look up the routine and the tag's argument list at the call site
+        f = func.site.resolve(self)
+        self.push_call(func.tag, f, func.site.names, func.args, func.is_func)
+
+    def tag_args(self, rou, tag, args):
+        """Return the argument list of the tag `tag` of the routine `rou`,
+        checking it against the arguments `args` of a call of the tag."""
+        try:
+            names = rou.tag_args(tag)
+        except KeyError:
+            raise mumpy.MUMPSSyntaxError("Tag not found in routine.",
+                                         err_type="NO LINE")
+        _check_args(names, args)
+        return names
+
+    def push_call(self, tag, rou, names, args, is_func=False):
+        """Push a new stack frame for a call of `tag^rou`, binding each of
+        the tag argument names in `names` to the matching argument value or
+        pointer in `args`. Callers must have checked the arguments against
+        the names."""
+        # Evaluate the arguments before pushing the new frame, since they
+        # refer to the caller's variables
+        if names:
+            in_args = [self._argument(args, i) for i in range(len(names))]
+
         # Push a new stack frame
-        self.push()
-        self._call_stack.append((func.tag, func.rou))
+        frame = self._pool.pop() if self._pool else MUMPSFrame()
+        self._frames.append(frame)
+        self._cur += 1
+        self._call_stack.append((tag, rou))
 
         # According the GT.M programmers guide, $T should stack only
         # for extrinsic functions and argumentless DO commands
-        if func.is_func:
-            self.new("$T")
-            self.set("$T", mumpy.mumps_true())
+        if is_func:
+            frame.test = self._test
+            self._test = self._true
 
-        # Get the argument list and push existing values onto the new frame
-        args = func.rou.tag_args(func.tag)
+        # Bind the argument list names on the new stack frame
+        if names:
+            for name, var in zip(names, in_args):
+                self._bind(name, var)
 
-        # Check for syntax errors in argument list
-        _check_args(args, func.args)
+    def pop_func_from_stack(self):
+        """Return execution to the original function or subroutine."""
+        self.pop()
+        self._call_stack.pop()
 
-        # Return if no arguments for this function
-        if args is None:
-            return
+    def call_depth(self):
+        """Return the number of frames on the call stack."""
+        return len(self._call_stack)
 
-        # Push the argument list on the stack
-        for i, arg in enumerate(args):
-            # Convert the tag argument name to an identifier
-            # This is the new name of the symbol on the current stack frame
-            ident = mumpy.MUMPSIdentifier(arg, self)
-
-            # Try to get the matching value from the input list
-            # If we can't find it, that's fine; MUMPS functions do not
-            # require any or all parameters to be input - just set it null.
-            #
-            # Check for TypeError in case the input argument list is None.
-            ptr = None
-            try:
-                # Create the pointer if necessary
-                v = func.args[i]
-                if isinstance(v, mumpy.MUMPSPointerIdentifier):
-                    in_arg = None
-                    ptr = v
-                else:
-                    in_arg = str(mumpy.MUMPSExpression(v))
-            except (IndexError, TypeError):
-                in_arg = mumpy.mumps_null()
+    def unwind(self, depth, level):
+        """Return execution to the call stack frame at `depth` and the
+        variable stack frame at `level`, discarding any frames above them."""
+        del self._call_stack[depth:]
+        while self._cur > level:
+            self.pop()
 
-            # New the argument list name
-            if ptr is None:
-                self.new(ident)
-            else:
-                self._new_pointer(ident)
+    ###################
+    # LOCK FUNCTIONS
+    # Locked names are shared with every process using the same database
+    # through a lock table file beside the database file.
+    ###################
+    def lock_table(self):
+        """Return the lock table for this environment."""
+        if self._locks is None:
+            self._locks = mumpy.locks.open_lock_table(
+                self.database_path() + '.lck'
+            )
+        return self._locks
+
+    def lock(self, idents, incremental=False, timeout=None):
+        """Lock the names of the variables given by `idents`, releasing
+        every other locked name first unless `incremental` is True. Return
+        True if the names were locked within `timeout` seconds."""
+        names = [_lock_name(ident) for ident in idents]
+        if incremental:
+            return self.lock_table().lock_add(names, timeout=timeout)
+        return self.lock_table().lock(names, timeout=timeout)
+
+    def unlock(self, idents):
+        """Release one lock on each of the names of the variables given by
+        `idents`."""
+        if self._locks is not None:
+            self._locks.unlock([_lock_name(ident) for ident in idents])
+
+    def unlock_all(self):
+        """Release every locked name."""
+        if self._locks is not None:
+            self._locks.unlock_all()
 
-            # Set the new value
-            self._set(ident, in_arg, pointer=ptr)
+    ###################
+    # TRANSACTION FUNCTIONS
+    # Changes to globals made in a transaction are held by the transaction
+    # until the outermost TCOMMIT, when they are applied to the global
+    # store together. Transactions which conflict with changes made by
+    # another transaction when they commit are restarted from their TSTART.
+    ###################
+    def tlevel(self):
+        """Return the number of open transactions (`$TLEVEL`)."""
+        return self._tlevel
+
+    def trestarts(self):
+        """Return the number of times the open transaction has been
+        restarted (`$TRESTART`)."""
+        return self._trestart
+
+    def tstart(self, restart=None):
+        """Start a transaction, nested in the open transaction if there is
+        one. The outermost transaction restarts from the command given by
+        the (routine, line number, command index) triple `restart`, if it
+        is given."""
+        if self._tlevel == 0:
+            self._txn = self.global_store().begin()
+            if restart is not None:
+                rou, line, cmd = restart
+                self._restart = (rou, line, cmd, self.call_depth(),
+                                 self._cur)
+        self._tlevel += 1
+
+    def tcommit(self):
+        """Commit the innermost open transaction. Committing the outermost
+        transaction applies its changes to the global store, or restarts it
+        if it conflicts with a change made since it started."""
+        if self._tlevel == 0:
+            raise mumpy.MUMPSSyntaxError("No transaction to commit.",
+                                         err_type="NO TRANSACTION")
+
+        self._tlevel -= 1
+        if self._tlevel > 0:
+            return
 
-    def pop_func_from_stack(self):
-        """Return execution to the original function or subroutine."""
-        self.pop()
-        self._call_stack.pop()
+        txn, self._txn = self._txn, None
+        if not txn.commit():
+            self._restart_txn()
+        self._trestart = 0
+        self._restart = None
+
+    def trollback(self):
+        """Discard all of the open transactions and their changes."""
+        if self._txn is not None:
+            self._txn.rollback()
+        self._txn = None
+        self._tlevel = 0
+        self._trestart = 0
+        self._restart = None
+
+    def trestart(self):
+        """Discard the changes of the open transactions and restart the
+        outermost transaction."""
+        if self._tlevel == 0:
+            raise mumpy.MUMPSSyntaxError("No transaction to restart.",
+                                         err_type="NO TRANSACTION")
+
+        self._txn.rollback()
+        self._txn = None
+        self._restart_txn()
+
+    def _restart_txn(self):
+        """Raise the exception which restarts the outermost transaction,
+        or an error if it has no restart point or has been restarted too
+        many times."""
+        self._tlevel = 0
+        restart, self._restart = self._restart, None
+        if restart is None or self._trestart >= _max_restarts:
+            self._trestart = 0
+            raise mumpy.MUMPSSyntaxError("Transaction conflicts with "
+                                         "another update.",
+                                         err_type="TRANSACTION CONFLICT")
+
+        self._trestart += 1
+        raise mumpy.MUMPSTransactionRestart(*restart)
 
     ###################
     # SYMBOL FUNCTIONS
     ###################
+    def global_store(self):
+        """Return the global store for this environment."""
+        if self._db is None:
+            self._db = mumpy.storage.open_store(
+                self._db_path,
+                commit_records=self._db_commit[0],
+                commit_interval=self._db_commit[1],
+                shared=self._db_shared,
+            )
+        return self._db
+
+    def share_database(self):
+        """Share the global database file with other processes (such as the
+        jobs started by this one) from now on."""
+        self._db_shared = True
+        if self._db is not None:
+            self._db.share()
+
+    def database_path(self):
+        """Return the path of the global database file."""
+        return mumpy.storage.database_path(self._db_path)
+
+    def use_database(self, path=None):
+        """Use the database file `path` for globals from now on, or a new
+        temporary database if `path` is empty, or the database file the
+        environment was created with if `path` is None. Names which are
+        already locked remain in the lock table they were locked in."""
+        if self._tlevel > 0:
+            raise mumpy.MUMPSSyntaxError("Cannot change the database in a "
+                                         "transaction.",
+                                         err_type="IN TRANSACTION")
+
+        temp = None
+        if path is None:
+            path = self._db_default
+        elif path == "":
+            temp = tempfile.mkdtemp(prefix="mumpy")
+            atexit.register(shutil.rmtree, temp, ignore_errors=True)
+            path = os.path.join(temp, "mumpy.db")
+
+        self._close_temp_database()
+        self._db_path, self._db_temp = path, temp
+        self._db = None
+
+    def _close_temp_database(self):
+        """Close and delete the temporary database in use, if any."""
+        if self._db_temp is None:
+            return
+        mumpy.storage.close_store(self._db_path)
+        shutil.rmtree(self._db_temp, ignore_errors=True)
+        self._db_temp = None
+
+    def use_locals(self, kind=None):
+        """Create new local variables as flat locals from now on if `kind` is
+        "FLAT", as tree locals if it is "TREE", or of the kind the
+        environment was created with if `kind` is None. Variables which
+        already exist keep their kind."""
+        kinds = {"FLAT": mumpy.MUMPSFlatLocal, "TREE": mumpy.MUMPSLocal}
+        if kind is None:
+            self._local = self._local_default
+        elif kind.upper() in kinds:
+            self._local = kinds[kind.upper()]
+        else:
+            raise mumpy.MUMPSSyntaxError("Invalid kind of local variable "
+                                         "'{}'.".format(kind),
+                                         err_type="INVALID LOCALS")
+
+    def _global(self, key):
+        """Return the global variable named by `key`, or None if `key`
+        does not name a global."""
+        if isinstance(key, mumpy.MUMPSIdentifier) and key.is_global():
+            return mumpy.MUMPSGlobal(self._globals(), key)
+        return None
+
+    def _globals(self):
+        """Return the open transaction if there is one, which holds the
+        global changes made in it, or otherwise the global store."""
+        if self._txn is not None:
+            return self._txn
+        return self.global_store()
+
     def __contains__(self, item):
         """Return False if `item` is not defined in the environment. This
         will be used for the `$DATA` operation on local variables."""
-        for frame in reversed(self._stack):
-            if item in frame:
-                return True
+        if self._global(item) is not None:
+            return self._globals().exists(str(item)[1:])
+        if type(item) is str:
+            return self._test is not None
 
-        return False
+        return item._ident in self._symbols
 
     def get(self, key, get_var=False):
-        """Return the item named at the current stack level or fall down
-        the stack until we find an item with that name. If `get_var` is
-        specified, return access to the entire local variable object.
-        Most clients should not need to use `get_var`, but it is needed
-        for `$DATA` function calls."""
-        # Check to see if the variable is a pointer, so we can return the
-        # actual value from the stack it resides in
-        item = self._get(key)
-        if item[0] is not None:
-            item = self._get_pointer(item[0], self._cur)
-
-        # Otherwise, we can just return the scalar value
-        try:
-            return item[1].get(key) if not get_var else item[1]
-        except AttributeError:
+        """Return the item named by `key` from the symbol table. If
+        `get_var` is specified, return access to the entire local variable
+        object. Most clients should not need to use `get_var`, but it is
+        needed for `$DATA` function calls."""
+        # $TEST is the only system variable, and is held apart
+        if type(key) is str:
+            return mumpy.mumps_null() if self._test is None else self._test
+
+        # Globals are held in the global store rather than the symbol table
+        name = key._ident
+        if name[0] == "^":
+            var = mumpy.MUMPSGlobal(self._globals(), key)
+            return var if get_var else var.get(key)
+
+        var = self._symbols.get(name)
+        if var is None:
             return mumpy.mumps_null()
+        return var if get_var else var.get(key)
 
-    def _get_pointer(self, key, end):
-        """Private pointer get function needed to recurse down the stack
-        if a pointer points back several levels on the stack."""
-        item = self._get(key, end=end)
-        if item[0] is not None and (end-1) >= 0:
-            return self._get_pointer(item[0], end-1)
+    def set(self, key, value):
+        """Set the item named by `key` in the symbol table. If it is not
+        defined, define it at the current stack level."""
+        if type(key) is str:
+            self._test = value
+            return
 
-        # Otherwise, we can just return the scalar value
-        return item
+        name = key._ident
+        if name[0] == "^":
+            mumpy.MUMPSGlobal(self._globals(), key).set(key, value)
+            return
 
-    def _get(self, key, start=0, end=None):
-        """Private environment variable retrieval function. This function
-        retrieves the (pointer, value) tuple from the stack. In general, clients
-        will just want the value, so the public function returns only the
-        value."""
-        end = len(self._stack) if end is None or end < start else end
+        var = self._symbols.get(name)
+        if var is None:
+            var = self._variable(name)
+        var.set(key, value)
 
-        for frame in reversed(self._stack[start:end]):
-            if key in frame:
-                return frame[key]
+    def _variable(self, name):
+        """Return the local variable bound to `name`, defining an empty
+        variable at the current stack level if it is not defined."""
+        var = self._symbols.get(name)
+        if var is None:
+            var = self._local()
+            self._bind(name, var)
+        return var
+
+    def _bind(self, name, var):
+        """Bind `name` to the local variable `var` at the current stack
+        level, saving the variable it hides to be restored when the frame
+        is popped. Only the first variable hidden at a level is saved, and
+        none are saved at the base level, which is never popped."""
+        if self._cur > 0:
+            self._frames[-1].saved.setdefault(name, self._symbols.get(name))
+        self._symbols[name] = var
+
+    def _argument(self, in_args, i):
+        """Return the local variable bound to the tag argument at index `i`
+        when it is called with the argument list `in_args`. A pointer
+        argument is resolved once, to the caller's variable itself (which
+        is defined, though empty, if it was not), so that reads and writes
+        through it need no further lookups."""
+        # MUMPS functions do not require any or all parameters to be
+        # input - missing arguments are just set null. Check for TypeError
+        # in case the input argument list is None.
+        try:
+            v = in_args[i]
+        except (IndexError, TypeError):
+            return self._local(mumpy.mumps_null())
+
+        # Values are evaluated now; strings and integers are already
+        # canonical values
+        t = type(v)
+        if t is mumpy.MUMPSPointerIdentifier:
+            return self._variable(v._ident)
+        if t is not str and t is not int:
+            v = str(mumpy.MUMPSExpression(v))
+        return self._local(v)
+
+    def merge(self, dst, src):
+        """Copy the value and descendants of the variable given by `src`
+        beneath the variable given by `dst`, as a `MERGE` command does."""
+        svar = self.get(src, get_var=True)
+        if not isinstance(svar, (mumpy.MUMPSLocalVariable, mumpy.MUMPSGlobal)):
+            return
+        if str(svar.data(src)) == "0":
+            return
 
-        return None, mumpy.mumps_null()
+        dvar = self.get(dst, get_var=True)
+        if not isinstance(dvar, (mumpy.MUMPSLocalVariable, mumpy.MUMPSGlobal)):
+            dvar = self._variable(dst._ident)
 
-    def set(self, key, value):
-        """Set the item with the given name at the highest stack level
-        we can find it at. If it does not exist at any stack level,
-        set it at the current stack level."""
-        # Check if the value is a pointer, so we can update that value
-        ptr = self._get(key)[0]
-        if ptr is not None:
-            self._set_pointer(ptr, value, self._cur)
-
-        # If the value is not a pointer, we can modify it easily
-        self._set(key, value, pointer=ptr)
-
-    def _set_pointer(self, key, value, end):
-        """Private pointer set function needed to recurse down the stack
-        if a pointer points back several levels on the stack."""
-        ptr = self._get(key, end=end)[0]
-        if ptr is not None and (end-1) >= 0:
-            self._set_pointer(ptr, value, end-1)
-
-        # If the value is not a pointer, we can modify it easily
-        self._set(key, value, pointer=ptr, end=end)
-
-    def _set(self, key, value, pointer=None, start=0, end=None):
-        """Private environment variable set function. This function can
-        be used internally to save a (pointer, value) tuple onto the
-        stack. External clients should never have to do this (since the
-        environment is responsible for function stack transfers), so
-        the public function always sets a None pointer value."""
-        end = len(self._stack) if end is None or end < start else end
-
-        for frame in reversed(self._stack[start:end]):
-            if key in frame:
-                try:
-                    # The variable is a value, update its value
-                    var = frame[key][1]
-                    var.set(key, value)
-                    frame[key] = (pointer, var)
-                except AttributeError:
-                    # The variable is a pointer, update its pointer
-                    frame[key] = (pointer, None)
+        # A node cannot be merged into one of its own descendants (or the
+        # reverse), but merging a node into itself does nothing
+        if dvar is svar or (isinstance(dvar, mumpy.MUMPSGlobal) and
+                            str(dst) == str(src)):
+            dsubs, ssubs = _subscript_strings(dst), _subscript_strings(src)
+            if dsubs == ssubs:
                 return
-
-        var = mumpy.MUMPSLocal()
-        var.set(key, value)
-        self._stack[self._cur][key] = (pointer, var)
+            n = min(len(dsubs), len(ssubs))
+            if dsubs[:n] == ssubs[:n]:
+                raise mumpy.MUMPSSyntaxError("Cannot MERGE a variable with "
+                                             "its own descendant.",
+                                             err_type="MERGE OVERLAP")
+
+        dvar.merge(dst, svar, src)
+
+    def query(self, ident):
+        """Return the reference to the first node with a value after the
+        node given by `ident`, as the `$QUERY` function does, or null if
+        there is none."""
+        var = self.get(ident, get_var=True)
+        if not isinstance(var, (mumpy.MUMPSLocalVariable, mumpy.MUMPSGlobal)):
+            return ""
+        subs = var.query(ident)
+        if subs is None:
+            return ""
+        return mumpy.storage.node_reference(str(ident), subs)
 
     def new(self, key):
         """Create a new symbol with the given name on the current stack
-        level with a null value."""
-        if not key in self._stack[self._cur]:
-            self._stack[self._cur][key] = (None,
-                                           mumpy.MUMPSLocal(mumpy.mumps_null()))
-
-    def _new_pointer(self, key):
-        """Create a new symbol with the given name on the current stack
-        level with a None value, which is used for values which are strictly
-        pointers."""
-        if not key in self._stack[self._cur]:
-            self._stack[self._cur][key] = (None, None)
+        level with a null value, hiding any existing symbol until the
+        frame is popped."""
+        if type(key) is str:
+            if self._frames[-1].test is None:
+                self._frames[-1].test = self._test
+            self._test = mumpy.mumps_null()
+            return
+        self._bind(key._ident, self._local(mumpy.mumps_null()))
 
     def kill(self, key):
-        """Kill a symbol with the given key at the highest stack level we
-        can find it at. If that symbol doesn't exist, do nothing."""
-        for frame in reversed(self._stack):
-            if key in frame:
-                if key.subscripts() is None:
-                    del frame[key]
-                else:
-                    var = frame[key][1]
-                    var.delete(key)
-                return
+        """Kill the symbol with the given key. If that symbol doesn't exist,
+        do nothing."""
+        var = self._global(key)
+        if var is not None:
+            var.delete(key)
+            return
+
+        name = key._ident
+        if key.subscripts() is None:
+            self._symbols.pop(name, None)
+            return
+
+        var = self._symbols.get(name)
+        if var is not None:
+            var.delete(key)
 
     def kill_all(self):
         """Clears the entire symbol table (all the way down the stack)."""
-        for frame in reversed(self._stack):
-            frame.clear()
+        self._symbols.clear()
+        for frame in self._frames:
+            frame.saved.clear()
 
     def push(self):
-        """Push a new frame onto the stack."""
-        self._stack.append({})
+        """Push a new frame onto the stack, reusing a popped frame if there
+        is one."""
+        self._frames.append(self._pool.pop() if self._pool else MUMPSFrame())
         self._cur += 1
 
     def pop(self):
-        """Pop the last frame off the stack."""
-        self._stack.pop()
+        """Pop the last frame off the stack, restoring the variables (and
+        $TEST) it hid."""
+        frame = self._frames.pop()
+        if frame.saved:
+            symbols = self._symbols
+            for name, var in frame.saved.items():
+                if var is None:
+                    symbols.pop(name, None)
+                else:
+                    symbols[name] = var
+            frame.saved.clear()
+        if frame.test is not None:
+            self._test = frame.test
+            frame.test = None
+        self._pool.append(frame)
         self._cur -= 1
 
     def print(self):
-        """Print the stack frames in reverse order."""
-        for i, frame in enumerate(reversed(self._stack)):
-            self.writeln("[Stack Frame {}]".format(i))
-            for k, v in frame.items():
-                self.writeln(v[1].pprint_str(k))
+        """Print the symbols visible at the current stack level in name
+        order. Variables passed by reference which were never set are not
+        printed."""
+        for name in sorted(self._symbols):
+            var = self._symbols[name]
+            if str(var.data(name)) != "0":
+                self.writeln(var.pprint_str(name))
 
     ###################
     # OUTPUT FUNCTIONS
@@ -540,6 +822,33 @@ def _check_args(tag_args, in_args):
                                      err_type="TAGFEWERARGS")
 
 
+def _subscript_strings(ident):
+    """Return the tuple of subscript strings of the identifier `ident`."""
+    subs = ident.subscripts()
+    return () if subs is None else tuple(str(s) for s in subs)
+
+
+def _lock_name(ident):
+    """Return the lock name of the variable given by `ident`, which is the
+    pair of its name and its subscript strings."""
+    return str(ident), _subscript_strings(ident)
+
+
+class MUMPSFrame:
+    """A frame of the variable stack, holding the bindings hidden by the
+    symbols bound at its level (and $TEST, if it was stacked) so they can
+    be restored when it is popped."""
+    __slots__ = ('saved', 'test')
+
+    def __init__(self):
+        # The variable each name bound at this level hid, or None if the
+        # name was not bound below it
+        self.saved = {}
+
+        # The value of $TEST to restore, or None if it was not stacked
+        self.test = None
+
+
 class MUMPSDevice:
     """Represents a file or network device usable by an M routine.
 
@@ -59,7 +59,64 @@ def main():
                         required=False,
                         action='store_true'
                         )
+    parser.add_argument("-db", "--database",
+                        help="The database file holding global variables",
+                        required=False,
+                        nargs=1
+                        )
+    parser.add_argument("-sdb", "--shared-database",
+                        help="Share the database file with other processes "
+                             "using it (as jobs started with JOB do)",
+                        required=False,
+                        action='store_true'
+                        )
+    parser.add_argument("-jr", "--journal-records",
+                        help="Commit the global journal every N records",
+                        required=False,
+                        type=int,
+                        nargs=1
+                        )
+    parser.add_argument("-jt", "--journal-time",
+                        help="Commit the global journal every N milliseconds "
+                             "(0 to only commit by records)",
+                        required=False,
+                        type=int,
+                        nargs=1
+                        )
+    parser.add_argument("-fl", "--flat-locals",
+                        help="Keep each local array in one sorted map of "
+                             "its full subscripts rather than a map for "
+                             "each node.",
+                        required=False,
+                        action='store_true'
+                        )
+    parser.add_argument("-x", "--exact",
+                        help="Compute with exact decimal numbers (to 18 "
+                             "significant digits) rather than floats.",
+                        required=False,
+                        action='store_true'
+                        )
+    parser.add_argument("-i", "--interpret",
+                        help="Interpret routines line by line rather than "
+                             "running their compiled code.",
+                        required=False,
+                        action='store_true'
+                        )
+    parser.add_argument("-ex", "--exceptions",
+                        help="Raise exceptions for QUIT, GOTO, IF and FOR "
+                             "commands when interpreting, as earlier "
+                             "versions did.",
+                        required=False,
+                        action='store_true'
+                        )
     args = parser.parse_args()
+    database = None if args.database is None else args.database[0]
+    records = None if args.journal_records is None else args.journal_records[0]
+    interval = None if args.journal_time is None else args.journal_time[0]
+
+    # Numbers are converted as routines are compiled, so the arithmetic mode
+    # must be chosen first
+    mumpy.set_exact_arithmetic(args.exact)
 
     # Process routine compilations first
     if args.compile:
@@ -73,18 +130,39 @@ def main():
                   device=None if args.device is None else args.device[0],
                   args=args.args,
                   recompile=args.recompile,
-                  debug=args.debug)
+                  debug=args.debug,
+                  compiled=not args.interpret,
+                  exceptions=args.exceptions,
+                  database=database,
+                  shared_database=args.shared_database,
+                  commit_records=records,
+                  commit_interval=interval,
+                  flat_locals=args.flat_locals)
 
     # If the user wants to neither compile any routines or interpret any files,
     # start the REPL
     if not args.compile and not args.file:
-        start_repl(args.debug)
-
-
-def start_repl(debug=False):
+        start_repl(args.debug,
+                   compiled=not args.interpret,
+                   exceptions=args.exceptions,
+                   database=database,
+                   shared_database=args.shared_database,
+                   commit_records=records,
+                   commit_interval=interval,
+                   flat_locals=args.flat_locals)
+
+
+def start_repl(debug=False, compiled=True, exceptions=False, database=None,
+               shared_database=False, commit_records=None,
+               commit_interval=None, flat_locals=False):
     """Start the interpreter loop."""
-    env = mumpy.MUMPSEnvironment()
-    p = mumpy.MUMPSParser(env, debug=debug)
+    env = mumpy.MUMPSEnvironment(database=database,
+                                 shared_database=shared_database,
+                                 commit_records=commit_records,
+                                 commit_interval=commit_interval,
+                                 flat_locals=flat_locals)
+    p = mumpy.MUMPSParser(env, debug=debug, compiled=compiled,
+                          exceptions=exceptions)
 
     # Catch the Keyboard Interrupt to let us exit gracefully
     try:
@@ -125,7 +203,9 @@ def compile_routine(files, debug=False):
 
 
 def interpret(file, tag=None, args=None, device=None,
-              recompile=False, debug=False):
+              recompile=False, debug=False, compiled=True, exceptions=False,
+              database=None, shared_database=False, commit_records=None,
+              commit_interval=None, flat_locals=False):
     """Interpret a routine file.."""
     # Prepare the file
     try:
@@ -139,16 +219,25 @@ def interpret(file, tag=None, args=None, device=None,
         print("{} recompiled successfully!".format(file))
 
     # Prepare the environment and parser
-    env = mumpy.MUMPSEnvironment()
-    p = mumpy.MUMPSParser(env, debug=debug)
+    env = mumpy.MUMPSEnvironment(database=database,
+                                 shared_database=shared_database,
+                                 commit_records=commit_records,
+                                 commit_interval=commit_interval,
+                                 flat_locals=flat_locals)
+    p = mumpy.MUMPSParser(env, debug=debug, compiled=compiled,
+                          exceptions=exceptions)
 
     # If the user specifies another default device, use that
     if device is not None:
         env.open(device)
         env.use(device)
 
-    # Parse the file
+    # Parse the file; errors are reported on the default device
     try:
         p.parse_file(f, tag=tag, args=args)
     except mumpy.MUMPSSyntaxError as e:
-        print(e)
+        if device is None:
+            print(e)
+        else:
+            env.use(device)
+            env.writeln(e)
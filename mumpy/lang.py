@@ -10,7 +10,10 @@ Licensed under a BSD license. See LICENSE for more information.
 
 Author: Christopher Rink"""
 import datetime
-import random
+import functools
+import itertools
+import math
+import re
 import string
 import os
 import subprocess
@@ -31,7 +34,9 @@ _horolog_midnight = datetime.time()
 # Command functions execute the actions given by a MUMPS keyword command
 # such as 'w' (write). Each matches the signature func(args, env). Functions
 # will either implicitly return None or raise one of the following exceptions
-# to indicate to the parser how to proceed next:
+# to indicate to the parser how to proceed next (parsers which do not use
+# exceptions for control flow use the command status functions below, which
+# return these signals rather than raising them):
 # - MUMPSReturn() encapsulates a return value (or None) and indicates that
 #   the parser should exit the current scope (subroutine or function)
 # - MUMPSCommandEnd() indicates to the parser that it should continue
@@ -60,7 +65,7 @@ def halt(args, env):
 def hang(args, env):
     """Sleep the system for the given number of seconds."""
     for slp in args:
-        time.sleep(slp)
+        time.sleep(float(slp.as_number()))
 
 
 def if_cmd(args, env):
@@ -86,6 +91,16 @@ def else_cmd(args, env):
 
 def goto_cmd(args, env):
     """Process a MUMPS GOTO command."""
+    arg = _goto_target(args, env)
+    if arg is not None:
+        # Raise a GotoLine exception to the parser
+        raise MUMPSGotoLine(arg)
+
+
+def _goto_target(args, env):
+    """Return the first argument of a GOTO command whose post-conditional
+    is true, checking that its tag can be found, or None if there is no
+    such argument."""
     for arg in args:
         # Process the argument post-conditional
         if arg.post is not None and not arg.post:
@@ -105,8 +120,8 @@ def goto_cmd(args, env):
                 raise MUMPSSyntaxError("Tag not found in current routine.",
                                        err_type="NO LINE")
 
-        # Raise a GotoLine exception to the parser
-        raise MUMPSGotoLine(arg)
+        return arg
+    return None
 
 
 def for_start(args, env):
@@ -210,6 +225,32 @@ def kill_all(args, env):
     env.kill_all()
 
 
+def merge(args, env):
+    """Merge each source variable into its destination variable."""
+    for dst, src in args:
+        env.merge(dst, src)
+
+
+def lock(args, env):
+    """Lock (or with `+`, also lock, or with `-`, unlock) the names of the
+    variables given in each argument. Arguments with a timeout set `$TEST`
+    to whether the names were locked in time."""
+    for op, names, timeout in args:
+        if op == '-':
+            env.unlock(names)
+            continue
+
+        timeout = None if timeout is None else timeout.as_number()
+        locked = env.lock(names, incremental=op == '+', timeout=timeout)
+        if timeout is not None:
+            env.set("$T", mumps_true() if locked else mumps_false())
+
+
+def unlock_all(args, env):
+    """Release every locked name."""
+    env.unlock_all()
+
+
 def job_cmd(args, env):
     """Spawn a new job at the given tag^routine with the given arguments."""
     for arg in args:
@@ -228,6 +269,12 @@ def job_cmd(args, env):
         cmd.append(sub.rou.name())
         cmd.append("-t")
         cmd.append(str(sub.tag))
+
+        # Jobs share the globals (and locks) of this process
+        env.share_database()
+        cmd.append("-db")
+        cmd.append(env.database_path())
+        cmd.append("-sdb")
         # cmd.append("-r")                  # No need to force recompile
 
         # Add arguments if they are given
@@ -323,7 +370,10 @@ def read(args, env):
 def set_var(args, env):
     """Set the symbols in the argument list to the given expression."""
     for item in args:
-        env.set(item[0], item[1].reduce())
+        if isinstance(item[0], MUMPSSetTarget):
+            item[0].set(item[1].reduce())
+        else:
+            env.set(item[0], item[1].reduce())
 
 
 def write(args, env):
@@ -338,9 +388,40 @@ def write_symbols(args, env):
 
 
 def view_cmd(args, env):
-    """Set an environmental factor."""
-    #TODO: this
-    pass
+    """Set an environmental factor. `VIEW "DATABASE":path` uses the
+    database file `path` for globals, or a new temporary database if
+    `path` is empty; `VIEW "DATABASE"` returns to the database file the
+    process started with. `VIEW "LOCALS":kind` creates new local variables
+    as "FLAT" or "TREE" locals; `VIEW "LOCALS"` returns to the kind the
+    process started with. Other keywords are ignored."""
+    for arg in args:
+        keyword = str(arg[0]).upper()
+        if keyword == "DATABASE":
+            env.use_database(str(arg[1]) if len(arg) > 1 else None)
+        elif keyword == "LOCALS":
+            env.use_locals(str(arg[1]) if len(arg) > 1 else None)
+
+
+def tstart(args, env, restart=None):
+    """Start a (possibly nested) transaction. The outermost transaction is
+    restarted from the `restart` routine, line and command if it cannot
+    commit."""
+    env.tstart(restart)
+
+
+def tcommit(args, env):
+    """Commit the innermost open transaction."""
+    env.tcommit()
+
+
+def trollback(args, env):
+    """Discard all of the open transactions."""
+    env.trollback()
+
+
+def trestart(args, env):
+    """Discard the open transactions and restart from the outermost."""
+    env.trestart()
 
 
 ###################
@@ -351,7 +432,14 @@ def view_cmd(args, env):
 # exceptions with their return value to indicate to the parser to return
 # and return to the previous stack frame.
 ###################
-class MUMPSReturn(Exception):
+class MUMPSControlFlow(Exception):
+    """Base class of the signals which commands give the parser to change
+    the flow of execution. The signals are raised by commands bound by
+    parsers which use exceptions for control flow, and returned by the
+    commands bound by other parsers."""
+
+
+class MUMPSReturn(MUMPSControlFlow):
     """The expression return value from a function is encapsulated in this
     exception. Quit commands will raise this exception to let the
     interpreter know that it should return to the previous stack level."""
@@ -368,27 +456,134 @@ class MUMPSReturn(Exception):
         return self._val
 
 
-class MUMPSCommandEnd(Exception):
+class MUMPSCommandEnd(MUMPSControlFlow):
     """An indicator to the parser that the current line should finish
     execution. Conditional commands raise this exception."""
     def __init__(self):
         pass
 
 
-class MUMPSGotoLine(Exception):
+class MUMPSGotoLine(MUMPSControlFlow):
     """An indicator to the parser to shift execution to the attached tag
     and routine. """
     def __init__(self, func):
         self.func = func
 
 
-class MUMPSForLine(Exception):
+class MUMPSTransactionRestart(Exception):
+    """An indicator to the parser to resume execution at the `TSTART`
+    command of a transaction which must be restarted, given by the routine,
+    line number and index of the command on its line and the depth of the
+    call and variable stacks when the transaction was started."""
+    def __init__(self, rou, line, cmd, depth, level):
+        self.rou = rou
+        self.line = line
+        self.cmd = cmd
+        self.depth = depth
+        self.level = level
+
+
+class MUMPSForLine(MUMPSControlFlow):
     """An indicator to the MUMPS line execute function to defer the
     remainder of command executions to the `FOR` command contained herein."""
     def __init__(self, func):
         self.func = func
 
 
+###################
+# COMMAND STATUS FUNCTIONS
+# Parsers which do not use exceptions for control flow bind the IF, ELSE,
+# GOTO, QUIT and FOR commands to these functions, which return the signal
+# for the parser as the status of the command rather than raising it. A
+# false IF or a QUIT therefore costs no more than any other command. Signals
+# which carry no value are shared.
+###################
+def if_status(args, env):
+    """Process an IF MUMPS command, returning its status."""
+    for expr in args:
+        if not expr:
+            env.set("$T", mumps_false())
+            return _command_end
+    env.set("$T", mumps_true())
+    return None
+
+
+def if_no_args_status(args, env):
+    """Process an argumentless IF MUMPS command, returning its status."""
+    if not env.get("$T").equals(mumps_true()):
+        return _command_end
+    return None
+
+
+def else_status(args, env):
+    """Process a MUMPS ELSE command, returning its status."""
+    if not env.get("$T").equals(mumps_false()):
+        return _command_end
+    return None
+
+
+def goto_status(args, env):
+    """Process a MUMPS GOTO command, returning its status."""
+    arg = _goto_target(args, env)
+    return None if arg is None else MUMPSGotoLine(arg)
+
+
+def quit_status(args, env):
+    """Quit from the current scope, returning the value as the status."""
+    # Quits from a DO block should have no argument
+    if args is None:
+        return _quit
+
+    # Check for multiple quit arguments
+    if len(args) > 1:
+        raise MUMPSSyntaxError("QUIT commands cannot have multiple arguments",
+                               err_type="INVALID ARGUMENTS")
+
+    # Return the evaluated expression otherwise
+    return MUMPSReturn(str(args[0]))
+
+
+def for_status(args, env):
+    """Return the status which lets the line defer the rest of its commands
+    to the `FOR` command."""
+    return _for_line
+
+
+def _for_loop(args, env, cmds):
+    """Implement the MUMPS FOR command over the remaining commands `cmds`
+    of its line, returning the status of the line."""
+    # Unlimited FOR loops will have no args and loop until they quit
+    if args is None:
+        var, values = None, itertools.repeat(None)
+    else:
+        var, gen = _process_for_args(args)
+        values = gen()
+
+    for arg in values:
+        # Update the value of the control variable in the environment
+        if var is not None:
+            set_var(((var, arg),), env)
+
+        # A false IF ends only this iteration of the loop, while a QUIT
+        # ends the loop and a GOTO leaves the line
+        status = _execute_line(cmds)
+        if status is None or isinstance(status, MUMPSCommandEnd):
+            continue
+        if isinstance(status, MUMPSReturn):
+            if status.value() is not None:
+                raise MUMPSSyntaxError("Cannot QUIT with value "
+                                       "from FOR loop",
+                                       err_type="ILLEGAL QUIT ARG")
+            return None
+        return status
+    return None
+
+
+_command_end = MUMPSCommandEnd()
+_quit = MUMPSReturn(None)
+_for_line = MUMPSForLine(_for_loop)
+
+
 ###################
 # INTRINSIC FUNCTIONS
 # Intrinsic functions are those functions in MUMPS which are prefixed
@@ -407,20 +602,7 @@ def intrinsic_ascii(expr, which=None):
 
 def _ascii(expr, which=None):
     """Private ASCII function to allow repeated processing (in a loop)."""
-    try:
-        which = int(which.as_number())
-    except AttributeError:
-        which = 1
-
-    try:
-        if which-1 >= 0:
-            char = ord(str(expr)[which-1])
-        else:
-            raise IndexError
-    except IndexError:
-        char = -1
-
-    return char
+    return mumpy.runtime.ascii(expr, which)
 
 
 def intrinsic_char(args):
@@ -433,10 +615,7 @@ def intrinsic_char(args):
 
 def _char(args):
     """Private data function to allow repeated processing (in a loop)."""
-    chars = []
-    for arg in args:
-        chars.append(chr(int(arg.as_number())))
-    return ''.join(chars)
+    return mumpy.runtime.char(*args)
 
 
 def intrinsic_data(ident, env):
@@ -452,13 +631,7 @@ def intrinsic_data(ident, env):
 
 def _data(ident, env):
     """Private data function to allow repeated processing (in a loop)."""
-    # Check if the value is defined anywhere in the environment
-    if not ident in env:
-        return 0
-
-    # If so, get it and query it for it's data
-    var = env.get(ident, get_var=True)
-    return var.data(ident)
+    return mumpy.runtime.data(env, ident)
 
 
 def intrinsic_extract(expr, low=None, high=None):
@@ -473,47 +646,7 @@ def intrinsic_extract(expr, low=None, high=None):
 
 def _extract(expr, low=None, high=None):
     """Private extract function to allow repeated processing (in a loop)."""
-    # Convert the low and high bounds to integers
-    try:
-        low = int(low.as_number())
-    except AttributeError:
-        low = 1
-
-    try:
-        high = int(high.as_number())
-    except AttributeError:
-        high = None
-
-    try:
-        s = str(expr)
-        slen = len(s)
-        if isinstance(low, int) and isinstance(high, int):
-            # Get the indices (noting that the low index is inclusive)
-            low -= 1
-
-            # The low index cannot be higher than the high index
-            # The low index cannot be below 0 either
-            if low > high or low < 0:
-                raise IndexError
-
-            # The length cannot exceed the string length
-            if high > slen:
-                high = slen
-
-            return MUMPSExpression(s[low:high])
-        elif isinstance(low, int):
-            # Get the index
-            idx = low-1
-
-            # The low index cannot be below 0
-            if idx < 0 or idx > slen:
-                raise IndexError
-
-            return MUMPSExpression(s[idx])
-        else:
-            return MUMPSExpression(s[0])
-    except IndexError:
-        return mumps_null()
+    return mumpy.runtime.extract(expr, low, high)
 
 
 def intrinsic_find(expr, search, start=None):
@@ -526,18 +659,20 @@ def intrinsic_find(expr, search, start=None):
 
 def _find(expr, search, start=None):
     """Private find function to allow repeated processing (in a loop)."""
-    try:
-        start = int(start.as_number())
-    except AttributeError:
-        start = None
+    return mumpy.runtime.find(expr, search, start)
+
+
+def intrinsic_get(ident, env, default=None):
+    """Return the value of the given variable if it has one, otherwise
+    return `default` (or null, if no default is given)."""
+    return MUMPSExpression(
+        lambda i=ident, e=env, d=default: _get(i, e, d)
+    )
 
-    try:
-        sub = str(search)
-        idx = str(expr).index(sub, start) + len(sub) + 1
-    except ValueError:
-        idx = mumpy.MUMPSExpression(0)
 
-    return idx
+def _get(ident, env, default=None):
+    """Private get function to allow repeated processing (in a loop)."""
+    return mumpy.runtime.get_defined(env, ident, default)
 
 
 def intrinsic_justify(expr, rspace, ndec=None):
@@ -552,64 +687,62 @@ def intrinsic_justify(expr, rspace, ndec=None):
 
 def _justify(expr, rspace, ndec=None):
     """Private justify function to allow repeated processing (in a loop)."""
-    try:
-        ndec = int(ndec.as_number())
-    except AttributeError:
-        ndec = None
-
-    if ndec is not None:
-        expr = round(expr.as_number(), ndec)
-        s = str(expr).split(".")
-        dig, dec = len(s[0]), len(s[1]) if len(s) > 1 else 0
-        expr = expr if dec >= ndec else str(expr).ljust(ndec + dig + 1, '0')
-
-    return str(expr).rjust(rspace)
+    return mumpy.runtime.justify(expr, rspace, ndec)
 
 
 def intrinsic_length(expr, char=None):
     """Compute the length of the input `expr` as a string or, if `char` is
     not None, count the number of occurrences of `char` in `expr`."""
-    if char is not None:
-        return MUMPSExpression(
-            lambda e=expr, c=char: str(e).count(str(c))
-        )
     return MUMPSExpression(
-        lambda e=expr: len(str(e))
+        lambda e=expr, c=char: mumpy.runtime.length(e, c)
+    )
+
+
+def intrinsic_name(ident):
+    """Return the name of the variable given by `ident`."""
+    return MUMPSExpression(
+        lambda i=ident: str(i)
     )
 
 
 def intrinsic_order(ident, env, rev=None):
     """Return the next subscript in the subscript level given by the input
     variable. If no more subscripts are defined, return null."""
-    try:
-        rev = rev.as_number()
-    except AttributeError:
-        rev = 1
+    return MUMPSExpression(
+        lambda i=ident, e=env, r=rev: _order(i, e, r)
+    )
+
+
+def _order(ident, env, rev=None):
+    """Private order function to allow repeated processing (in a loop)."""
+    return mumpy.runtime.order(env, ident, rev)
+
 
-    var = env.get(ident, get_var=True)
+def intrinsic_query(ident, env):
+    """Return the reference to the next node with a value after the input
+    variable, in the order of a depth-first walk of the variable. If there
+    is no such node, return null."""
     return MUMPSExpression(
-        lambda v=var, i=ident, r=rev: v.order(ident, rev=r)
+        lambda i=ident, e=env: _query(i, e)
     )
 
 
-def intrinsic_piece(expr, char, num=None):
-    """Give the `num`th piece of `expr` split about `char` (1 indexed)."""
+def _query(ident, env):
+    """Private query function to allow repeated processing (in a loop)."""
+    return mumpy.runtime.query(env, ident)
+
+
+def intrinsic_piece(expr, char, num=None, high=None):
+    """Give the `num`th piece of `expr` split about `char` (1 indexed), or
+    the pieces `num` through `high` if `high` is given."""
     return MUMPSExpression(
-        lambda e=expr, c=char, n=num: _piece(e, c, n)
+        lambda e=expr, c=char, n=num, h=high: _piece(e, c, n, h)
     )
 
 
-def _piece(expr, char, num=None):
+def _piece(expr, char, num=None, high=None):
     """Private piece function to allow repeated processing (in a loop)."""
-    try:
-        num = int(num.as_number())
-    except AttributeError:
-        num = 1
-
-    try:
-        return str(expr).split(sep=str(char), maxsplit=num)[num-1]
-    except (IndexError, ValueError):
-        return mumpy.mumps_null()
+    return mumpy.runtime.piece(expr, char, num, high)
 
 
 def intrinsic_random(num):
@@ -622,13 +755,14 @@ def intrinsic_random(num):
 
 def _random(num):
     """Private random function to allow repeated processing (in a loop)."""
-    num = int(num.as_number())
+    return mumpy.runtime.rand(num)
 
-    if num < 1:
-        raise mumpy.MUMPSSyntaxError("RANDOM argument less than 1.",
-                                     err_type="RANDARGNEG")
 
-    return random.randint(0, num)
+def intrinsic_reverse(expr):
+    """Return the characters of `expr` in reverse order."""
+    return MUMPSExpression(
+        lambda e=expr: str(e)[::-1]
+    )
 
 
 def intrinsic_select(args):
@@ -661,30 +795,7 @@ def intrinsic_translate(expr, trexpr, newexpr=None):
 
 def _translate(expr, trexpr, newexpr=None):
     """Private translate function to allow repeated processing (in a loop)."""
-    # We use the string and translation map for both paths
-    expr = str(expr)
-    trexpr = str(trexpr)
-    trmap = dict()
-
-    if newexpr is not None:
-        # Create a translation map between the two strings
-        # In this iteration, we map positionally identical characters
-        # between the input string and the replacement string
-        # Characters without matches are deleted (i.e. if the
-        # replacement string is shorter than the translation string)
-        newmap = str(newexpr)
-        for i, c in enumerate(trexpr):
-            try:
-                trmap[ord(c)] = ord(newmap[i])
-            except IndexError:
-                trmap[ord(c)] = None
-    else:
-        # Create a translation map which deletes each character
-        for c in trexpr:
-            trmap[ord(c)] = None
-
-    # Return the translated string
-    return expr.translate(trmap)
+    return mumpy.runtime.translate(expr, trexpr, newexpr)
 
 
 ###################
@@ -726,6 +837,13 @@ def current_job():
     return MUMPSExpression(os.getpid())
 
 
+def _column(offset, x):
+    """Return the spaces needed to advance the device from column `x` to
+    the column given by the `offset` expression (the `?N` format)."""
+    c = int(offset.as_number())
+    return " " * (c-x) if c > x else ""
+
+
 ###################
 # LANGUAGE COMPONENTS
 # Language components are various components of the language which can be
@@ -752,19 +870,33 @@ class MUMPSLine:
         )
 
     def execute(self):
-        """Execute the entire line of commands."""
-        for i, cmd in enumerate(self.list):
-            try:
-                cmd.execute()
-            except AttributeError:
-                # Empty lines will return a command of None
-                # Empty lines are generally comments - we ignore these
-                pass
-            except MUMPSForLine as f:
-                # For exceptions instruct us to transfer execution of the line
-                # to the FOR command and stop our own execution path
-                f.func(cmd.args, cmd.env, self.list[i+1:])
-                break
+        """Execute the entire line of commands, returning the control flow
+        signal returned by its commands (if any)."""
+        return _execute_line(self.list)
+
+
+def _execute_line(cmds):
+    """Execute the commands `cmds` of a line in order. Return the status of
+    the first command which returns a control flow signal, or None if every
+    command was executed. A FOR command takes over the commands after it."""
+    for i, cmd in enumerate(cmds):
+        try:
+            status = cmd.execute()
+        except AttributeError:
+            # Empty lines will return a command of None
+            # Empty lines are generally comments - we ignore these
+            continue
+        except MUMPSForLine as f:
+            # For exceptions instruct us to transfer execution of the line
+            # to the FOR command and stop our own execution path
+            f.func(cmd.args, cmd.env, cmds[i+1:])
+            return None
+
+        if status is not None and isinstance(status, MUMPSControlFlow):
+            if isinstance(status, MUMPSForLine):
+                return status.func(cmd.args, cmd.env, cmds[i+1:])
+            return status
+    return None
 
 
 class MUMPSCommand:
@@ -819,8 +951,10 @@ class MUMPSCommand:
 class MUMPSFuncSubCall:
     """Represents a function or subroutine call in a MUMPS routine."""
     def __init__(self, tag, env, parser, args=None,
-                 is_func=False, rou=None, post=True):
-        """Initialize a MUMPS Function or Subroutine call."""
+                 is_func=False, rou=None, post=True, site=None):
+        """Initialize a MUMPS Function or Subroutine call. Calls made from
+        the same place in a routine should share the MUMPSCallSite `site`,
+        which is created for the call if it is not given."""
         # The tag should be a valid MUMPS Identifier
         if not isinstance(tag, MUMPSIdentifier):
             raise MUMPSSyntaxError("Invalid Function or Subroutine name given.",
@@ -846,21 +980,35 @@ class MUMPSFuncSubCall:
         self.env = env
         self.parser = parser
         self.is_func = is_func
-        self.rou = self.env.get_routine(rou)
         self.post = post
 
-        # If we don't have a routine at this point, we're in an error state
-        if self.rou is None:
-            raise MUMPSSyntaxError("No routine found.", err_type="NO LINE")
+        # The routine is looked up by the call site when the call is made
+        if site is None:
+            site = MUMPSCallSite(tag, rou, is_func,
+                                 None if args is None else len(args))
+        self.site = site
+        self._rou = None
 
     def __repr__(self):
         return "MUMPSFuncSubCall({tag}, {args}, {as_func}, {rou})".format(
             tag=self.tag,
             args=self.args,
             as_func=self.is_func,
-            rou=self.rou,
+            rou=self.site.rou,
         )
 
+    @property
+    def rou(self):
+        """The routine containing the tag, which is looked up the first time
+        it is needed (by a GOTO or JOB command)."""
+        if self._rou is None:
+            self._rou = self.env.get_routine(self.site.rou)
+
+            # If we don't have a routine at this point, we're in an error state
+            if self._rou is None:
+                raise MUMPSSyntaxError("No routine found.", err_type="NO LINE")
+        return self._rou
+
     def execute(self):
         """Execute the subroutine or function call."""
         # Check for a post-conditional (for subroutines only)
@@ -868,20 +1016,57 @@ class MUMPSFuncSubCall:
             return None
 
         # Execute the function or subroutine
-        self.env.push_func_to_stack(self)
-        ret = mumpy.trampoline(self.parser._parse_tag, self.rou, self.tag)
-        self.env.pop_func_from_stack()
+        return mumpy.runtime.call(self.env, self.parser, self.site, self.args)
+
 
-        # Check for syntax errors
-        if self.is_func and isinstance(ret, type(None)):
-            raise MUMPSSyntaxError("Function call did not return value.",
-                                   err_type="FUNCTION NO RETURN")
-        if not self.is_func and not isinstance(ret, type(None)):
-            raise MUMPSSyntaxError("Subroutine call returned a value.",
-                                   err_type="SUBROUTINE RETURN")
+class MUMPSCallSite:
+    """Represents one place in a routine which calls a function or
+    subroutine. The tag's argument list is found and checked against the
+    arguments given at the site on the first call, and again only when a
+    call from the site reaches a different routine (as a call with no
+    routine name does when the code is run from several routines)."""
+    __slots__ = ('tag', 'rou', 'is_func', 'nargs', 'file', 'names', 'func',
+                 'line')
 
-        # Return our value
-        return ret
+    def __init__(self, tag, rou=None, is_func=False, nargs=None):
+        """Initialize a call site for calls of `tag^rou` with `nargs`
+        arguments, or None if the calls have no argument list."""
+        self.tag = tag
+        self.rou = rou
+        self.is_func = is_func
+        self.nargs = nargs
+
+        # The routine last called from this site, its argument list for
+        # the tag, its compiled function for the tag (if any) and the line
+        # the tag starts at. A routine which is recompiled is loaded as a
+        # new MUMPSFile, so these are looked up again for it.
+        self.file = None
+        self.names = None
+        self.func = None
+        self.line = None
+
+    def __repr__(self):
+        return "MUMPSCallSite({tag}, {rou}, {as_func}, {nargs})".format(
+            tag=self.tag,
+            rou=self.rou,
+            as_func=self.is_func,
+            nargs=self.nargs,
+        )
+
+    def resolve(self, env):
+        """Return the routine called from this site in the environment
+        `env`, looking up the tag in it if it was not the routine called
+        last."""
+        f = env.get_routine(self.rou)
+        if f is not self.file:
+            if f is None:
+                raise MUMPSSyntaxError("No routine found.", err_type="NO LINE")
+            args = None if self.nargs is None else range(self.nargs)
+            self.names = env.tag_args(f, self.tag, args)
+            self.func = f.tag_func(self.tag)
+            self.line = f.tag_line(self.tag)
+            self.file = f
+        return f
 
 
 class MUMPSExpression:
@@ -912,7 +1097,7 @@ class MUMPSExpression:
 
     def as_number(self):
         """Return the canonical MUMPS numeric form of this expression."""
-        return _mumps_number(str(self))
+        return _mumps_number(self._val())
 
     def is_ident(self):
         """Return True if this expression is also an Identifier."""
@@ -1041,7 +1226,8 @@ class MUMPSExpression:
         """Divide two MUMPS expressions."""
         return MUMPSExpression(
             lambda left=self, right=other: (
-                _mumps_number(left.as_number() / _other_as_number(right))
+                _mumps_number(_divide(left.as_number(),
+                                      _other_as_number(right)))
             )
         )
 
@@ -1050,18 +1236,19 @@ class MUMPSExpression:
 
         See here for truncation towards zero:
         http://stackoverflow.com/questions/19919387/in-python-what-is-a-good-way-to-round-towards-zero-in-integer-division"""
-        n = self.as_number()
-        d = _other_as_number(other)
-        v = n // d if n * d > 0 else (n + (-n % d)) // d
         return MUMPSExpression(
-            lambda num=v: _mumps_number(num)
+            lambda left=self, right=other: (
+                _mumps_number(_idivide(left.as_number(),
+                                       _other_as_number(right)))
+            )
         )
 
     def __mod__(self, other):
         """Return the modulus of two MUMPS expressions."""
         return MUMPSExpression(
             lambda left=self, right=other: (
-                _mumps_number(left.as_number() % _other_as_number(right))
+                _mumps_number(_modulo(left.as_number(),
+                                      _other_as_number(right)))
             )
         )
 
@@ -1069,7 +1256,8 @@ class MUMPSExpression:
         """Return the power of two MUMPS expressions."""
         return MUMPSExpression(
             lambda left=self, right=power: (
-                _mumps_number(left.as_number() ** _other_as_number(right))
+                _mumps_number(_power(left.as_number(),
+                                     _other_as_number(right)))
             )
         )
 
@@ -1089,7 +1277,7 @@ class MUMPSExpression:
         """Return the AND result of two MUMPS expressions."""
         return MUMPSExpression(
             lambda left=self, right=other: (
-                int(left.as_number() and _other_as_number(right))
+                int(bool(left.as_number()) and bool(_other_as_number(right)))
             )
         )
 
@@ -1097,7 +1285,7 @@ class MUMPSExpression:
         """Return the OR result of two MUMPS expressions."""
         return MUMPSExpression(
             lambda left=self, right=other: (
-                int(left.as_number() or _other_as_number(right))
+                int(bool(left.as_number()) or bool(_other_as_number(right)))
             )
         )
 
@@ -1117,22 +1305,23 @@ class MUMPSExpression:
 
     def sorts_after(self, other):
         """Return True if this MUMPS expression sorts after other in
-        collation (UTF-8) order."""
-        o = MUMPSExpression(other)
-        s = str(self)
-        l = sorted([s, str(o)])
+        the collation order of subscripts."""
+        key = mumpy.storage.subscript_key
         return MUMPSExpression(
-            lambda me=s: 1 if (me == l[1]) else 0
+            lambda left=self, right=other: (
+                1 if key(str(left)) > key(str(MUMPSExpression(right))) else 0
+            )
         )
 
     def follows(self, other):
         """Return True if this MUMPS expression follows other in
         binary order."""
-        o = MUMPSExpression(other)
-        b = bytes(str(self), encoding='utf8')
-        l = sorted([b, bytes(str(o), encoding='utf8')])
         return MUMPSExpression(
-            lambda me=b: 1 if (b == l[1]) else 0
+            lambda left=self, right=other: (
+                1 if (bytes(str(left), encoding='utf8') >
+                      bytes(str(MUMPSExpression(right)), encoding='utf8'))
+                else 0
+            )
         )
 
     def contains(self, other):
@@ -1158,18 +1347,44 @@ def mumps_false():
     return MUMPSExpression(0)
 
 
+# The characters which may begin a variable name (after any `^`)
+_name_start = frozenset(string.ascii_letters + "%")
+
+# Variable names which have already been validated, each mapped to its
+# interned string, and the most names which are kept
+_names = {}
+_max_names = 4096
+
+
 class MUMPSIdentifier:
-    """Represents a MUMPS identifier in code."""
+    """Represents a MUMPS identifier in code.
+
+    Identifiers are created for every variable reference each time it is
+    evaluated, so they hold only their slots. Names are interned (so that
+    comparing two names for the same variable is an identity check) and
+    are only validated the first time they are seen."""
+    __slots__ = ('_ident', '_subscripts', '_env', '_max', '_timeout')
+
     def __init__(self, ident, env, subscripts=None, max=None, timeout=None):
         # Handle the case that we may be passed another instance of
         # a MUMPSIdentifier object
         if isinstance(ident, MUMPSIdentifier):
-            self._ident = str(ident._ident)
+            self._ident = ident._ident
         else:
-            self._ident = str(ident)
+            name = _names.get(ident) if type(ident) is str else None
+            if name is None:
+                name = sys.intern(str(ident))
+                self._ident = name
+
+                # Check that we are a valid identifier
+                self.is_valid()
+                if len(_names) < _max_names:
+                    _names[name] = name
+            self._ident = name
 
         # Make sure we got valid subscripts
-        if not isinstance(subscripts, (type(None), MUMPSArgumentList)):
+        if not (subscripts is None or
+                isinstance(subscripts, MUMPSArgumentList)):
             raise MUMPSSyntaxError("Invalid subscript list given.",
                                    err_type="INVALID SUBSCRIPTS")
 
@@ -1178,9 +1393,6 @@ class MUMPSIdentifier:
         # Accept an environment so we can resolve our own value
         self._env = env
 
-        # Check that we are a valid identifier
-        self.is_valid()
-
         # Set the maximum number of bytes for this variable
         self._max = max
 
@@ -1210,12 +1422,15 @@ class MUMPSIdentifier:
 
     def get_max(self):
         """Return the number of bytes to read into this variable."""
+        if isinstance(self._max, MUMPSExpression):
+            return int(self._max.as_number())
         return self._max
 
     def set_max(self, m):
         """Sets the maximum number of bytes that will be read into this
-        variable."""
-        if not isinstance(m, (type(None), int)):
+        variable. The maximum may be given as an expression, which will be
+        evaluated each time the variable is read."""
+        if not isinstance(m, (type(None), int, MUMPSExpression)):
             raise MUMPSSyntaxError("Maximum read size for variable invalid.",
                                    err_type="INVALID READ SIZE")
 
@@ -1224,11 +1439,15 @@ class MUMPSIdentifier:
 
     def get_timeout(self):
         """Gets the maximum number of seconds to wait for input."""
+        if isinstance(self._timeout, MUMPSExpression):
+            return int(self._timeout.as_number())
         return self._timeout
 
     def set_timeout(self, t):
-        """Sets the maximum number of seconds to wait for input."""
-        if not isinstance(t, (type(None), int)):
+        """Sets the maximum number of seconds to wait for input. The timeout
+        may be given as an expression, which will be evaluated each time
+        the variable is read."""
+        if not isinstance(t, (type(None), int, MUMPSExpression)):
             raise MUMPSSyntaxError("Maximum read size for variable invalid.",
                                    err_type="INVALID READ SIZE")
 
@@ -1244,12 +1463,16 @@ class MUMPSIdentifier:
         """Return the subscripts associated with this Identifier."""
         return self._subscripts
 
+    def is_global(self):
+        """Return True if this Identifier names a global variable."""
+        return self._ident.startswith("^")
+
     def is_valid(self):
         """Returns True if this is a valid MUMPS identifier."""
-        c = self._ident[0]
+        c = self._ident[1 if self.is_global() else 0]
         if c.isdigit():
             raise MUMPSSyntaxError("Variable names cannot start with digits.")
-        if not c in "{}{}".format(string.ascii_letters, "%"):
+        if c not in _name_start:
             raise MUMPSSyntaxError("Variable names must be valid "
                                    "ASCII letters or the '%' character.")
 
@@ -1263,18 +1486,55 @@ class MUMPSIdentifier:
 class MUMPSPointerIdentifier(MUMPSIdentifier):
     """Represents a normal MUMPS identifier which will be used as a pointer
     when passed into a function or subroutine."""
+    __slots__ = ()
+
     def __init__(self, ident, env):
         super().__init__(ident, env)
 
 
+class MUMPSSetTarget:
+    """Represents the left side of a SET command which replaces part of the
+    value of a variable, such as `$PIECE(x,"^",2)`."""
+    def __init__(self, func, ident, env, args=()):
+        """Initialize a target which is set by calling the runtime function
+        `func` with the environment, the identifier `ident` of the variable,
+        the value and the arguments `args`."""
+        self.func = func
+        self.ident = ident
+        self.env = env
+        self.args = args
+
+    def __repr__(self):
+        return "MUMPSSetTarget({func}, {ident}, {args})".format(
+            func=self.func.__name__,
+            ident=self.ident,
+            args=self.args,
+        )
+
+    def set(self, value):
+        """Set the part of the variable given by this target to `value`."""
+        self.func(self.env, self.ident, value, *self.args)
+
+
 class MUMPSArgumentList:
-    """Holds a list of MUMPS arguments for a command to process."""
+    """Holds a list of MUMPS arguments for a command to process. The
+    arguments are kept in a tuple; adding an argument to a list gives a
+    new list."""
+    __slots__ = ('list',)
+
     def __init__(self, item, others=None):
         if isinstance(others, MUMPSArgumentList):
-            self.list = others.list
-            self.list.append(item)
+            self.list = others.list + (item,)
         else:
-            self.list = [item]
+            self.list = (item,)
+
+    @classmethod
+    def from_items(cls, items):
+        """Return an argument list holding each of the given items, without
+        adding them one at a time."""
+        args = cls.__new__(cls)
+        args.list = tuple(items)
+        return args
 
     def __repr__(self):
         """A string representation of the argument list."""
@@ -1297,11 +1557,70 @@ class MUMPSArgumentList:
 
     def reverse(self):
         """Return the reverse of the argument list."""
-        self.list.reverse()
+        self.list = self.list[::-1]
         return self
 
 
-class MUMPSLocal:
+class MUMPSLocalVariable:
+    """The interface shared by every kind of local variable. Identifiers
+    passed to these methods may also be a variable name without subscripts,
+    which names the root node."""
+    def get(self, ident):
+        """Return the value of the node at the given identifier, or null if
+        the node has no value."""
+        raise NotImplementedError
+
+    def set(self, ident, value):
+        """Set the value of the node at the given identifier."""
+        raise NotImplementedError
+
+    def delete(self, ident):
+        """Delete the node at the given identifier and its descendants."""
+        raise NotImplementedError
+
+    def data(self, ident):
+        """Return the `$DATA` value of the node at the given identifier."""
+        raise NotImplementedError
+
+    def order(self, ident, rev=0):
+        """Return the next subscript after the last subscript of the given
+        identifier, or the previous subscript if `rev` is -1."""
+        raise NotImplementedError
+
+    def order_iter(self, ident, rev=1):
+        """Generate each subscript following the last subscript of the given
+        identifier at its level (or preceding it, if `rev` is -1)."""
+        raise NotImplementedError
+
+    def query(self, ident):
+        """Return the tuple of subscripts of the first node after the given
+        identifier with a value, in the order of a depth-first walk of the
+        variable, or None if there is no such node."""
+        raise NotImplementedError
+
+    def nodes(self, ident):
+        """Generate the subscripts (relative to the given identifier) and
+        value of the node at the given identifier and of each descendant
+        which has a value."""
+        raise NotImplementedError
+
+    def merge(self, ident, src, src_ident):
+        """Copy the value and descendants of `src_ident` in the variable `src`
+        (a local or global variable) beneath the given identifier."""
+        raise NotImplementedError
+
+    def pprint_str(self, name):
+        """Return a pretty-print style string which can be output when
+        the user issues an argumentless `WRITE` command (spill symbols),
+        with a line for each node which has a value."""
+        return "\n".join(
+            "{ref}={val}".format(ref=mumpy.storage.node_reference(name, subs),
+                                 val=str(value))
+            for subs, value in self.nodes(name)
+        )
+
+
+class MUMPSLocal(MUMPSLocalVariable):
     """Wrap a SortedDict to provide MUMPS local variable functionality."""
     def __init__(self, value=None):
         self._b = SortedDict()
@@ -1309,6 +1628,15 @@ class MUMPSLocal:
         if value is not None:
             self._b[""] = value
 
+        # The `$ORDER` cursor at each subscript depth, as a tuple of the
+        # leading subscripts, their SortedDict, and the index and value of
+        # the last subscript returned by `$ORDER` there
+        self._cursors = {}
+
+        # The `$QUERY` cursor, as a tuple of the subscripts of the last node
+        # returned by `$QUERY` and the SortedDicts on the path to it
+        self._query = None
+
     def __repr__(self):
         return "MUMPSLocal({root}, {n})".format(
             root=self._b[""],
@@ -1382,6 +1710,9 @@ class MUMPSLocal:
                 raise MUMPSSyntaxError("Variable with no subscripts given.",
                                        err_type="INVALID SUBSCRIPTS")
 
+            # The deleted node may hold a level a cursor is on
+            self._cursors.clear()
+            self._query = None
             self._delete(self._b, s)
         except AttributeError:
             raise MUMPSSyntaxError("Invalid identifier given for this var.",
@@ -1401,10 +1732,13 @@ class MUMPSLocal:
 
             return
 
-        # If there are more subscripts, recurse
+        # If there are more subscripts, recurse, removing the node if it
+        # has neither a value nor any children left
         try:
             s = str(subscripts[0])
             self._delete(d[s], subscripts[1:])
+            if len(d[s]) == 0:
+                del d[s]
         except KeyError:
             pass
 
@@ -1439,7 +1773,14 @@ class MUMPSLocal:
     def order(self, ident, rev=0):
         """Return an iterator for the given identifier. If the identifier
         has no subscripts, then raise a syntax error. If `rev` is -1, then
-        iterate on subscripts in reverse order."""
+        iterate on subscripts in reverse order.
+
+        The level and index of the subscript returned are kept as the
+        cursor for the depth of the identifier, so a loop stepping through
+        a level does not look up the leading subscripts or bisect the
+        level again. Subscripts added to the level move the cursor's
+        subscript, so the cursor is only used if its subscript is still at
+        its index; deleting any node discards every cursor."""
         try:
             s = ident.subscripts() if not isinstance(ident, str) else None
 
@@ -1448,132 +1789,333 @@ class MUMPSLocal:
                 raise MUMPSSyntaxError("Cannot $ORDER over a scalar value.",
                                        err_type="INVALID $ORDER PARAM")
 
-            # Otherwise, set the value at the requested subscripts
-            b = self._b
-            if rev >= 0:
-                ss = str(s[0])
-                for sub in s[:-1]:
-                    ss = str(sub)
-                    try:
-                        b = b[ss]
-                    except KeyError:
-                        pass
-
-                return b.next_key(ss)
+            # Loops call `$ORDER` again with the subscript it just returned,
+            # so continue from the cursor at this depth if that subscript is
+            # still at the index it was returned from
+            n = len(s)
+            ss = str(s[n-1])
+            path = tuple(map(str, s[:n-1])) if n > 1 else ()
+            cursor = self._cursors.get(n)
+            if (cursor is not None and cursor[3] == ss and
+                    cursor[0] == path and cursor[1].key_at(cursor[2]) == ss):
+                b = cursor[1]
+                i = cursor[2] + (1 if rev >= 0 else -1)
             else:
-                ss = str(s[len(s)-1])
-                for sub in s[1:]:
-                    ss = str(sub)
-                    try:
-                        b = b[ss]
-                    except KeyError:
-                        pass
-
-                return b.prev_key(ss)
+                # Otherwise, find the next key at the level of the last
+                # subscript
+                b = self._level(s)
+                if b is None:
+                    return mumps_null()
+                i = b.key_index(ss, rev=rev < 0)
+
+            k = b.key_at(i)
+            if k == "":
+                self._cursors.pop(n, None)
+            else:
+                self._cursors[n] = (path, b, i, k)
+            return k
         except AttributeError:
             raise MUMPSSyntaxError("Invalid identifier given for this var.",
                                    "INVALID IDENTIFIER")
 
-    def pprint_str(self, name):
-        """Return a pretty-print style string which can be output when
-        the user issues an argumentless `WRITE` command (spill symbols)."""
-        return self._pprint_str(name)
-
-    def _pprint_str(self, name, sub=None, depth=0):
-        """Recursive pretty-print function for this MUMPSLocal value."""
-        # Set up the output string and which sub node to iterate on
-        if sub is None:
-            out = "{name}={val}".format(name=name, val=str(self))
-            sub = self._b
-            name = "{name}(".format(name=name)
+    def order_iter(self, ident, rev=1):
+        """Generate each subscript following the last subscript of the given
+        identifier at its level (or preceding it, if `rev` is -1), as
+        repeated `$ORDER` calls would return them. A null last subscript
+        starts from the first (or last) subscript."""
+        s = ident.subscripts() if not isinstance(ident, str) else None
+        if s is None:
+            raise MUMPSSyntaxError("Cannot $ORDER over a scalar value.",
+                                   err_type="INVALID $ORDER PARAM")
+
+        b = self._level(s)
+        if b is None:
+            return iter(())
+        return b.keys_after(str(s[len(s)-1]), rev=rev < 0)
+
+    def query(self, ident):
+        """Return the tuple of subscripts of the first node after the given
+        identifier with a value, in the order of a depth-first walk of the
+        variable (descendants first, then later siblings and those of each
+        ancestor), or None if there is no such node.
+
+        The walk keeps an explicit stack of the SortedDicts on the path to
+        the current node and bisects each level once to find the next
+        subscript, so it takes O(depth * log n) time. The stack of the node
+        returned is kept, so a walk which passes each node back to `$QUERY`
+        does not look up its subscripts again."""
+        s = ident.subscripts() if not isinstance(ident, str) else None
+        subs = () if s is None else tuple(map(str, s))
+        if subs and subs[-1] == "":
+            subs = subs[:len(subs)-1]
+
+        # `levels[i]` is the SortedDict of the node at depth `i` on the path
+        # and `path[i]` is the subscript of the node at depth `i + 1`
+        if self._query is not None and self._query[0] == subs:
+            path, levels = list(subs), list(self._query[1])
+            k = ""
         else:
-            out = "{name})={val}".format(name=name, val=str(sub[""]))
+            path, levels = [], [self._b]
+            for sub in subs:
+                path.append(sub)
+                try:
+                    levels.append(levels[-1][sub])
+                except KeyError:
+                    break
+
+            # Start from the first child of the node if it exists, or from
+            # the subscript after it in the deepest level which does
+            k = "" if len(levels) > len(path) else path.pop()
 
-        # Iterate on each key in the node
-        for k in sub:
+        while True:
+            b = levels[-1]
+            k = b.next_key(k)
             if k == "":
+                # This level is done, so continue after it in its parent
+                if not path:
+                    self._query = None
+                    return None
+                levels.pop()
+                k = path.pop()
                 continue
-            out = "{base}\n{next}".format(base=out,
-                                          next=self._pprint_str(
-                                              '{name}{sep}"{k}"'.format(
-                                                  name=name,
-                                                  sep="," if depth > 0 else "",
-                                                  k=k),
-                                              sub=sub[k],
-                                              depth=depth+1
-                                          )
-            )
-        return out
+
+            path.append(k)
+            levels.append(b[k])
+            if "" in levels[-1]:
+                subs = tuple(path)
+                self._query = (subs, levels)
+                return subs
+            k = ""
+
+    def _level(self, subscripts):
+        """Return the SortedDict holding the keys at the level of the last of
+        the given subscripts, or None if there is no such level."""
+        b = self._b
+        for sub in subscripts[:len(subscripts)-1]:
+            try:
+                b = b[str(sub)]
+            except KeyError:
+                return None
+        return b
+
+    def nodes(self, ident):
+        """Generate the subscripts (relative to the given identifier) and
+        value of the node at the given identifier and of each descendant."""
+        b = self._node(ident)
+        return () if b is None else self._nodes(b, ())
+
+    def _nodes(self, b, subs):
+        """Recursive helper function for generating nodes."""
+        for k, v in b.items():
+            if k == "":
+                yield subs, v
+            else:
+                yield from self._nodes(v, subs + (k,))
+
+    def merge(self, ident, src, src_ident):
+        """Copy the value and descendants of `src_ident` in the variable `src`
+        (a local or global variable) beneath the given identifier. Nodes of
+        another local are copied a whole SortedDict at a time."""
+        if type(src) is MUMPSLocal:
+            node = src._node(src_ident)
+            if node is not None:
+                self._merge(self._node(ident, create=True), node)
+            return
+
+        b = self._node(ident, create=True)
+        for subs, value in src.nodes(src_ident):
+            node = b
+            for ss in subs:
+                try:
+                    node = node[ss]
+                except KeyError:
+                    node[ss] = SortedDict()
+                    node = node[ss]
+            node[""] = value
+
+    def _merge(self, b, src):
+        """Recursive merge helper function. Subtrees which do not exist in
+        `b` are copied whole rather than merged node by node."""
+        for k, v in src.items():
+            if k == "":
+                b[""] = v
+            elif k in b:
+                self._merge(b[k], v)
+            else:
+                b[k] = self._copy(v)
+
+    def _copy(self, b):
+        """Return a copy of the subtree `b`, built one level at a time."""
+        return SortedDict((k, v if k == "" else self._copy(v))
+                          for k, v in b.items())
+
+    def _node(self, ident, create=False):
+        """Return the SortedDict holding the node at the given identifier,
+        creating it (and its ancestors) if `create` is True, or None if it
+        does not exist."""
+        s = ident.subscripts() if not isinstance(ident, str) else None
+        b = self._b
+        for sub in () if s is None else s:
+            ss = str(sub)
+            try:
+                b = b[ss]
+            except KeyError:
+                if not create:
+                    return None
+                b[ss] = SortedDict()
+                b = b[ss]
+        return b
+
+
+class MUMPSFlatLocal(MUMPSLocalVariable):
+    """A local variable whose nodes are all kept in one MUMPSNodeMap, keyed
+    by the encoding of their full subscripts, rather than in a SortedDict
+    for each node. Flat locals have the same interface as MUMPSLocal but
+    use much less memory for arrays with many nodes and few children per
+    node, at the cost of looking up every node from the top of the map."""
+    def __init__(self, value=None):
+        self._map = mumpy.MUMPSNodeMap()
+        if value is not None:
+            self._map.set_node("", (), value)
+
+    def __repr__(self):
+        return "MUMPSFlatLocal({root}, {n})".format(
+            root=self._map.get_node(""),
+            n=len(self._map),
+        )
+
+    def __str__(self):
+        """Return the value of the root node."""
+        v = self._map.get_node("")
+        return "" if v is None else str(v)
+
+    def get(self, ident):
+        """Return the value given by the input identifier, or null if the
+        node has no value."""
+        v = self._map.get_node("", mumpy.storage.ident_subscripts(ident))
+        return mumps_null() if v is None else v
+
+    def set(self, ident, value):
+        """Set the value at the given identifier."""
+        self._map.set_node("", mumpy.storage.ident_subscripts(ident), value)
+
+    def delete(self, ident):
+        """Delete the node at the given identifier and its descendants. The
+        environment deletes the whole variable, so there must be at least
+        one subscript."""
+        s = mumpy.storage.ident_subscripts(ident)
+        if len(s) < 1:
+            raise MUMPSSyntaxError("Variable with no subscripts given.",
+                                   err_type="INVALID SUBSCRIPTS")
+        self._map.kill_node("", s)
+
+    def data(self, ident):
+        """Return the `$DATA` value of the node at the given identifier."""
+        return MUMPSExpression(
+            self._map.data("", mumpy.storage.ident_subscripts(ident))
+        )
+
+    def order(self, ident, rev=0):
+        """Return the next subscript after the last subscript of the given
+        identifier, or the previous subscript if `rev` is -1."""
+        s = mumpy.storage.ident_subscripts(ident, last_null=True)
+        if not s:
+            raise MUMPSSyntaxError("Cannot $ORDER over a scalar value.",
+                                   err_type="INVALID $ORDER PARAM")
+        return self._map.order("", s, rev=rev)
+
+    def order_iter(self, ident, rev=1):
+        """Generate each subscript following the last subscript of the given
+        identifier at its level (or preceding it, if `rev` is -1)."""
+        s = mumpy.storage.ident_subscripts(ident, last_null=True)
+        if not s:
+            raise MUMPSSyntaxError("Cannot $ORDER over a scalar value.",
+                                   err_type="INVALID $ORDER PARAM")
+        return self._map.order_iter("", s, rev=rev)
+
+    def query(self, ident):
+        """Return the tuple of subscripts of the first node after the given
+        identifier with a value, in the order of a depth-first walk of the
+        variable, or None if there is no such node."""
+        s = mumpy.storage.ident_subscripts(ident, last_null=True)
+        if s and s[-1] == "":
+            s.pop()
+        return self._map.query("", s)
+
+    def nodes(self, ident):
+        """Generate the subscripts (relative to the given identifier) and
+        value of the node at the given identifier and of each descendant."""
+        return self._map.nodes("", mumpy.storage.ident_subscripts(ident))
+
+    def merge(self, ident, src, src_ident):
+        """Copy the value and descendants of `src_ident` in the variable `src`
+        (a local or global variable) beneath the given identifier."""
+        self._map.set_nodes("", mumpy.storage.ident_subscripts(ident),
+                            list(src.nodes(src_ident)))
 
 
 class SortedDict(blist.sorteddict):
     """Sub-class the blist Sorted Dictionary to provide a next-key
     functionality. Standard blist.sorteddict doesn't let you get the next
-    key in lexicographical order - it just throws a KeyError."""
+    key in lexicographical order - it just throws a KeyError.
+
+    Keys are subscript strings, sorted in MUMPS collation order (canonical
+    numbers first, in numeric order, then other strings) by their collation
+    keys from `mumpy.storage.subscript_key`, which are computed once when a
+    key is added and compared as byte strings.
+
+    The null key holds the so-called "root node" value of a subtree. It
+    sorts before every other key, but it is never returned as a next or
+    previous key; the null key is returned when there is no such key.
+
+    Keys are found by bisecting the sorted keys, so finding the next or
+    previous key takes O(log n) time whether or not `key` is present."""
     def __init__(self, *args, **kwargs):
-        super(SortedDict, self).__init__(*args, **kwargs)
+        super(SortedDict, self).__init__(mumpy.storage.subscript_key,
+                                         *args, **kwargs)
         self._keys = self.keys()
 
     def next_key(self, key):
         """Return the next key in sorted order."""
-        try:
-            # We need to handle the null key differently, since that
-            # actually holds our so-called "root node" value, which doesn't
-            # sort in the rest of the tree in MUMPS
-            if key == "" and "" in self._keys:
-                i = 1
-            else:
-                i = self._keys.index(key) + 1
-
-            # Get the next key sequentially
-            k = self._keys[i]
-            return k
-        except ValueError:
-            # If we don't have an existing key, we unfortunately have to
-            # iterate through the entire key list to find the next
-            # key lexicographically
-            for k in self._keys:
-                if k < key:
-                    continue
-                elif k > key:
-                    return k
-
-            # If we don't find another one, then return the null key
-            return ""
-        except IndexError:
-            return ""
+        return self.key_at(self.key_index(key))
 
     def prev_key(self, key):
         """Return the previous key in sorted order."""
-        try:
-            # The null key matters less in the previous key case, since it
-            # will not sort "first"
+        return self.key_at(self.key_index(key, rev=True))
+
+    def key_index(self, key, rev=False):
+        """Return the index of the key after `key` in sorted order (or
+        before it, if `rev` is True), starting from the first (or last) key
+        if `key` is null. The index may be out of range if there is no such
+        key."""
+        if rev:
             if key == "":
-                i = len(self)
-            else:
-                i = self._keys.index(key)
-
-            # Do not return the null key for the reverse iteration
-            if (i == 1 and "" in self._keys) or (i == 0):
-                return ""
-
-            # Get the next key sequentially
-            k = self._keys[i-1]
-            return k
-        except ValueError:
-            # If we don't have an existing key, we unfortunately have to
-            # iterate through the entire key list to find the next
-            # key lexicographically
-            for k in reversed(self._keys):
-                if k > key:
-                    continue
-                elif k < key:
-                    return k
-
-            # If we don't find another one, then return the null key
-            return ""
-        except IndexError:
-            return ""
+                return len(self._keys) - 1
+            return self._keys.bisect_left(key) - 1
+        return self._keys.bisect_right(key)
+
+    def key_at(self, i):
+        """Return the key at index `i` in sorted order, or null if `i` is
+        out of range."""
+        return self._keys[i] if 0 <= i < len(self._keys) else ""
+
+    def keys_after(self, key, rev=False):
+        """Generate the keys after `key` in sorted order (or before it in
+        reverse order, if `rev` is True), starting from the first (or last)
+        key if `key` is null.
+
+        Only the first key is found by bisecting; the rest are read in turn
+        from a slice of the sorted keys, so each step takes amortized O(1)
+        time. The slice is taken when iteration starts, so keys added or
+        deleted during iteration do not affect it."""
+        if rev:
+            i = len(self._keys) if key == "" else self._keys.bisect_left(key)
+            for k in reversed(self._keys[:i]):
+                if k == "":
+                    return
+                yield k
+        else:
+            yield from self._keys[self._keys.bisect_right(key):]
 
 
 class MUMPSSyntaxError(Exception):
@@ -1589,7 +2131,8 @@ class MUMPSSyntaxError(Exception):
             self.line = line
             #TODO.md: Remove this print_exc call
             try:
-                traceback.print_exc()
+                if sys.exc_info()[0] is not None:
+                    traceback.print_exc()
             except:
                 pass
 
@@ -1604,59 +2147,408 @@ class MUMPSSyntaxError(Exception):
         return str(self)
 
 
+###################
+# NUMBERS
+# MUMPS numbers are decimal. Numbers are held as Python ints and, by
+# default, floats; in exact arithmetic mode non-integers are instead held
+# as scaled integers, which are exact to 18 significant digits.
+###################
+# Whether non-integers are held exactly as MUMPSDecimals, rather than floats
+_exact = False
+
+# The number of significant digits kept by exact arithmetic
+_precision = 18
+_limit = 10 ** _precision
+
+
+def set_exact_arithmetic(exact=True):
+    """Hold non-integer numbers as exact MUMPSDecimals if `exact` is True,
+    or as floats otherwise. Numbers which have already been computed are
+    not converted, so this should be set before any routine is run."""
+    global _exact
+    _exact = bool(exact)
+    _to_mumps_number.cache_clear()
+
+
+class MUMPSDecimal:
+    """A non-integer MUMPS number held exactly as the integer coefficient
+    `c` scaled by `10**-s`.
+
+    Decimals support the Python numeric operators with ints and other
+    decimals, so they may be used wherever a float would be. Every result
+    is normalized: a whole result is returned as an int (so that integer
+    arithmetic never pays for the scaling) and other results have no
+    trailing zeros in their coefficient and are rounded half away from
+    zero to 18 significant digits."""
+    __slots__ = ('_c', '_s')
+
+    def __init__(self, c, s):
+        self._c = c
+        self._s = s
+
+    def _pair(self, other):
+        """Return the coefficients of this decimal and the number `other`
+        at their common scale, followed by that scale, or None if `other`
+        is not a number."""
+        t = type(other)
+        if t is int:
+            c2, s2 = other, 0
+        elif t is MUMPSDecimal:
+            c2, s2 = other._c, other._s
+        elif t is float:
+            if not math.isfinite(other):
+                return None
+            return self._pair(_float_decimal(other))
+        else:
+            return None
+
+        c1, s1 = self._c, self._s
+        if s1 == s2:
+            return c1, c2, s1
+        elif s1 > s2:
+            return c1, c2 * 10 ** (s1 - s2), s1
+        return c1 * 10 ** (s2 - s1), c2, s2
+
+    def _float_op(self, name, other):
+        """Return the result of the operator method `name` for this decimal
+        as a float and `other`, if it is an infinite or NaN float (which no
+        decimal can hold), or NotImplemented if it is not a number."""
+        if type(other) is float:
+            return getattr(float(self), name)(other)
+        return NotImplemented
+
+    def __add__(self, other):
+        if type(other) is int:
+            return _decimal(self._c + other * 10 ** self._s, self._s)
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__add__", other)
+        return _decimal(p[0] + p[1], p[2])
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if type(other) is int:
+            return _decimal(self._c - other * 10 ** self._s, self._s)
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__sub__", other)
+        return _decimal(p[0] - p[1], p[2])
+
+    def __rsub__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__rsub__", other)
+        return _decimal(p[1] - p[0], p[2])
+
+    def __mul__(self, other):
+        t = type(other)
+        if t is int:
+            return _decimal(self._c * other, self._s)
+        elif t is MUMPSDecimal:
+            return _decimal(self._c * other._c, self._s + other._s)
+        elif t is float:
+            if not math.isfinite(other):
+                return self._float_op("__mul__", other)
+            return self * _float_decimal(other)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__truediv__", other)
+        return _quotient(p[0], p[1])
+
+    def __rtruediv__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__rtruediv__", other)
+        return _quotient(p[1], p[0])
+
+    def __floordiv__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__floordiv__", other)
+        return p[0] // p[1]
+
+    def __rfloordiv__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__rfloordiv__", other)
+        return p[1] // p[0]
+
+    def __mod__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__mod__", other)
+        return _decimal(p[0] % p[1], p[2])
+
+    def __rmod__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__rmod__", other)
+        return _decimal(p[1] % p[0], p[2])
+
+    def __pow__(self, other):
+        if type(other) is int:
+            if other >= 0:
+                return _decimal(self._c ** other, self._s * other)
+            return _quotient(10 ** (self._s * -other), self._c ** -other)
+        return _float_power(float(self), other)
+
+    def __rpow__(self, other):
+        return _float_power(other, float(self))
+
+    def __neg__(self):
+        return MUMPSDecimal(-self._c, self._s)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return MUMPSDecimal(abs(self._c), self._s)
+
+    def __round__(self, ndigits=None):
+        """Round this decimal half away from zero to `ndigits` decimal
+        places."""
+        n = 0 if ndigits is None else ndigits
+        if n >= self._s:
+            return self
+        q, r = divmod(abs(self._c), 10 ** (self._s - n))
+        if 2 * r >= 10 ** (self._s - n):
+            q += 1
+        return _decimal(-q if self._c < 0 else q, n)
+
+    def __eq__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__eq__", other)
+        return p[0] == p[1]
+
+    def __lt__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__lt__", other)
+        return p[0] < p[1]
+
+    def __le__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__le__", other)
+        return p[0] <= p[1]
+
+    def __gt__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__gt__", other)
+        return p[0] > p[1]
+
+    def __ge__(self, other):
+        p = self._pair(other)
+        if p is None:
+            return self._float_op("__ge__", other)
+        return p[0] >= p[1]
+
+    def __hash__(self):
+        return hash((self._c, self._s))
+
+    def __bool__(self):
+        return self._c != 0
+
+    def __int__(self):
+        """Return this decimal truncated towards zero."""
+        q = abs(self._c) // 10 ** self._s
+        return -q if self._c < 0 else q
+
+    def __float__(self):
+        return self._c / 10 ** self._s
+
+    def __str__(self):
+        """Return the canonical form of this decimal, which is written the
+        same way as a float with the same value."""
+        digits = str(abs(self._c)).rjust(self._s + 1, "0")
+        return "{sign}{whole}.{frac}".format(
+            sign="-" if self._c < 0 else "",
+            whole=digits[:-self._s],
+            frac=digits[-self._s:],
+        )
+
+    def __repr__(self):
+        """Return this decimal as a Python number literal, so syntax trees
+        holding decimals can be recreated from their representation."""
+        return str(self)
+
+
+def _decimal(c, s):
+    """Return the number `c*10**-s` for the integer `c` and scale `s`,
+    normalized as described for MUMPSDecimal."""
+    if s > 0:
+        a = -c if c < 0 else c
+        if a >= _limit:
+            # Round away the digits past the precision, although never
+            # any of the integer digits
+            drop = min(len(str(a)) - _precision, s)
+            q, r = divmod(a, 10 ** drop)
+            if 2 * r >= 10 ** drop:
+                q += 1
+            c = -q if c < 0 else q
+            s -= drop
+
+        while s and c % 10 == 0:
+            c //= 10
+            s -= 1
+    if s <= 0:
+        return c * 10 ** -s
+    return MUMPSDecimal(c, s)
+
+
+def _quotient(n, d):
+    """Return the exact quotient `n/d` of the integers `n` and `d`."""
+    neg = (n < 0) != (d < 0)
+    n, d = abs(n), abs(d)
+    q, r = divmod(n, d)
+    if not r:
+        return -q if neg else q
+
+    # Scale the dividend so the quotient has more digits than are kept,
+    # then append a digit for any remainder so that it is rounded
+    # correctly by _decimal
+    s = max(_precision + 1 - len(str(n)) + len(str(d)), 1)
+    q, r = divmod(n * 10 ** s, d)
+    q = q * 10 + (1 if r else 0)
+    return _decimal(-q if neg else q, s + 1)
+
+
+def _exact_number(digits, exp):
+    """Return the exact number given by the unsigned decimal `digits` and
+    the exponent `exp` (or None if there is none). Numbers beyond the range
+    of a float overflow to infinity or are 0, as they are when read as
+    floats."""
+    whole, _, frac = digits.partition(".")
+    c = (whole + frac).lstrip("0")
+    if not c:
+        return 0
+    s = len(frac) - (0 if exp is None else int(exp))
+
+    # Check the exponent of the leading digit before scaling by it
+    e = len(c) - s - 1
+    if e > sys.float_info.max_10_exp:
+        return math.inf
+    elif e < sys.float_info.min_10_exp:
+        return 0
+
+    # Keep one digit past the precision to round with, and replace any
+    # after it with a digit which is only 0 if they all are
+    drop = min(len(c) - _precision - 1, s)
+    if drop > 1:
+        c, rest = c[:-drop], c[-drop:]
+        c += "0" if rest.strip("0") == "" else "1"
+        s -= drop - 1
+    return _decimal(int(c), s)
+
+
+def _float_decimal(f):
+    """Return the exact number which is written the same as the float
+    `f`. Infinities and NaNs are returned as they are."""
+    if not math.isfinite(f):
+        return f
+    signs, digits, exp = _number_prefix.match(repr(f)).groups()
+    n = _exact_number(digits, exp)
+    return -n if signs else n
+
+
+def _float_power(n, e):
+    """Return `n**e` for the exponent `e` which is not an integer, which
+    is only computed to the precision of a float."""
+    r = float(n) ** float(e)
+    return r if type(r) is complex else _float_decimal(r)
+
+
+# The numeric prefix of a string: any signs, then digits with at most one
+# decimal point, and an optional exponent
+_number_prefix = re.compile(
+    r'([+-]*)([0-9]*(?:\.[0-9]*)?)(?:[Ee]([+-]?[0-9]+))?'
+)
+
+
 def _mumps_number(v):
     """Given a number (perhaps evaluated by expression), return the
-    integral value if it is an integer, or a float otherwise."""
-    try:
+    integral value if it is an integer, or a float (or MUMPSDecimal in
+    exact arithmetic mode) otherwise. Numbers are returned without being
+    converted to strings."""
+    t = type(v)
+    if t is int:
+        return v
+    elif t is float:
+        if v.is_integer():
+            return int(v)
+        return _float_decimal(v) if _exact else v
+    elif t is str:
         return _to_mumps_number(v)
-    except ValueError:
-        return 0
+    elif t is MUMPSDecimal:
+        return v
+    return _to_mumps_number(str(v))
 
 
+@functools.lru_cache(maxsize=4096)
 def _to_mumps_number(v):
-    """Given a value, attempt to coerce it to either an integer or float."""
-    sign = 1
-    ndec = 0
-    try:
-        tmp = float(v)
-
-        if tmp.is_integer():
-            return int(tmp)
-        else:
-            return tmp
-    except ValueError:
-        v = str(v)
-        n = []
-
-        # Build a number based on the MUMPS numeric conversion rules
-        for c in v:
-            # Look for numeric characters (digits, decimal, or sign)
-            if c.isnumeric() or c in ('.', '+', '-'):
-                # Make sure we only add one decimal
-                if c == '.':
-                    if ndec >= 1:
-                        break
-                    else:
-                        ndec += 1
-
-                # Correctly swap the sign
-                if c == '-':
-                    sign *= -1
-                    continue
-
-                # Ignore the plus signs
-                if c == '+':
-                    continue
-
-                # If we made it this far, this is a valid numeric character
-                n.append(c)
-            else:
-                # If we don't find any,
-                break
+    """Return the numeric interpretation of the string `v`, which is the
+    number given by its longest numeric prefix (or 0 if it has none). The
+    numbers of recently seen strings are cached."""
+    signs, digits, exp = _number_prefix.match(v).groups()
+    if digits == "" or digits == ".":
+        return 0
 
-        # Re-assemble the digits and attempt to convert it
-        n = float("".join(n)) * sign
-        return n if not n.is_integer() else int(n)
+    if exp is None and "." not in digits:
+        try:
+            n = int(digits)
+        except ValueError:
+            # Python will not convert integers of more than 4300 digits,
+            # so these overflow a float as they did before
+            n = float(digits)
+    elif _exact:
+        n = _exact_number(digits, exp)
+    else:
+        n = float(digits if exp is None else "{}e{}".format(digits, exp))
+        if n.is_integer():
+            n = int(n)
+    return -n if signs.count("-") % 2 else n
+
+
+def _divide(n, d):
+    """Divide `n` by `d`, raising a MUMPS error on division by zero."""
+    if d == 0:
+        raise MUMPSSyntaxError("Cannot divide by zero.",
+                               err_type="DIVIDE BY ZERO")
+    if _exact and type(n) is int and type(d) is int:
+        return _quotient(n, d)
+    return n / d
+
+
+def _idivide(n, d):
+    """Integer divide `n` by `d`, truncating the result towards zero."""
+    if d == 0:
+        raise MUMPSSyntaxError("Cannot divide by zero.",
+                               err_type="DIVIDE BY ZERO")
+    return n // d if n * d > 0 else (n + (-n % d)) // d
+
+
+def _modulo(n, d):
+    """Return `n` modulo `d`, raising a MUMPS error on division by zero."""
+    if d == 0:
+        raise MUMPSSyntaxError("Cannot divide by zero.",
+                               err_type="DIVIDE BY ZERO")
+    return n % d
+
+
+def _power(n, e):
+    """Return `n**e`. In exact arithmetic mode, integers raised to negative
+    integer powers are divided exactly rather than as floats."""
+    if _exact and type(e) is int and e < 0 and type(n) is int:
+        return _quotient(1, n ** -e)
+    return n ** e
 
 
 def _other_as_number(other):
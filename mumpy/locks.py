@@ -0,0 +1,329 @@
+"""MUMPy Lock Table
+
+The MUMPS `LOCK` command claims names (variable names, with or without
+subscripts) so that cooperating processes can agree which of them may use
+the data those names refer to. Locks are advisory; holding a lock does not
+prevent any other process from reading or changing a variable. A lock on a
+name also covers every name beneath it, so `^X(1)` conflicts with both `^X`
+and `^X(1,2)` but not with `^X(2)`.
+
+Locks are shared by every MUMPy process using the same database file (such
+as the processes started by `JOB` commands) through a small lock table file
+beside the database. The table lists the names held by each process, with
+a count for names locked more than once, and the requests which are waiting
+for names. It is only read and changed while the file is locked, and the
+entries of processes which have exited are removed when the table is read.
+
+Waiting requests are granted in the order they were made: a request waits
+for any earlier request for a conflicting name, so a request for a busy
+name is not overtaken forever by later ones. A request which would wait on
+a process which is (directly or indirectly) waiting on the requester fails
+rather than waiting forever.
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import atexit
+import contextlib
+import json
+import os
+import time
+import mumpy
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+# The number of seconds between checks of the lock table by a request
+# which is waiting for a name
+_poll_interval = 0.01
+
+# Lock tables which are open in this process, by the path of their file
+_tables = {}
+
+
+def open_lock_table(path):
+    """Return the lock table kept in the file `path`, opening (or creating)
+    it if it is not already open in this process."""
+    path = os.path.abspath(path)
+    try:
+        return _tables[path]
+    except KeyError:
+        table = MUMPSLockTable(path)
+        _tables[path] = table
+        return table
+
+
+@atexit.register
+def close_lock_tables():
+    """Release every lock held by this process and close the lock tables."""
+    for path in list(_tables):
+        _tables.pop(path).close()
+
+
+def _conflicts(a, b):
+    """Return True if the lock names `a` and `b` conflict, which they do if
+    they name the same variable and the subscripts of one begin with all
+    of the subscripts of the other."""
+    if a[0] != b[0]:
+        return False
+    n = min(len(a[1]), len(b[1]))
+    return a[1][:n] == b[1][:n]
+
+
+def _any_conflicts(names, others):
+    """Return True if any of the lock names `names` conflicts with any of
+    the lock names `others`."""
+    return any(_conflicts(a, b) for a in names for b in others)
+
+
+def _alive(pid):
+    """Return True if the process `pid` may still be running."""
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+###################
+# LOCK TABLE
+###################
+class MUMPSLockTable:
+    """The table of names locked and requested by MUMPy processes, kept in
+    a lock table file. Lock names are given as pairs of the variable name
+    and a sequence of subscript strings."""
+    def __init__(self, path):
+        self.path = path
+        self._pid = os.getpid()
+
+        # The names held by this process and their lock counts, which are
+        # also kept in the table
+        self._held = {}
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        self._f = os.fdopen(fd, mode='r+')
+
+    def __repr__(self):
+        return "MUMPSLockTable({path}, {held})".format(
+            path=self.path,
+            held=len(self._held),
+        )
+
+    ###################
+    # LOCKS
+    ###################
+    def lock(self, names, timeout=None):
+        """Release every name held by this process and then lock all of the
+        given names, as a `LOCK` command without `+` does. Return True if
+        the names were locked, or False if they could not be locked within
+        `timeout` seconds (or forever, if no timeout is given)."""
+        self.unlock_all()
+        return self.lock_add(names, timeout=timeout)
+
+    def lock_add(self, names, timeout=None):
+        """Lock all of the given names in addition to the names this process
+        already holds, as a `LOCK +` command does. The names are either all
+        locked together or none are locked. Return True if the names were
+        locked, or False if they could not be locked within `timeout`
+        seconds (or forever, if no timeout is given)."""
+        names = [(str(name), tuple(str(s) for s in subs))
+                 for name, subs in names]
+        deadline = (None if timeout is None
+                    else time.monotonic() + max(timeout, 0))
+
+        ticket = None
+        try:
+            while True:
+                with self._table() as table:
+                    if ticket is None:
+                        ticket = table['next']
+                        table['next'] += 1
+                        table['waiting'].append((ticket, self._pid, names))
+
+                    if not self._blockers(table, ticket, self._pid, names):
+                        self._dequeue(table, ticket)
+                        ticket = None
+                        for name in names:
+                            self._hold(table, name)
+                        return True
+
+                    deadlock = self._deadlocked(table, ticket, names)
+                    expired = (deadline is not None and
+                               time.monotonic() >= deadline)
+                    if deadlock or expired:
+                        self._dequeue(table, ticket)
+                        ticket = None
+
+                if deadlock and timeout is None:
+                    raise mumpy.MUMPSSyntaxError(
+                        "Lock request would wait forever on a process "
+                        "waiting for this process.",
+                        err_type="LOCK DEADLOCK"
+                    )
+                elif deadlock or expired:
+                    return False
+                time.sleep(_poll_interval)
+        finally:
+            # Withdraw the request if we were interrupted while waiting
+            if ticket is not None:
+                with self._table() as table:
+                    self._dequeue(table, ticket)
+
+    def unlock(self, names):
+        """Release one lock on each of the given names, as a `LOCK -`
+        command does. Names which are not held are ignored."""
+        names = [(str(name), tuple(str(s) for s in subs))
+                 for name, subs in names]
+        if not any(name in self._held for name in names):
+            return
+
+        with self._table() as table:
+            for name in names:
+                self._release(table, name)
+
+    def unlock_all(self):
+        """Release every name held by this process."""
+        if not self._held:
+            return
+
+        with self._table() as table:
+            table['held'] = [h for h in table['held'] if h[0] != self._pid]
+        self._held = {}
+
+    def close(self):
+        """Release every name held by this process and close the file."""
+        try:
+            self.unlock_all()
+        finally:
+            self._f.close()
+
+    ###################
+    # TABLE
+    ###################
+    @contextlib.contextmanager
+    def _table(self):
+        """Lock the lock table file and return its contents, which are
+        written back when the context exits normally. The table is a dict
+        of the next request ticket, the held names (as lists of process ID,
+        name and count) and the waiting requests (as lists of ticket,
+        process ID and names)."""
+        self._lock_file()
+        try:
+            self._f.seek(0)
+            data = self._f.read()
+            table = (json.loads(data) if data else
+                     {'next': 0, 'held': [], 'waiting': []})
+
+            # Lock names are stored as lists; compare them as tuples
+            table['held'] = [(pid, (name[0], tuple(name[1])), count)
+                             for pid, name, count in table['held']]
+            table['waiting'] = [(ticket, pid,
+                                 [(n[0], tuple(n[1])) for n in names])
+                                for ticket, pid, names in table['waiting']]
+            self._prune(table)
+
+            yield table
+
+            self._f.seek(0)
+            self._f.truncate()
+            self._f.write(json.dumps(table))
+            self._f.flush()
+        finally:
+            self._unlock_file()
+
+    def _prune(self, table):
+        """Remove the entries of processes which have exited from `table`."""
+        pids = {h[0] for h in table['held']} | {w[1] for w in table['waiting']}
+        dead = {pid for pid in pids if pid != self._pid and not _alive(pid)}
+        if dead:
+            table['held'] = [h for h in table['held'] if h[0] not in dead]
+            table['waiting'] = [w for w in table['waiting']
+                                if w[1] not in dead]
+
+    def _hold(self, table, name):
+        """Add one lock on `name` for this process to `table`."""
+        count = self._held.get(name, 0) + 1
+        self._held[name] = count
+        held = [h for h in table['held']
+                if not (h[0] == self._pid and h[1] == name)]
+        held.append((self._pid, name, count))
+        table['held'] = held
+
+    def _release(self, table, name):
+        """Remove one lock on `name` by this process from `table`."""
+        count = self._held.pop(name, 0) - 1
+        held = [h for h in table['held']
+                if not (h[0] == self._pid and h[1] == name)]
+        if count > 0:
+            self._held[name] = count
+            held.append((self._pid, name, count))
+        table['held'] = held
+
+    @staticmethod
+    def _dequeue(table, ticket):
+        """Remove the request `ticket` from the waiting requests."""
+        table['waiting'] = [w for w in table['waiting'] if w[0] != ticket]
+
+    @staticmethod
+    def _blockers(table, ticket, pid, names):
+        """Return the set of processes the request `ticket` of process `pid`
+        for `names` is waiting on. These are the other processes holding a
+        conflicting name, and those which made an earlier request for a
+        conflicting name (unless that request is itself waiting on a name
+        held by `pid`)."""
+        held = [h[1] for h in table['held'] if h[0] == pid]
+        blockers = {h[0] for h in table['held']
+                    if h[0] != pid and _any_conflicts(names, (h[1],))}
+        for other, opid, onames in table['waiting']:
+            if other >= ticket or opid == pid or opid in blockers:
+                continue
+            if (_any_conflicts(names, onames) and
+                    not _any_conflicts(onames, held)):
+                blockers.add(opid)
+        return blockers
+
+    def _deadlocked(self, table, ticket, names):
+        """Return True if the request `ticket` for `names` waits (directly or
+        through other waiting requests) on a process which is waiting on
+        this process."""
+        waits = {}
+        for other, pid, onames in table['waiting']:
+            if pid != self._pid:
+                waits.setdefault(pid, set()).update(
+                    self._blockers(table, other, pid, onames)
+                )
+
+        seen = set()
+        todo = list(self._blockers(table, ticket, self._pid, names))
+        while todo:
+            pid = todo.pop()
+            if pid == self._pid:
+                return True
+            if pid not in seen:
+                seen.add(pid)
+                todo.extend(waits.get(pid, ()))
+        return False
+
+    def _lock_file(self):
+        """Wait for an exclusive lock on the lock table file."""
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        else:
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock_file(self):
+        """Release the lock on the lock table file."""
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+        else:
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
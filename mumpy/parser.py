@@ -9,18 +9,43 @@ import logging
 import ply.yacc as yacc
 import mumpy
 import mumpy.lang as lang
+import mumpy.tree as tree
+
+
+# Syntax trees of parsed routine lines, keyed by routine name and then by
+# the (line number, source hash) pair of each line. Syntax trees hold no
+# reference to an environment, so they are shared by every parser.
+_routine_trees = dict()
 
 
 # noinspection PyMethodMayBeStatic
 class MUMPSParser:
-    def __init__(self, env, debug=False):
-        # The environment is the execution stack
+    def __init__(self, env=None, debug=False, compiled=True,
+                 exceptions=False):
+        # The environment is the execution stack. Parsers created without
+        # an environment may still produce syntax trees with parse_tree()
         self.env = env
         self.debug = debug
 
+        # If True, run the compiled Python functions for routine tags
+        # rather than interpreting routines line by line
+        self.compiled = compiled
+
+        # If True, interpreted commands raise exceptions to change the flow
+        # of execution (QUIT, GOTO, a false IF and FOR) as in earlier
+        # versions, rather than returning them as their status
+        self.exceptions = exceptions
+
         # Boolean flag if the last line caused output
         self.output = False
 
+        # Routine lines bound to this parser's environment, keyed by routine
+        # name and then by the (line number, source hash) pair of each line
+        self._line_cache = dict()
+
+        # The (routine, line number) of the line being bound, if any
+        self._bind_line = None
+
         # Output log file that PLY uses to report Parse errors
         logging.basicConfig(
             level=logging.DEBUG if debug else logging.ERROR,
@@ -73,25 +98,20 @@ class MUMPSParser:
         try:
             self.output = False
 
-            # Output the Lexer tokens
-            if self.debug:
-                self.repl['lex'].test(data)
-
-            # Reset the Lexer and parse the data
-            self.repl['lex'].reset()
-
             # Execute the parsed command(s)
             try:
-                p = self.repl['parser'].parse(data,
-                                              lexer=self.repl['lex'].lexer)
-                p.execute()
-            except (mumpy.MUMPSReturn, mumpy.MUMPSCommandEnd):
-                pass
-            except mumpy.MUMPSGotoLine as goto:
-                fn = goto.func
-                trampoline(self._parse_tag, fn.rou, fn.tag)
+                p = self.parse_tree(data, is_rou=False)
+                status = tree.execute(p, self.env, self)
+            except (mumpy.MUMPSReturn, mumpy.MUMPSGotoLine,
+                    mumpy.MUMPSCommandEnd) as signal:
+                status = signal
             except Exception as e:
                 raise mumpy.MUMPSSyntaxError(e)
+
+            # Follow a GOTO to its tag
+            if isinstance(status, mumpy.MUMPSGotoLine):
+                fn = status.func
+                self._run_tag(fn.rou, fn.tag)
         except KeyError:
             print("The REPL was not set up correctly. Quitting...")
 
@@ -109,31 +129,34 @@ class MUMPSParser:
         tag = tag if tag is not None else f.rou
         self.env.init_stack_frame(f, tag=tag, in_args=args)
 
-        # If no tag is specified, start at the beginning
-        lines = f.tag_body(tag)
-        for line in lines:
-            self.output = False
+        # Run the routine from the tag, following any GOTOs
+        return self._run_tag(f, tag)
 
-            if self.debug:
-                self.rou['lex'].test(line)
+    def _run_tag(self, f, tag, compiled=None, line=None):
+        """Run a MUMPSFile from the specified tag in the current stack
+        frame, following any GOTOs, and return the result. Callers which
+        have already looked up the compiled function for the tag and the
+        line it starts at may give them as `compiled` and `line`.
 
-            self.rou['lex'].reset()
+        Transactions started in this stack frame which must be restarted
+        are resumed here from their TSTART command, after
+        discarding any stack frames pushed since the transaction started."""
+        depth = self.env.call_depth()
+        if compiled is not None and self.compiled:
+            self.output = True
+            func, args = compiled, (self.env, self)
+        elif line is not None:
+            func, args = self._parse_lines, (f, line)
+        else:
+            func, args = self._parse_tag, (f, tag)
+        while True:
             try:
-                p = self.rou['parser'].parse(line, lexer=self.rou['lex'].lexer)
-                p.execute()
-            except mumpy.MUMPSReturn as ret:
-                return ret.value()
-            except mumpy.MUMPSCommandEnd:
-                continue
-            except mumpy.MUMPSGotoLine as goto:
-                fn = goto.func
-                return trampoline(self._parse_tag, fn.rou, fn.tag)
-
-        # Reset the Lexer and Parser to the correct state
-        self.rou['lex'].reset()
-
-        # Return any resulting expression to the caller
-        return None
+                return _trampoline_private(func(*args))
+            except mumpy.MUMPSTransactionRestart as r:
+                if r.depth != depth:
+                    raise
+                self.env.unwind(r.depth, r.level)
+                func, args = self._parse_lines, (r.rou, r.line, r.cmd)
 
     def _parse_tag(self, f, tag):
         """Parse a MUMPSFile starting at the specified tag.
@@ -151,26 +174,40 @@ class MUMPSParser:
         if not isinstance(f, mumpy.MUMPSFile):
             raise TypeError("Please specify a valid MUMPS routine.")
 
-        # Get the tag body
-        lines = f.tag_body(tag)
-        for line in lines:
+        # Run the compiled function for the tag if there is one
+        func = f.tag_func(tag) if self.compiled else None
+        if func is not None:
             self.output = True
+            return func(self.env, self)
 
-            if self.debug:
-                self.rou['lex'].test(line)
+        return self._parse_lines(f, f.tag_line(tag))
 
-            self.rou['lex'].reset()
+    def _parse_lines(self, f, start, cmd=0):
+        """Parse a MUMPSFile starting at line number `start` (from the
+        command at index `cmd` on that line), returning a lambda in the
+        same way as `_parse_tag`."""
+        lines = f.lines()[start:]
+        for num, line in enumerate(lines, start=start):
+            self.output = True
 
             try:
-                p = self.rou['parser'].parse(line, lexer=self.rou['lex'].lexer)
-                p.execute()
-            except mumpy.MUMPSReturn as ret:
-                return lambda v=ret: v.value()
-            except mumpy.MUMPSGotoLine as goto:
-                return lambda cmd=self._parse_tag, fn=goto.func: cmd(fn.rou,
-                                                                     fn.tag)
-            except mumpy.MUMPSCommandEnd:
+                p = self._parse_line(f, num, line)
+                if num == start and cmd:
+                    status = lang._execute_line(p.list[cmd:])
+                else:
+                    status = p.execute()
+            except (mumpy.MUMPSReturn, mumpy.MUMPSGotoLine,
+                    mumpy.MUMPSCommandEnd) as signal:
+                status = signal
+
+            # Lines end normally with no status (or a false IF)
+            if status is None or isinstance(status, mumpy.MUMPSCommandEnd):
                 continue
+            elif isinstance(status, mumpy.MUMPSReturn):
+                return lambda v=status: v.value()
+            elif isinstance(status, mumpy.MUMPSGotoLine):
+                return lambda cmd=self._parse_tag, fn=status.func: cmd(fn.rou,
+                                                                       fn.tag)
 
         # Reset the Lexer and Parser to the correct state
         self.rou['lex'].reset()
@@ -178,6 +215,57 @@ class MUMPSParser:
         # Return any resulting expression to the caller
         return lambda: None
 
+    def parse_tree(self, data, is_rou=True):
+        """Parse a single line of MUMPS code into a syntax tree without
+        executing it. Routine lines are parsed by default; REPL and XECUTE
+        input should be given with `is_rou` False.
+
+        The returned LineNode holds no reference to this parser or its
+        environment, so it may be cached and later bound to any environment
+        using the functions in `mumpy.tree`."""
+        p = self.rou if is_rou else self.repl
+
+        # Output the Lexer tokens
+        if self.debug:
+            p['lex'].test(data)
+
+        # Reset the Lexer and parse the data
+        p['lex'].reset()
+        return p['parser'].parse(data, lexer=p['lex'].lexer)
+
+    def _parse_line(self, f, num, line):
+        """Return the executable MUMPSLine for line number `num` of routine
+        `f`.
+
+        Syntax trees are cached per routine, keyed by the line number and
+        a hash of the line source, so each line is only lexed and parsed
+        the first time it is executed by any parser. The tree is bound to
+        this parser's environment once and the bound line is reused by
+        subsequent executions (such as calls to a hot subroutine)."""
+        key = (num, hash(line))
+        bound = self._line_cache.setdefault(f.name(), dict())
+        try:
+            return bound[key]
+        except KeyError:
+            pass
+
+        trees = _routine_trees.setdefault(f.name(), dict())
+        try:
+            node = trees[key]
+        except KeyError:
+            node = self.parse_tree(line)
+            trees[key] = node
+
+        # Commands which refer back to their line (such as TSTART) may
+        # find it while the line is bound
+        self._bind_line = (f, num)
+        try:
+            p = tree.bind(node, self.env, self)
+        finally:
+            self._bind_line = None
+        bound[key] = p
+        return p
+
     def _parse_xecute(self, args, env):
         """Parse an expression for an XECUTE command.
 
@@ -185,21 +273,21 @@ class MUMPSParser:
         encountered."""
         self.output = False
         for expr in args:
-            self.repl['lex'].reset()
             try:
-                p = self.repl['parser'].parse(str(expr),
-                                              lexer=self.repl['lex'].lexer)
-                p.execute()
-            except mumpy.MUMPSReturn as ret:
-                return ret.value()
-            except mumpy.MUMPSCommandEnd:
-                continue
-            except mumpy.MUMPSGotoLine as goto:
-                fn = goto.func
-                return trampoline(self._parse_tag, fn.rou, fn.tag)
+                p = self.parse_tree(str(expr), is_rou=False)
+                status = tree.execute(p, env, self)
+            except (mumpy.MUMPSReturn, mumpy.MUMPSGotoLine,
+                    mumpy.MUMPSCommandEnd) as signal:
+                status = signal
             except Exception as e:
                 raise mumpy.MUMPSSyntaxError(e)
 
+            if isinstance(status, mumpy.MUMPSReturn):
+                return status.value()
+            elif isinstance(status, mumpy.MUMPSGotoLine):
+                fn = status.func
+                return self._run_tag(fn.rou, fn.tag)
+
     def p_error(self, p):
         if p is not None:
             raise lang.MUMPSSyntaxError(str(p), err_type="PARSE ERROR",
@@ -243,19 +331,19 @@ class MUMPSParser:
 
     def p_comment(self, p):
         """comment : COMMENT"""
-        p[0] = mumpy.MUMPSLine(None)
+        p[0] = tree.LineNode()
 
     def p_input(self, p):
-        """valid_input : valid_input SPACE command
+        """valid_input : valid_input SPACE any_command
                        | valid_input any_command
                        | any_command"""
         l = len(p)
         if l == 4:
-            p[0] = mumpy.MUMPSLine(p[3], p[1])
+            p[0] = tree.LineNode(p[1].commands + (p[3],))
         elif l == 3:
-            p[0] = mumpy.MUMPSLine(p[2], p[1])
+            p[0] = tree.LineNode(p[1].commands + (p[2],))
         else:
-            p[0] = mumpy.MUMPSLine(p[1])
+            p[0] = tree.LineNode((p[1],))
 
     def p_any_command(self, p):
         """any_command : command
@@ -280,16 +368,23 @@ class MUMPSParser:
                    | goto_command
                    | for_command
                    | view_command
-                   | job_command"""
+                   | job_command
+                   | lock_command
+                   | merge_command"""
         p[0] = p[1]
 
     def p_command_no_arg(self, p):
         """command_no_arg : kill_all_command
+                          | lock_all_command
                           | halt_command
                           | write_symbols
                           | if_command_no_args
                           | else_command
-                          | for_unlimited"""
+                          | for_unlimited
+                          | tstart_command
+                          | tcommit_command
+                          | trollback_command
+                          | trestart_command"""
         p[0] = p[1]
 
     ###################
@@ -297,7 +392,7 @@ class MUMPSParser:
     ###################
     def p_new_command(self, p):
         """new_command : NEW SPACE symbol_list"""
-        p[0] = mumpy.MUMPSCommand(lang.new_var, p[3], self.env)
+        p[0] = tree.CommandNode('NEW', p[3])
 
     def p_do_command(self, p):
         """do_command : DO SPACE subroutine_call_list
@@ -309,19 +404,19 @@ class MUMPSParser:
             post = None
             args = p[3]
 
-        p[0] = mumpy.MUMPSCommand(lang.do_cmd, args, self.env, post=post)
+        p[0] = tree.CommandNode('DO', args, post=post)
 
     def p_if_command(self, p):
         """if_command : IF SPACE argument_list"""
-        p[0] = mumpy.MUMPSCommand(lang.if_cmd, p[3], self.env)
+        p[0] = tree.CommandNode('IF', p[3])
 
     def p_if_command_no_arg(self, p):
         """if_command_no_args : IF no_argument"""
-        p[0] = mumpy.MUMPSCommand(lang.if_no_args, None, self.env)
+        p[0] = tree.CommandNode('IF')
 
     def p_else_command(self, p):
         """else_command : ELSE no_argument"""
-        p[0] = mumpy.MUMPSCommand(lang.else_cmd, None, self.env)
+        p[0] = tree.CommandNode('ELSE')
 
     def p_for_command(self, p):
         """for_command : for_limited_all
@@ -342,7 +437,7 @@ class MUMPSParser:
         if len(p) == 12:
             args['others'] = p[11]
 
-        p[0] = mumpy.MUMPSCommand(lang.for_start, args, self.env)
+        p[0] = tree.CommandNode('FOR', args)
 
     def p_for_limited_inc(self, p):
         """for_limited_inc : FOR SPACE variable EQUALS expression COLON expression COMMA argument_list
@@ -356,7 +451,7 @@ class MUMPSParser:
         if len(p) == 10:
             args['others'] = p[9]
 
-        p[0] = mumpy.MUMPSCommand(lang.for_start, args, self.env)
+        p[0] = tree.CommandNode('FOR', args)
 
     def p_for_limited_start(self, p):
         """for_limited_start : FOR SPACE variable EQUALS expression COMMA argument_list
@@ -369,11 +464,11 @@ class MUMPSParser:
         if len(p) == 8:
             args['others'] = p[7]
 
-        p[0] = mumpy.MUMPSCommand(lang.for_start, args, self.env)
+        p[0] = tree.CommandNode('FOR', args)
 
     def p_for_unlimited(self, p):
         """for_unlimited : FOR no_argument"""
-        p[0] = mumpy.MUMPSCommand(lang.for_start, None, self.env)
+        p[0] = tree.CommandNode('FOR')
 
     def p_goto_command(self, p):
         """goto_command : GOTO SPACE goto_call_list
@@ -385,7 +480,7 @@ class MUMPSParser:
             post = None
             args = p[3]
 
-        p[0] = mumpy.MUMPSCommand(lang.goto_cmd, args, self.env, post=post)
+        p[0] = tree.CommandNode('GOTO', args, post=post)
 
     def p_job_command(self, p):
         """job_command : JOB SPACE job_argument_list
@@ -397,7 +492,7 @@ class MUMPSParser:
             post = None
             args = p[3]
 
-        p[0] = mumpy.MUMPSCommand(lang.job_cmd, args, self.env, post=post)
+        p[0] = tree.CommandNode('JOB', args, post=post)
 
     def p_kill_command(self, p):
         """kill_command : KILL SPACE variable_list
@@ -411,7 +506,7 @@ class MUMPSParser:
             symbols = p[3]
 
         # Kill the specified symbols
-        p[0] = mumpy.MUMPSCommand(lang.kill, symbols, self.env, post=post)
+        p[0] = tree.CommandNode('KILL', symbols, post=post)
 
     def p_kill_all_command(self, p):
         """kill_all_command : KILL no_argument
@@ -420,7 +515,39 @@ class MUMPSParser:
         post = p[3] if len(p) > 4 else None
 
         # Kill the specified symbols
-        p[0] = mumpy.MUMPSCommand(lang.kill_all, None, self.env, post=post)
+        p[0] = tree.CommandNode('KILL', post=post)
+
+    def p_lock_command(self, p):
+        """lock_command : LOCK SPACE lock_argument_list
+                        | LOCK COLON expression SPACE lock_argument_list"""
+        if len(p) > 4:
+            post = p[3]
+            args = p[5]
+        else:
+            post = None
+            args = p[3]
+
+        p[0] = tree.CommandNode('LOCK', args, post=post)
+
+    def p_lock_all_command(self, p):
+        """lock_all_command : LOCK no_argument
+                            | LOCK COLON expression no_argument
+                            | LOCK COLON expression
+                            | LOCK"""
+        post = p[3] if len(p) > 3 else None
+        p[0] = tree.CommandNode('LOCK', post=post)
+
+    def p_merge_command(self, p):
+        """merge_command : MERGE SPACE merge_list
+                         | MERGE COLON expression SPACE merge_list"""
+        if len(p) > 4:
+            post = p[3]
+            args = p[5]
+        else:
+            post = None
+            args = p[3]
+
+        p[0] = tree.CommandNode('MERGE', args, post=post)
 
     def p_set_command(self, p):
         """set_command : SET SPACE assignment_list
@@ -434,7 +561,7 @@ class MUMPSParser:
             args = p[3]
 
         # Set the values
-        p[0] = mumpy.MUMPSCommand(lang.set_var, args, self.env, post=post)
+        p[0] = tree.CommandNode('SET', args, post=post)
 
     def p_open_command(self, p):
         """open_command : OPEN SPACE device_list
@@ -446,7 +573,7 @@ class MUMPSParser:
             post = None
             args = p[3]
 
-        p[0] = mumpy.MUMPSCommand(lang.open_dev, args, self.env, post=post)
+        p[0] = tree.CommandNode('OPEN', args, post=post)
 
     def p_close_command(self, p):
         """close_command : CLOSE SPACE device_list
@@ -458,19 +585,19 @@ class MUMPSParser:
             post = None
             args = p[3]
 
-        p[0] = mumpy.MUMPSCommand(lang.close_dev, args, self.env, post=post)
+        p[0] = tree.CommandNode('CLOSE', args, post=post)
 
     def p_use_command(self, p):
         """use_command : USE SPACE device
                        | USE COLON expression SPACE device"""
         if len(p) == 6:
             post = p[3]
-            args = mumpy.MUMPSArgumentList(p[5])
+            args = tree.ArgumentListNode((p[5],))
         else:
             post = None
-            args = mumpy.MUMPSArgumentList(p[3])
+            args = tree.ArgumentListNode((p[3],))
 
-        p[0] = mumpy.MUMPSCommand(lang.use_dev, args, self.env, post=post)
+        p[0] = tree.CommandNode('USE', args, post=post)
 
     def p_read_command(self, p):
         """read_command : READ SPACE read_argument_list
@@ -484,14 +611,11 @@ class MUMPSParser:
             args = p[3]
 
         # Write out the outputs
-        p[0] = mumpy.MUMPSCommand(lang.read, args, self.env, post=post)
+        p[0] = tree.CommandNode('READ', args, post=post)
 
     def p_write_command(self, p):
         """write_command : WRITE SPACE write_argument_list
                          | WRITE COLON expression SPACE write_argument_list"""
-        if self.env.current_device() == self.env.default_device():
-            self.output = True
-
         # Evaluate the post-conditional if it exists
         if len(p) > 4:
             post = p[3]
@@ -501,12 +625,11 @@ class MUMPSParser:
             args = p[3]
 
         # Write out the outputs
-        p[0] = mumpy.MUMPSCommand(lang.write, args, self.env, post=post)
+        p[0] = tree.CommandNode('WRITE', args, post=post)
 
     def p_write_symbols(self, p):
         """write_symbols : WRITE no_argument"""
-        self.output = True
-        p[0] = mumpy.MUMPSCommand(lang.write_symbols, None, self.env)
+        p[0] = tree.CommandNode('WRITE')
 
     def p_view_command(self, p):
         """view_command : VIEW SPACE view_argument_list
@@ -520,7 +643,7 @@ class MUMPSParser:
             args = p[3]
 
         # Execute the code in each expression
-        p[0] = mumpy.MUMPSCommand(lang.view_cmd, args, self.env, post=post)
+        p[0] = tree.CommandNode('VIEW', args, post=post)
 
     def p_xecute_command(self, p):
         """xecute_command : XECUTE SPACE argument_list
@@ -534,22 +657,22 @@ class MUMPSParser:
             args = p[3]
 
         # Execute the code in each expression
-        p[0] = mumpy.MUMPSCommand(self._parse_xecute, args, self.env, post=post)
+        p[0] = tree.CommandNode('XECUTE', args, post=post)
 
     def p_quit(self, p):
         """quit_command : QUIT
                         | QUIT no_argument
                         | QUIT SPACE expression"""
         # Handle the post-conditional if it exists
-        args = mumpy.MUMPSArgumentList(p[3]) if len(p) == 4 else None
-        p[0] = mumpy.MUMPSCommand(lang.quit_cmd, args, self.env)
+        args = tree.ArgumentListNode((p[3],)) if len(p) == 4 else None
+        p[0] = tree.CommandNode('QUIT', args)
 
     def p_quit_post(self, p):
         """quit_post_command : QUIT COLON expression no_argument
                              | QUIT COLON expression
                              | QUIT COLON expression SPACE expression"""
-        args = mumpy.MUMPSArgumentList(p[5]) if len(p) > 5 else None
-        p[0] = mumpy.MUMPSCommand(lang.quit_cmd, args, self.env, post=p[3])
+        args = tree.ArgumentListNode((p[5],)) if len(p) > 5 else None
+        p[0] = tree.CommandNode('QUIT', args, post=p[3])
 
     def p_halt(self, p):
         """halt_command : HALT_HANG
@@ -557,7 +680,39 @@ class MUMPSParser:
                         | HALT_HANG COLON expression
                         | HALT COLON expression"""
         post = p[3] if len(p) == 4 else None
-        p[0] = mumpy.MUMPSCommand(lang.halt, None, self.env, post=post)
+        p[0] = tree.CommandNode('HALT', post=post)
+
+    def p_tstart(self, p):
+        """tstart_command : TSTART no_argument
+                          | TSTART COLON expression no_argument
+                          | TSTART COLON expression
+                          | TSTART"""
+        post = p[3] if len(p) > 3 else None
+        p[0] = tree.CommandNode('TSTART', post=post)
+
+    def p_tcommit(self, p):
+        """tcommit_command : TCOMMIT no_argument
+                           | TCOMMIT COLON expression no_argument
+                           | TCOMMIT COLON expression
+                           | TCOMMIT"""
+        post = p[3] if len(p) > 3 else None
+        p[0] = tree.CommandNode('TCOMMIT', post=post)
+
+    def p_trollback(self, p):
+        """trollback_command : TROLLBACK no_argument
+                             | TROLLBACK COLON expression no_argument
+                             | TROLLBACK COLON expression
+                             | TROLLBACK"""
+        post = p[3] if len(p) > 3 else None
+        p[0] = tree.CommandNode('TROLLBACK', post=post)
+
+    def p_trestart(self, p):
+        """trestart_command : TRESTART no_argument
+                            | TRESTART COLON expression no_argument
+                            | TRESTART COLON expression
+                            | TRESTART"""
+        post = p[3] if len(p) > 3 else None
+        p[0] = tree.CommandNode('TRESTART', post=post)
 
     def p_hang(self, p):
         """hang_command : HALT_HANG SPACE numeric
@@ -567,13 +722,13 @@ class MUMPSParser:
         # Handle the post-conditional if it exists
         if len(p) > 4:
             post = p[3]
-            num = mumpy.MUMPSArgumentList(p[5].as_number())
+            num = tree.ArgumentListNode((p[5],))
         else:
             post = None
-            num = mumpy.MUMPSArgumentList(p[3].as_number())
+            num = tree.ArgumentListNode((p[3],))
 
         # Put the system to sleep for the specified number of seconds
-        p[0] = mumpy.MUMPSCommand(lang.hang, num, self.env, post=post)
+        p[0] = tree.CommandNode('HANG', num, post=post)
 
     ###################
     # ENTRYREF COMMAND MISC
@@ -586,9 +741,9 @@ class MUMPSParser:
         """goto_call_list : goto_call_list COMMA goto_call
                           | goto_call"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_goto_call(self, p):
         """goto_call : goto_tag_routine
@@ -601,23 +756,23 @@ class MUMPSParser:
 
     def p_goto_tag_routine(self, p):
         """goto_tag_routine : identifier routine_global"""
-        p[0] = mumpy.MUMPSFuncSubCall(p[1], self.env, self, rou=p[2])
+        p[0] = tree.CallNode(p[1], rou=p[2])
 
     def p_goto_tag(self, p):
         """goto_tag : identifier"""
-        p[0] = mumpy.MUMPSFuncSubCall(p[1], self.env, self)
+        p[0] = tree.CallNode(p[1])
 
     def p_goto_routine(self, p):
         """goto_routine : routine_global"""
-        p[0] = mumpy.MUMPSFuncSubCall(p[1], self.env, self, rou=p[1])
+        p[0] = tree.CallNode(p[1], rou=p[1])
 
     def p_job_argument_list(self, p):
         """job_argument_list : job_argument_list COMMA job_argument
                              | job_argument"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_job_argument(self, p):
         """job_argument : job_sub_call COLON LPAREN command_keyword_list RPAREN COLON expression
@@ -634,6 +789,38 @@ class MUMPSParser:
         else:
             p[0] = (p[1], None, None)
 
+    def p_lock_argument_list(self, p):
+        """lock_argument_list : lock_argument_list COMMA lock_argument
+                              | lock_argument"""
+        if len(p) == 4:
+            p[0] = p[1].append(p[3])
+        else:
+            p[0] = tree.ArgumentListNode((p[1],))
+
+    def p_lock_argument(self, p):
+        """lock_argument : PLUS lock_names COLON expression
+                         | MINUS lock_names
+                         | PLUS lock_names
+                         | lock_names COLON expression
+                         | lock_names"""
+        l = len(p)
+        if l == 5:
+            p[0] = ('+', p[2], p[4])
+        elif l == 3:
+            p[0] = (p[1], p[2], None)
+        elif l == 4:
+            p[0] = (None, p[1], p[3])
+        else:
+            p[0] = (None, p[1], None)
+
+    def p_lock_names(self, p):
+        """lock_names : LPAREN variable_list RPAREN
+                      | variable"""
+        if len(p) == 4:
+            p[0] = p[2]
+        else:
+            p[0] = tree.ArgumentListNode((p[1],))
+
     def p_job_sub_call(self, p):
         """job_sub_call : subroutine_call_tag
                         | subroutine_call_no_tag
@@ -644,9 +831,9 @@ class MUMPSParser:
         """subroutine_call_list : subroutine_call_list COMMA subroutine_call
                                 | subroutine_call"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_subroutine_call(self, p):
         """subroutine_call : subroutine_call_tag
@@ -668,8 +855,7 @@ class MUMPSParser:
             args = ()
         else:
             args = None
-        p[0] = mumpy.MUMPSFuncSubCall(p[1], self.env, self, args=args,
-                                      is_func=False, rou=p[2])
+        p[0] = tree.CallNode(p[1], rou=p[2], args=args, is_func=False)
 
     def p_subroutine_call_no_tag(self, p):
         """subroutine_call_no_tag : routine_global
@@ -682,8 +868,7 @@ class MUMPSParser:
             args = ()
         else:
             args = None
-        p[0] = mumpy.MUMPSFuncSubCall(p[1], self.env, self, args=args,
-                                      is_func=False, rou=p[1])
+        p[0] = tree.CallNode(p[1], rou=p[1], args=args, is_func=False)
 
     def p_subroutine_call_no_rou(self, p):
         """subroutine_call_no_rou : identifier
@@ -696,14 +881,13 @@ class MUMPSParser:
             args = ()
         else:
             args = None
-        p[0] = mumpy.MUMPSFuncSubCall(p[1], self.env, self, args=args,
-                                      is_func=False)
+        p[0] = tree.CallNode(p[1], args=args, is_func=False)
 
     def p_function_call(self, p):
         """function_call : function_call_tag
                          | function_call_no_tag
                          | function_call_no_rou"""
-        p[0] = mumpy.MUMPSExpression(p[1])
+        p[0] = p[1]
 
     def p_function_call_tag(self, p):
         """function_call_tag : EXTRINSIC identifier routine_global
@@ -716,8 +900,7 @@ class MUMPSParser:
             args = ()
         else:
             args = None
-        p[0] = mumpy.MUMPSFuncSubCall(p[2], self.env, self, args=args,
-                                      is_func=True, rou=p[3])
+        p[0] = tree.CallNode(p[2], rou=p[3], args=args, is_func=True)
 
     def p_function_call_no_tag(self, p):
         """function_call_no_tag : EXTRINSIC routine_global
@@ -730,8 +913,7 @@ class MUMPSParser:
             args = ()
         else:
             args = None
-        p[0] = mumpy.MUMPSFuncSubCall(p[2], self.env, self, args=args,
-                                      is_func=True, rou=p[2])
+        p[0] = tree.CallNode(p[2], rou=p[2], args=args, is_func=True)
 
     def p_function_call_no_rou(self, p):
         """function_call_no_rou : EXTRINSIC identifier
@@ -744,16 +926,15 @@ class MUMPSParser:
             args = ()
         else:
             args = None
-        p[0] = mumpy.MUMPSFuncSubCall(p[2], self.env, self, args=args,
-                                      is_func=True)
+        p[0] = tree.CallNode(p[2], args=args, is_func=True)
 
     def p_func_sub_argument_list(self, p):
         """func_sub_argument_list : func_sub_argument_list COMMA func_sub_argument
                                   | func_sub_argument"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_func_sub_argument(self, p):
         """func_sub_argument : pointer_argument
@@ -762,7 +943,7 @@ class MUMPSParser:
 
     def p_pointer_argument(self, p):
         """pointer_argument : PERIOD identifier"""
-        p[0] = mumpy.MUMPSPointerIdentifier(p[2], self.env)
+        p[0] = tree.PointerNode(p[2])
 
     ###################
     # COMMAND MISC
@@ -771,33 +952,33 @@ class MUMPSParser:
         """symbol_list : symbol_list COMMA identifier
                        | identifier"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(tree.VariableNode(p[3]))
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((tree.VariableNode(p[1]),))
 
     def p_variable_list(self, p):
         """variable_list : variable_list COMMA variable
                          | variable"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_argument_list(self, p):
         """argument_list : argument_list COMMA expression
                          | expression"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_sel_argument_list(self, p):
         """sel_argument_list : sel_argument_list COMMA sel_argument
                              | sel_argument"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_sel_argument(self, p):
         """sel_argument : expression COLON expression"""
@@ -807,41 +988,64 @@ class MUMPSParser:
         """view_argument_list : view_argument_list COMMA view_argument
                               | view_argument"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_view_argument(self, p):
         """view_argument : view_argument COLON expression
                          | expression"""
         if len(p) == 4:
-            p[0] = p[1] + p[3]
+            p[0] = p[1] + (p[3],)
         else:
             p[0] = (p[1],)
 
     def p_assignment(self, p):
-        """assignment : variable EQUALS expression"""
-        p[0] = (p[1], p[3])
+        """assignment : variable EQUALS expression
+                      | extract_func EQUALS expression
+                      | piece_func EQUALS expression"""
+        target = p[1]
+        if isinstance(target, tree.IntrinsicNode):
+            # The first argument names the variable which is set
+            var = target.args[0]
+            if not isinstance(var, tree.ValueNode):
+                raise mumpy.MUMPSSyntaxError("SET functions require a "
+                                             "variable.",
+                                             err_type="INVALID SET TARGET")
+            target = tree.SetTargetNode(target.name, var.var, target.args[1:])
+        p[0] = (target, p[3])
 
     def p_assignment_list(self, p):
         """assignment_list : assignment_list COMMA assignment
                            | assignment"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
+
+    def p_merge(self, p):
+        """merge : variable EQUALS variable"""
+        p[0] = (p[1], p[3])
+
+    def p_merge_list(self, p):
+        """merge_list : merge_list COMMA merge
+                      | merge"""
+        if len(p) == 4:
+            p[0] = p[1].append(p[3])
+        else:
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_command_keyword_list(self, p):
         """command_keyword_list : command_keyword_list COMMA keyword_value
                                 | keyword_value"""
         if len(p) == 4:
-            p[0] = p[1].append(p[3])
+            p[0] = p[1] + (p[3],)
         else:
-            p[0] = [p[1]]
+            p[0] = (p[1],)
 
     def p_keyword_value(self, p):
         """keyword_value : string_contents EQUALS expression"""
-        p[0] = (p[1], p[3])
+        p[0] = (p[1].value, p[3])
 
     def p_no_arguments(self, p):
         """no_argument : SPACE SPACE"""
@@ -855,9 +1059,9 @@ class MUMPSParser:
                        | device"""
         l = len(p)
         if l == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = p[1].append(p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode((p[1],))
 
     def p_device(self, p):
         """device : expression
@@ -872,20 +1076,26 @@ class MUMPSParser:
         """read_argument_list : read_argument_list COMMA read_argument
                               | read_argument"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = tree.ArgumentListNode(p[1].items + p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode(p[1])
 
     def p_read_argument(self, p):
         """read_argument : string_contents
                          | io_format
                          | read_variable
                          | read_timeout"""
-        p[0] = mumpy.MUMPSExpression(p[1])
+        if isinstance(p[1], tuple):
+            p[0] = p[1]
+        elif isinstance(p[1], tree.VariableNode):
+            p[0] = (tree.ValueNode(p[1]),)
+        else:
+            p[0] = (p[1],)
 
     def p_read_timeout(self, p):
         """read_timeout : read_variable COLON expression"""
-        p[0] = p[1].set_timeout(int(p[3].as_number()))
+        p[0] = tree.VariableNode(p[1].name, p[1].subscripts,
+                                 max=p[1].max, timeout=p[3])
 
     def p_read_variable(self, p):
         """read_variable : read_one_char
@@ -895,11 +1105,12 @@ class MUMPSParser:
 
     def p_read_one_char(self, p):
         """read_one_char : TIMES variable"""
-        p[0] = p[2].set_max(1)
+        p[0] = tree.VariableNode(p[2].name, p[2].subscripts,
+                                 max=tree.LiteralNode(1))
 
     def p_read_n_chars(self, p):
         """read_n_chars : variable MODULUS expression"""
-        p[0] = p[1].set_max(int(p[3].as_number()))
+        p[0] = tree.VariableNode(p[1].name, p[1].subscripts, max=p[3])
 
     def p_read_line(self, p):
         """read_line : variable"""
@@ -909,19 +1120,19 @@ class MUMPSParser:
         """write_argument_list : write_argument_list COMMA write_argument
                                | write_argument"""
         if len(p) == 4:
-            p[0] = mumpy.MUMPSArgumentList(p[3], p[1])
+            p[0] = tree.ArgumentListNode(p[1].items + p[3])
         else:
-            p[0] = mumpy.MUMPSArgumentList(p[1])
+            p[0] = tree.ArgumentListNode(p[1])
 
     def p_write_argument(self, p):
         """write_argument : expression
                           | io_format
                           | write_char"""
-        p[0] = p[1]
+        p[0] = p[1] if isinstance(p[1], tuple) else (p[1],)
 
     def p_write_char(self, p):
         """write_char : TIMES expression"""
-        p[0] = lang.intrinsic_char((p[2],))
+        p[0] = tree.IntrinsicNode('CHAR', (tree.ArgumentListNode((p[2],)),))
 
     def p_io_format(self, p):
         """io_format : io_format format_newline
@@ -930,7 +1141,11 @@ class MUMPSParser:
                      | format_newline
                      | format_clear_screen
                      | format_column"""
-        p[0] = p[1]
+        # Each format code is written out separately, since column formats
+        # depend on the device position left by the preceding codes
+        fmt = p[len(p)-1]
+        fmt = tree.LiteralNode(fmt) if isinstance(fmt, str) else fmt
+        p[0] = p[1] + (fmt,) if len(p) == 3 else (fmt,)
 
     def p_format_newline(self, p):
         """format_newline : format_newline OR
@@ -954,12 +1169,8 @@ class MUMPSParser:
     def p_format_column(self, p):
         """format_column : format_column PATTERN expression
                          | PATTERN expression"""
-        off = int(p[2].as_number()) if len(p) == 3 else int(p[3].as_number())
-        x_pos = lambda env=self.env: self.env.device_x()
-
-        p[0] = mumpy.MUMPSExpression(
-            lambda c=off, x=x_pos: " " * (c-x()) if c > x() else ""
-        )
+        off = p[2] if len(p) == 3 else p[3]
+        p[0] = tree.ColumnNode(off)
 
     ###################
     # GENERIC DEFS
@@ -987,10 +1198,15 @@ class MUMPSParser:
                       | numeric_op
                       | expression_parens
                       | local_var
+                      | global_var
                       | function_call
                       | intrinsic_func
                       | special_var"""
-        p[0] = mumpy.MUMPSExpression(p[1])
+        # Variables used in an expression evaluate to their value
+        if isinstance(p[1], tree.VariableNode):
+            p[0] = tree.ValueNode(p[1])
+        else:
+            p[0] = p[1]
 
     def p_expression_parens(self, p):
         """expression_parens : LPAREN expression RPAREN"""
@@ -1007,7 +1223,7 @@ class MUMPSParser:
         else:
             v = p[1][1:]
 
-        p[0] = mumpy.MUMPSExpression(v)
+        p[0] = tree.LiteralNode(v)
 
     def p_numeric_op(self, p):
         """numeric_op : numeric
@@ -1024,15 +1240,18 @@ class MUMPSParser:
         """numeric : NUMBER
                    | uplus
                    | uminus"""
-        p[0] = mumpy.MUMPSExpression(p[1])
+        if isinstance(p[1], tree.MUMPSNode):
+            p[0] = p[1]
+        else:
+            p[0] = tree.LiteralNode(p[1])
 
     def p_string_concat(self, p):
         """string_concat : expression CONCAT expression"""
-        p[0] = mumpy.MUMPSExpression(p[1]).concat(p[3])
+        p[0] = tree.BinaryNode('CONCAT', p[1], p[3])
 
     def p_identifier(self, p):
         """identifier : SYMBOL"""
-        p[0] = mumpy.MUMPSIdentifier(p[1], self.env)
+        p[0] = p[1]
 
     def p_tag(self, p):
         """tag : identifier LPAREN func_sub_argument_list RPAREN
@@ -1049,18 +1268,18 @@ class MUMPSParser:
         """local_var : identifier LPAREN argument_list RPAREN
                      | identifier"""
         if len(p) == 5:
-            p[0] = mumpy.MUMPSIdentifier(p[1], self.env, subscripts=p[3])
+            p[0] = tree.VariableNode(p[1], subscripts=p[3])
         else:
-            p[0] = mumpy.MUMPSIdentifier(p[1], self.env)
+            p[0] = tree.VariableNode(p[1])
 
     def p_global_var(self, p):
         """global_var : routine_global LPAREN argument_list RPAREN
                       | routine_global"""
-        #if len(p) == 5:
-        #    p[0] = mumpy.MUMPSIdentifier(p[0], self.env, subscripts=p[3])
-        #else:
-        #    p[0] = mumpy.MUMPSIdentifier(p[1], self.env)
-        pass
+        name = "^{}".format(p[1])
+        if len(p) == 5:
+            p[0] = tree.VariableNode(name, subscripts=p[3])
+        else:
+            p[0] = tree.VariableNode(name)
 
     ###################
     # INTRINSICS
@@ -1071,11 +1290,13 @@ class MUMPSParser:
                           | extract_func
                           | data_func
                           | find_func
+                          | get_func
                           | justify_func
                           | length_func
                           | name_func
                           | order_func
                           | piece_func
+                          | query_func
                           | random_func
                           | reverse_func
                           | select_func
@@ -1102,15 +1323,15 @@ class MUMPSParser:
         """ascii_func : ASCII LPAREN expression COMMA expression RPAREN
                       | ASCII LPAREN expression RPAREN"""
         which = p[5] if len(p) == 7 else None
-        p[0] = lang.intrinsic_ascii(p[3], which=which)
+        p[0] = tree.IntrinsicNode('ASCII', (p[3], which))
 
     def p_char(self, p):
         """char_func : CHAR LPAREN argument_list RPAREN"""
-        p[0] = lang.intrinsic_char(p[3])
+        p[0] = tree.IntrinsicNode('CHAR', (p[3],))
 
     def p_data(self, p):
         """data_func : DATA LPAREN variable RPAREN"""
-        p[0] = lang.intrinsic_data(p[3], self.env)
+        p[0] = tree.IntrinsicNode('DATA', (p[3],))
 
     def p_extract(self, p):
         """extract_func : EXTRACT LPAREN expression COMMA expression COMMA expression RPAREN
@@ -1119,63 +1340,72 @@ class MUMPSParser:
         l = len(p)
         low = p[5] if l >= 7 else None
         high = p[7] if l == 9 else None
-        p[0] = lang.intrinsic_extract(p[3], low=low, high=high)
+        p[0] = tree.IntrinsicNode('EXTRACT', (p[3], low, high))
 
     def p_find(self, p):
         """find_func : FIND LPAREN expression COMMA expression COMMA expression RPAREN
                      | FIND LPAREN expression COMMA expression RPAREN"""
         start = p[7] if len(p) == 9 else None
-        p[0] = lang.intrinsic_find(p[3], p[5], start=start)
+        p[0] = tree.IntrinsicNode('FIND', (p[3], p[5], start))
+
+    def p_get(self, p):
+        """get_func : GET LPAREN variable COMMA expression RPAREN
+                    | GET LPAREN variable RPAREN"""
+        default = p[5] if len(p) == 7 else None
+        p[0] = tree.IntrinsicNode('GET', (p[3], default))
 
     def p_justify(self, p):
         """justify_func : justify_token LPAREN expression COMMA expression COMMA expression RPAREN
                         | justify_token LPAREN expression COMMA expression RPAREN"""
         ndec = p[7] if len(p) == 9 else None
-        p[0] = lang.intrinsic_justify(p[3], int(p[5].as_number()), ndec)
+        p[0] = tree.IntrinsicNode('JUSTIFY', (p[3], p[5], ndec))
 
     def p_length(self, p):
         """length_func : LENGTH LPAREN expression COMMA expression RPAREN
                        | LENGTH LPAREN expression RPAREN"""
         char = p[5] if len(p) == 7 else None
-        p[0] = lang.intrinsic_length(p[3], char=char)
+        p[0] = tree.IntrinsicNode('LENGTH', (p[3], char))
 
     def p_name(self, p):
         """name_func : NAME LPAREN identifier RPAREN"""
-        p[0] = mumpy.MUMPSExpression(
-            lambda v=p[3]: str(v)
-        )
+        p[0] = tree.IntrinsicNode('NAME', (tree.VariableNode(p[3]),))
 
     def p_order(self, p):
         """order_func : ORDER LPAREN variable COMMA expression RPAREN
                       | ORDER LPAREN variable RPAREN"""
         rev = p[5] if len(p) == 7 else None
-        p[0] = lang.intrinsic_order(p[3], self.env, rev=rev)
+        p[0] = tree.IntrinsicNode('ORDER', (p[3], rev))
 
     def p_piece(self, p):
-        """piece_func : piece_token LPAREN expression COMMA expression COMMA expression RPAREN
+        """piece_func : piece_token LPAREN expression COMMA expression COMMA expression COMMA expression RPAREN
+                      | piece_token LPAREN expression COMMA expression COMMA expression RPAREN
                       | piece_token LPAREN expression COMMA expression RPAREN"""
-        pnum = p[7] if len(p) == 9 else None
-        p[0] = lang.intrinsic_piece(p[3], p[5], num=pnum)
+        l = len(p)
+        low = p[7] if l >= 9 else None
+        high = p[9] if l == 11 else None
+        p[0] = tree.IntrinsicNode('PIECE', (p[3], p[5], low, high))
+
+    def p_query(self, p):
+        """query_func : QUERY LPAREN variable RPAREN"""
+        p[0] = tree.IntrinsicNode('QUERY', (p[3],))
 
     def p_random(self, p):
         """random_func : RANDOM LPAREN expression RPAREN"""
-        p[0] = lang.intrinsic_random(p[3])
+        p[0] = tree.IntrinsicNode('RANDOM', (p[3],))
 
     def p_reverse(self, p):
         """reverse_func : REVERSE LPAREN expression RPAREN"""
-        p[0] = mumpy.MUMPSExpression(
-            lambda v=p[3]: str(v)[::-1]
-        )
+        p[0] = tree.IntrinsicNode('REVERSE', (p[3],))
 
     def p_select(self, p):
         """select_func : SELECT LPAREN sel_argument_list RPAREN"""
-        p[0] = lang.intrinsic_select(p[3])
+        p[0] = tree.IntrinsicNode('SELECT', (p[3],))
 
     def p_translate(self, p):
         """translate_func : TRANSLATE LPAREN expression COMMA expression COMMA expression RPAREN
                           | TRANSLATE LPAREN expression COMMA expression RPAREN"""
         newexpr = p[7] if len(p) == 9 else None
-        p[0] = lang.intrinsic_translate(p[3], p[5], newexpr=newexpr)
+        p[0] = tree.IntrinsicNode('TRANSLATE', (p[3], p[5], newexpr))
 
     ###################
     # SPECIAL VARIABLES
@@ -1186,6 +1416,8 @@ class MUMPSParser:
                        | job_var
                        | principal_var
                        | test_var
+                       | tlevel_var
+                       | trestart_var
                        | x_var
                        | y_var
                        | z_job"""
@@ -1193,167 +1425,161 @@ class MUMPSParser:
 
     def p_horolog(self, p):
         """horolog_var : HOROLOG"""
-        p[0] = lang.horolog()
+        p[0] = tree.SpecialVarNode('HOROLOG')
 
     def p_io_var(self, p):
         """io_var : DOLLARIO"""
-        p[0] = self.env.current_device()
+        p[0] = tree.SpecialVarNode('IO')
 
     def p_job_var(self, p):
         """job_var : DOLLARJ
                    | JUSTIFY_DOLLARJ"""
-        p[0] = lang.current_job()
+        p[0] = tree.SpecialVarNode('JOB')
 
     def p_principal_var(self, p):
         """principal_var : PIECE_PRINCIPAL
                          | PRINCIPAL"""
-        p[0] = self.env.default_device()
+        p[0] = tree.SpecialVarNode('PRINCIPAL')
 
     def p_test_var(self, p):
         """test_var : TEST_TEXT
                     | TEST"""
-        p[0] = mumpy.MUMPSExpression(self.env.get("$T"))
+        p[0] = tree.SpecialVarNode('TEST')
+
+    def p_tlevel_var(self, p):
+        """tlevel_var : DOLLARTL"""
+        p[0] = tree.SpecialVarNode('TLEVEL')
+
+    def p_trestart_var(self, p):
+        """trestart_var : DOLLARTRE"""
+        p[0] = tree.SpecialVarNode('TRESTART')
 
     def p_x_var(self, p):
         """x_var : DOLLARX"""
-        p[0] = mumpy.MUMPSExpression(lambda env=self.env: env.device_x())
+        p[0] = tree.SpecialVarNode('X')
 
     def p_y_var(self, p):
         """y_var : DOLLARY"""
-        p[0] = mumpy.MUMPSExpression(lambda env=self.env: env.device_y())
+        p[0] = tree.SpecialVarNode('Y')
 
     def p_z_job(self, p):
         """z_job : ZJOB"""
-        p[0] = mumpy.MUMPSExpression(lambda env=self.env: env.get("$ZJ"))
+        p[0] = tree.SpecialVarNode('ZJOB')
 
     ###################
     # LOGIC
     ###################
     def p_not_expr(self, p):
         """not_expr : NOT expression"""
-        p[0] = ~p[2]
+        p[0] = tree.UnaryNode('NOT', p[2])
 
     def p_and_expr(self, p):
         """and_expr : expression AND expression"""
-        p[0] = p[1] & p[3]
+        p[0] = tree.BinaryNode('AND', p[1], p[3])
 
     def p_not_and_expr(self, p):
         """not_and_expr : expression NOT AND expression"""
-        p[0] = ~ (p[1] & p[4])
+        p[0] = tree.UnaryNode('NOT', tree.BinaryNode('AND', p[1], p[4]))
 
     def p_or_expr(self, p):
         """or_expr : expression OR expression"""
-        p[0] = p[1] | p[3]
+        p[0] = tree.BinaryNode('OR', p[1], p[3])
 
     def p_not_or_expr(self, p):
         """not_or_expr : expression NOT OR expression"""
-        p[0] = ~ (p[1] | p[4])
+        p[0] = tree.UnaryNode('NOT', tree.BinaryNode('OR', p[1], p[4]))
 
     ###################
     # COMPARISON
     ###################
     def p_greater_than(self, p):
         """gt_expr : expression GREATER_THAN expression"""
-        p[0] = p[1] > p[3]
+        p[0] = tree.BinaryNode('GREATER_THAN', p[1], p[3])
 
     def p_not_greater_than(self, p):
         """not_gt_expr : expression NOT GREATER_THAN expression"""
-        p[0] = ~ (p[1] > p[4])
+        p[0] = tree.UnaryNode('NOT', tree.BinaryNode('GREATER_THAN', p[1],
+                                                  p[4]))
 
     def p_less_than(self, p):
         """lt_expr : expression LESS_THAN expression"""
-        p[0] = p[1] < p[3]
+        p[0] = tree.BinaryNode('LESS_THAN', p[1], p[3])
 
     def p_not_less_than(self, p):
         """not_lt_expr : expression NOT LESS_THAN expression"""
-        p[0] = ~ (p[1] < p[4])
+        p[0] = tree.UnaryNode('NOT', tree.BinaryNode('LESS_THAN', p[1], p[4]))
 
     def p_equal_to(self, p):
         """equals_expr : expression EQUALS expression"""
-        p[0] = p[1] == p[3]
+        p[0] = tree.BinaryNode('EQUALS', p[1], p[3])
 
     def p_not_equal_to(self, p):
         """not_equals_expr : expression NOT EQUALS expression"""
-        p[0] = p[1] != p[4]
+        p[0] = tree.UnaryNode('NOT', tree.BinaryNode('EQUALS', p[1], p[4]))
 
     def p_follows(self, p):
         """follows_expr : expression FOLLOWS expression"""
-        p[0] = mumpy.MUMPSExpression(p[1]).follows(p[3])
+        p[0] = tree.BinaryNode('FOLLOWS', p[1], p[3])
 
     def p_not_follows(self, p):
         """not_follows_expr : expression NOT FOLLOWS expression"""
-        p[0] = ~mumpy.MUMPSExpression(p[1]).follows(p[4])
+        p[0] = tree.UnaryNode('NOT', tree.BinaryNode('FOLLOWS', p[1], p[4]))
 
     def p_sorts_after(self, p):
         """sorts_after_expr : expression FOLLOWS FOLLOWS expression"""
-        p[0] = mumpy.MUMPSExpression(p[1]).sorts_after(p[4])
+        p[0] = tree.BinaryNode('SORTS_AFTER', p[1], p[4])
 
     def p_not_sorts_after(self, p):
         """not_sorts_after_expr : expression NOT FOLLOWS FOLLOWS expression"""
-        p[0] = ~mumpy.MUMPSExpression(p[1]).sorts_after(p[5])
+        p[0] = tree.UnaryNode('NOT', tree.BinaryNode('SORTS_AFTER', p[1],
+                                                  p[5]))
 
     def p_contains(self, p):
         """contains_expr : expression CONTAINS expression"""
-        p[0] = mumpy.MUMPSExpression(p[1]).contains(p[3])
+        p[0] = tree.BinaryNode('CONTAINS', p[1], p[3])
 
     def p_not_contains(self, p):
         """not_contains_expr : expression NOT CONTAINS expression"""
-        p[0] = ~mumpy.MUMPSExpression(p[1]).contains(p[4])
+        p[0] = tree.UnaryNode('NOT', tree.BinaryNode('CONTAINS', p[1], p[4]))
 
     ###################
     # ARITHMETIC
     ###################
     def p_uplus(self, p):
         """uplus : PLUS expression %prec UPLUS"""
-        p[0] = +mumpy.MUMPSExpression(p[2])
+        p[0] = tree.UnaryNode('PLUS', p[2])
 
     def p_uminus(self, p):
         """uminus : MINUS expression %prec UMINUS"""
-        p[0] = -mumpy.MUMPSExpression(p[2])
+        p[0] = tree.UnaryNode('MINUS', p[2])
 
     def p_addition(self, p):
         """addition : expression PLUS expression"""
-        p[0] = p[1] + p[3]
+        p[0] = tree.BinaryNode('PLUS', p[1], p[3])
 
     def p_subtraction(self, p):
         """subtraction : expression MINUS expression"""
-        p[0] = p[1] - p[3]
+        p[0] = tree.BinaryNode('MINUS', p[1], p[3])
 
     def p_multiplication(self, p):
         """multiplication : expression TIMES expression"""
-        p[0] = p[1] * p[3]
+        p[0] = tree.BinaryNode('TIMES', p[1], p[3])
 
     def p_division(self, p):
         """division : expression DIVIDE expression"""
-        try:
-            p[0] = p[1] / p[3]
-        except ZeroDivisionError:
-            raise mumpy.MUMPSSyntaxError("Cannot divide by zero.",
-                                         err_type="DIVIDE BY ZERO")
+        p[0] = tree.BinaryNode('DIVIDE', p[1], p[3])
 
     def p_idivision(self, p):
         """idivision : expression IDIVIDE expression"""
-        try:
-            p[0] = p[1] // p[3]
-        except ZeroDivisionError:
-            raise mumpy.MUMPSSyntaxError("Cannot divide by zero.",
-                                         err_type="DIVIDE BY ZERO")
+        p[0] = tree.BinaryNode('IDIVIDE', p[1], p[3])
 
     def p_modulus(self, p):
         """modulus : expression MODULUS expression"""
-        try:
-            p[0] = p[1] % p[3]
-        except ZeroDivisionError:
-            raise mumpy.MUMPSSyntaxError("Cannot divide by zero.",
-                                         err_type="DIVIDE BY ZERO")
+        p[0] = tree.BinaryNode('MODULUS', p[1], p[3])
 
     def p_exponent(self, p):
         """exponent : expression EXPONENT expression"""
-        try:
-            p[0] = p[1] ** p[3]
-        except TypeError:
-            raise mumpy.MUMPSSyntaxError("The result is a complex number.",
-                                         err_type="COMPLEX RESULT")
+        p[0] = tree.BinaryNode('EXPONENT', p[1], p[3])
 
 
 def _cmd_params_to_dict(params):
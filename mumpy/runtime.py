@@ -0,0 +1,532 @@
+"""MUMPy Runtime
+
+The functions in this file implement MUMPS operators, intrinsic functions
+and commands on plain Python values (strings, integers and floats) rather
+than on the deferred language components in `mumpy.lang`. Routines which
+have been compiled to Python code by `mumpy.compiler` call these functions
+directly, and the language components use them for the actual computation
+of their values, so both paths share one set of semantics.
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import os
+import random
+import time
+import mumpy
+import mumpy.lang as lang
+
+
+###################
+# VALUES
+# MUMPS has a single data type (the string), but most values computed by
+# routines are numbers. Numbers are kept as Python ints and floats (or
+# MUMPSDecimals in exact arithmetic mode) until they are needed as strings.
+###################
+def value(v):
+    """Return `v` as a plain value. Values stored in the environment may
+    still be deferred expressions, which are evaluated here."""
+    t = type(v)
+    if t is str or t is int or t is float or t is lang.MUMPSDecimal:
+        return v
+    return str(v)
+
+
+def string(v):
+    """Return the MUMPS string value of `v`."""
+    return v if type(v) is str else str(v)
+
+
+def num(v):
+    """Return the canonical MUMPS numeric value of `v`."""
+    t = type(v)
+    if t is int:
+        return v
+    if t is str:
+        return lang._to_mumps_number(v)
+    if t is float:
+        if v.is_integer():
+            return int(v)
+        return lang._float_decimal(v) if lang._exact else v
+    if t is lang.MUMPSDecimal:
+        return v
+    return lang._to_mumps_number(str(v))
+
+
+def truth(v):
+    """Return True if `v` is true when interpreted as a MUMPS truth value."""
+    return num(v) != 0
+
+
+def _canonical(n):
+    """Return the canonical form of the numeric result `n`."""
+    if type(n) is float:
+        if n.is_integer():
+            return int(n)
+        if lang._exact:
+            return lang._float_decimal(n)
+    elif type(n) is complex:
+        raise lang.MUMPSSyntaxError("The result is a complex number.",
+                                    err_type="COMPLEX RESULT")
+    return n
+
+
+###################
+# OPERATORS
+###################
+def add(a, b):
+    """Return `a+b`."""
+    return _canonical(num(a) + num(b))
+
+
+def sub(a, b):
+    """Return `a-b`."""
+    return _canonical(num(a) - num(b))
+
+
+def mul(a, b):
+    """Return `a*b`."""
+    return _canonical(num(a) * num(b))
+
+
+def div(a, b):
+    """Return `a/b`."""
+    return _canonical(lang._divide(num(a), num(b)))
+
+
+def idiv(a, b):
+    """Return `a\\b`, truncated towards zero."""
+    return _canonical(lang._idivide(num(a), num(b)))
+
+
+def mod(a, b):
+    """Return `a#b`."""
+    return _canonical(lang._modulo(num(a), num(b)))
+
+
+def power(a, b):
+    """Return `a**b`."""
+    try:
+        return _canonical(lang._power(num(a), num(b)))
+    except ZeroDivisionError:
+        raise lang.MUMPSSyntaxError("Cannot divide by zero.",
+                                    err_type="DIVIDE BY ZERO")
+
+
+def neg(a):
+    """Return the unary negative `-a`."""
+    return -num(a)
+
+
+def and_(a, b):
+    """Return `a&b`."""
+    return int(truth(a) and truth(b))
+
+
+def or_(a, b):
+    """Return `a!b`."""
+    return int(truth(a) or truth(b))
+
+
+def not_(a):
+    """Return `'a`."""
+    return int(not truth(a))
+
+
+def gt(a, b):
+    """Return `a>b`."""
+    return int(num(a) > num(b))
+
+
+def lt(a, b):
+    """Return `a<b`."""
+    return int(num(a) < num(b))
+
+
+def eq(a, b):
+    """Return `a=b`, which compares the string values of `a` and `b`."""
+    return int(string(a) == string(b))
+
+
+def concat(a, b):
+    """Return `a_b`."""
+    return string(a) + string(b)
+
+
+def contains(a, b):
+    """Return `a[b`."""
+    return int(string(b) in string(a))
+
+
+def follows(a, b):
+    """Return `a]b`. Comparing strings by code point is the same as
+    comparing their UTF-8 encodings byte by byte."""
+    return int(string(a) > string(b))
+
+
+def sorts_after(a, b):
+    """Return `a]]b`, comparing the operands in the collation order of
+    subscripts."""
+    key = mumpy.storage.subscript_key
+    return int(key(string(a)) > key(string(b)))
+
+
+###################
+# INTRINSIC FUNCTIONS
+# Optional arguments which were not given are passed as None.
+###################
+def ascii(s, which=None):
+    """Return the ordinal of the `which`th character of `s` (or the first
+    character), or -1 if there is no such character."""
+    s = string(s)
+    i = 1 if which is None else int(num(which))
+    return ord(s[i-1]) if 0 < i <= len(s) else -1
+
+
+def char(*codes):
+    """Return the string of characters given by the ordinals in `codes`."""
+    return "".join(chr(int(num(c))) for c in codes)
+
+
+def data(env, ident):
+    """Return the `$DATA` value of the variable given by `ident`."""
+    if ident not in env:
+        return 0
+    return num(env.get(ident, get_var=True).data(ident))
+
+
+def extract(s, low=None, high=None):
+    """Return the first character of `s`, the character at index `low`, or
+    the substring from `low` to `high` (1 indexed and inclusive)."""
+    s = string(s)
+    if low is None:
+        return s[:1]
+
+    low = int(num(low)) - 1
+    if high is None:
+        return s[low] if 0 <= low < len(s) else ""
+
+    high = int(num(high))
+    if low > high or low < 0:
+        return ""
+    return s[low:high]
+
+
+def find(s, search, start=None):
+    """Return the index after the first occurrence of `search` in `s`, at
+    or after `start` if it is given, or 0 if `search` does not occur."""
+    search = string(search)
+    start = None if start is None else int(num(start))
+    try:
+        return string(s).index(search, start) + len(search) + 1
+    except ValueError:
+        return 0
+
+
+def get_defined(env, ident, default=None):
+    """Return the value of the variable given by `ident` if it has one,
+    otherwise `default` (or null)."""
+    if data(env, ident) % 10:
+        return get(env, ident)
+    return "" if default is None else default
+
+
+def justify(s, rspace, ndec=None):
+    """Right justify `s` in a field of `rspace` characters. If `ndec` is
+    given, `s` is treated as a number rounded (or zero padded) to `ndec`
+    decimal places."""
+    if ndec is not None:
+        ndec = int(num(ndec))
+        n = round(num(s), ndec)
+        s = str(n)
+        dec = len(s.split(".")[1]) if "." in s else 0
+        if ndec > 0 and dec < ndec:
+            s = "{}{}{}".format(s, "" if dec else ".", "0" * (ndec - dec))
+    return string(s).rjust(int(num(rspace)))
+
+
+def length(s, char=None):
+    """Return the length of `s` or, if `char` is given, the number of
+    occurrences of `char` in `s`."""
+    if char is None:
+        return len(string(s))
+    return string(s).count(string(char))
+
+
+def order(env, ident, rev=None):
+    """Return the next (or previous, if `rev` is -1) subscript after the
+    last subscript of `ident`, or null if there is none."""
+    rev = 1 if rev is None else num(rev)
+    var = env.get(ident, get_var=True)
+    if not isinstance(var, (lang.MUMPSLocalVariable, mumpy.MUMPSGlobal)):
+        return ""
+    return value(var.order(ident, rev=rev))
+
+
+def query(env, ident):
+    """Return the reference to the next node with a value after `ident`, or
+    null if there is none."""
+    return env.query(ident)
+
+
+# The string most recently split into pieces by `$PIECE`, its delimiter
+# and the list of its pieces, so that a loop over the pieces of a record
+# splits it only once
+_split = ["", None, [""]]
+
+
+def _pieces(s, delim):
+    """Return the list of the pieces of `s` delimited by `delim`, which
+    must not be modified."""
+    if s == _split[0] and delim == _split[1]:
+        return _split[2]
+    pieces = s.split(delim)
+    _split[0], _split[1], _split[2] = s, delim, pieces
+    return pieces
+
+
+def piece(s, delim, low=None, high=None):
+    """Return the `low`th (or first) piece of `s` delimited by `delim`, or
+    the pieces `low` through `high` (with their delimiters) if `high` is
+    given."""
+    s, delim = string(s), string(delim)
+    low = 1 if low is None else int(num(low))
+    if high is None:
+        # The first piece needs no split
+        if low == 1:
+            i = s.find(delim)
+            return s if i < 0 else s[:i]
+        high = low
+    else:
+        high = int(num(high))
+
+    if delim == "" or high < low or high < 1:
+        return ""
+    pieces = _pieces(s, delim)
+    if low == high:
+        return pieces[low-1] if low <= len(pieces) else ""
+    return delim.join(pieces[max(low, 1)-1:high])
+
+
+def rand(n):
+    """Return a random integer in the range given by `n`."""
+    n = int(num(n))
+    if n < 1:
+        raise lang.MUMPSSyntaxError("RANDOM argument less than 1.",
+                                    err_type="RANDARGNEG")
+    return random.randint(0, n)
+
+
+def reverse(s):
+    """Return the characters of `s` in reverse order."""
+    return string(s)[::-1]
+
+
+def select_error():
+    """Raise the error for a `$SELECT` with no true argument."""
+    raise lang.MUMPSSyntaxError("No select arguments evaluated true.",
+                                err_type="SELECTFALSE")
+
+
+def translate(s, trexpr, newexpr=None):
+    """Delete each character of `trexpr` from `s`, or replace it with the
+    character at the same position in `newexpr` where there is one."""
+    trexpr = string(trexpr)
+    newmap = "" if newexpr is None else string(newexpr)
+    trmap = dict()
+    for i, c in enumerate(trexpr):
+        trmap[ord(c)] = ord(newmap[i]) if i < len(newmap) else None
+    return string(s).translate(trmap)
+
+
+###################
+# SPECIAL VARIABLES
+###################
+def horolog():
+    """Return the `$HOROLOG` value."""
+    return lang._horolog()
+
+
+def job():
+    """Return the `$JOB` value, which is the current process ID."""
+    return os.getpid()
+
+
+###################
+# SYMBOLS
+###################
+def ident(name, *subscripts):
+    """Return an identifier for the variable `name` with the given
+    subscripts. Identifiers only name a variable and so can be shared
+    between environments."""
+    subs = lang.MUMPSArgumentList.from_items(subscripts) if subscripts else None
+    return lang.MUMPSIdentifier(name, None, subscripts=subs)
+
+
+def pointer(name):
+    """Return an identifier which passes `name` by reference."""
+    return lang.MUMPSPointerIdentifier(name, None)
+
+
+def get(env, ident):
+    """Return the value of the variable given by `ident`."""
+    subs = ident.subscripts()
+    if subs is not None and "" in (string(s) for s in subs):
+        raise lang.MUMPSSyntaxError("Null subscript given for identifier.",
+                                    err_type="NULL SUBSCRIPT")
+    return value(env.get(ident))
+
+
+def test(env):
+    """Return the value of `$TEST` as a truth value."""
+    return truth(env.get("$T"))
+
+
+def if_test(env, t):
+    """Set `$TEST` from the truth value `t` and return `t`."""
+    env.set("$T", lang.mumps_true() if t else lang.mumps_false())
+    return t
+
+
+###################
+# COMMANDS
+###################
+def fail(msg, err_type):
+    """Raise a MUMPS syntax error with the given message and type."""
+    raise lang.MUMPSSyntaxError(msg, err_type=err_type)
+
+
+def for_values(start, inc=None, end=None, others=()):
+    """Generate the values taken by a `FOR` control variable given the
+    `start:inc:end` range, followed by any other listed values."""
+    if inc is None:
+        yield start
+    else:
+        v, inc = num(start), num(inc)
+        if end is None:
+            while True:
+                yield v
+                v = _canonical(v + inc)
+        else:
+            end = num(end)
+            while v <= end if inc >= 0 else v >= end:
+                yield v
+                v = _canonical(v + inc)
+
+    yield from others
+
+
+def set_piece(env, ident, v, delim, low=None, high=None):
+    """Replace the `low`th (or first) piece of the variable `ident`
+    delimited by `delim`, or the pieces `low` through `high`, with `v` (the
+    `SET $PIECE` form). Missing pieces are added as null pieces."""
+    delim = string(delim)
+    low = 1 if low is None else int(num(low))
+    high = low if high is None else int(num(high))
+    if delim == "" or high < low or high < 1:
+        return
+
+    # Rebuild the value from its pieces in one join
+    v = string(v)
+    pieces = string(get_defined(env, ident)).split(delim)
+    if len(pieces) < low:
+        pieces.extend([""] * (low - 1 - len(pieces)))
+        pieces.append(v)
+    else:
+        pieces[max(low, 1)-1:high] = [v]
+    s = delim.join(pieces)
+    env.set(ident, s)
+
+    # The pieces are those of the new value unless `v` was delimited
+    if delim not in v:
+        _split[0], _split[1], _split[2] = s, delim, pieces
+
+
+def set_extract(env, ident, v, low=None, high=None):
+    """Replace the character of the variable `ident` at index `low` (or the
+    first), or the characters from `low` to `high`, with `v` (the
+    `SET $EXTRACT` form). A value too short is padded with spaces."""
+    low = 1 if low is None else int(num(low))
+    high = low if high is None else int(num(high))
+    if high < low or high < 1:
+        return
+
+    # Rebuild the value from its two ends in one join
+    s = string(get_defined(env, ident))
+    low = max(low, 1)
+    if len(s) < low - 1:
+        s = s.ljust(low - 1)
+    env.set(ident, "".join((s[:low-1], string(v), s[high:])))
+
+
+def column(env, offset):
+    """Return the padding which advances the current device to column
+    `offset` (the `?N` format)."""
+    c = int(num(offset))
+    x = env.device_x()
+    return " " * (c-x) if c > x else ""
+
+
+def read(env, ident, size=None, timeout=None):
+    """Read a value from the current device into `ident`."""
+    size = None if size is None else int(num(size))
+    timeout = None if timeout is None else int(num(timeout))
+    env.set(ident, env.input(size=size, timeout=timeout))
+
+
+def hang(secs):
+    """Sleep the process for `secs` seconds."""
+    time.sleep(float(num(secs)))
+
+
+def halt():
+    """Quit from the MUMPy environment."""
+    raise SystemExit(0)
+
+
+def call_site(tag, rou=None, is_func=False, nargs=None):
+    """Return the call site for a call of the function or subroutine
+    `tag^rou` with `nargs` arguments (None for no argument list) from one
+    place in a routine."""
+    return lang.MUMPSCallSite(ident(tag), rou, is_func, nargs)
+
+
+def call(env, parser, site, args=None):
+    """Call the function or subroutine of the call site `site` with the
+    argument values (or pointers) in `args` and return its result."""
+    f = site.resolve(env)
+    env.push_call(site.tag, f, site.names, args, site.is_func)
+    ret = parser._run_tag(f, site.tag, site.func, site.line)
+    env.pop_func_from_stack()
+
+    if site.is_func:
+        if ret is None:
+            raise lang.MUMPSSyntaxError("Function call did not return "
+                                        "value.",
+                                        err_type="FUNCTION NO RETURN")
+    elif ret is not None:
+        raise lang.MUMPSSyntaxError("Subroutine call returned a value.",
+                                    err_type="SUBROUTINE RETURN")
+    return ret
+
+
+def goto(env, parser, tag, rou=None):
+    """Return a function which transfers control to `tag^rou` when called
+    by the parser trampoline."""
+    f = env.get_routine(rou)
+    try:
+        _ = f.tag_line(tag)
+    except AttributeError:
+        raise lang.MUMPSSyntaxError("No current routine. Cannot GOTO "
+                                    "tag without routine.",
+                                    err_type="NO LINE")
+    except KeyError:
+        raise lang.MUMPSSyntaxError("Tag not found in current routine.",
+                                    err_type="NO LINE")
+
+    return lambda: parser._parse_tag(f, tag)
+
+
+def command(env, parser, node):
+    """Execute a command syntax tree node which has no compiled form."""
+    return mumpy.tree.bind(node, env, parser).execute()
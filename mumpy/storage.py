@@ -0,0 +1,1918 @@
+"""MUMPy Global Storage
+
+MUMPS globals (variables whose names begin with a `^`) persist outside of
+any one process. MUMPy stores every global node in a single database file,
+which holds a B+tree of fixed size pages keyed by the global name and node
+subscripts. Keys are encoded so that comparing them byte by byte gives the
+MUMPS collation order, so each lookup, insertion and deletion only touches
+one page per level of the tree and `$ORDER` is a seek to the next key.
+
+The database file is memory mapped. Leaf pages which have not been
+modified are read in place from the mapping and only the values which are
+returned are copied out and decoded, so walking a large global does not
+decode every node it passes.
+
+Every change to a global is first appended to a write-ahead journal, which
+is committed to disk in groups (every so many records or milliseconds)
+rather than once per change. Modified pages are held in memory and are only
+written to the database file at a checkpoint, which happens whenever too
+many pages have been modified and when the store is closed. A checkpoint
+first writes the new page images to the journal, so a checkpoint cut short
+by a crash can be completed when the store is next opened; the changes
+journaled after the last checkpoint are then replayed.
+
+A store may be shared with other processes using the same database file
+(such as the processes started by `JOB` commands). A shared store locks the
+journal file while it reads the database and locks it exclusively while it
+changes it, and checkpoints each batch of changes before unlocking it. Every
+checkpoint counts a commit in the header page, so a process which finds the
+count changed when it next locks the file discards the pages it has cached.
+Locks only make each read and each batch of changes atomic; processes which
+must read a node and then change it without interference should use `LOCK`
+or a transaction. A transaction which began before another process committed
+repeats its reads when it commits, with the file locked, and conflicts if
+any of them now gives a different result.
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import atexit
+import bisect
+import collections
+import collections.abc
+import contextlib
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+import blist
+import mumpy
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+# Default database file, in the current directory like routine files
+_default_path = 'mumpy.db'
+
+# Size of each page in the database file, in bytes
+_page_size = 8192
+
+# Number of unmodified pages held in the page cache of each store, and the
+# number of modified pages held before a checkpoint
+_cache_pages = 2048
+
+# Journal records written before the journal is committed
+_commit_records = 1000
+
+# Milliseconds after which written journal records are committed
+_commit_interval = 100
+
+# Longest encoded key (global name and subscripts) which may be stored
+_max_key = 1024
+
+# Longest value stored in a leaf page; longer values are stored in a chain
+# of overflow pages
+_max_inline = 1024
+
+# Minimum number of pages by which the database file grows when it is full;
+# larger files grow by a quarter of their size
+_grow_pages = 256
+
+# Open stores, by absolute path
+_stores = {}
+
+
+def database_path(path=None):
+    """Return the absolute path of the database file `path`, or of the
+    default database file if no path is given."""
+    return os.path.abspath(_default_path if path is None else path)
+
+
+def open_store(path=None, commit_records=None, commit_interval=None,
+               shared=False):
+    """Return the global store for the database file `path`, opening (or
+    creating) it if it is not already open in this process. The journal of
+    the store is committed every `commit_records` records or every
+    `commit_interval` milliseconds, whichever comes first. If `shared` is
+    True, the store is shared with other processes using the file."""
+    path = database_path(path)
+    try:
+        store = _stores[path]
+    except KeyError:
+        store = MUMPSGlobalStore(
+            path,
+            commit_records=(_commit_records if commit_records is None
+                            else commit_records),
+            commit_interval=(_commit_interval if commit_interval is None
+                             else commit_interval),
+            shared=shared,
+        )
+        _stores[path] = store
+        return store
+
+    if shared:
+        store.share()
+    return store
+
+
+def close_store(path=None):
+    """Flush and close the global store for the database file `path`, if
+    it is open in this process."""
+    store = _stores.pop(database_path(path), None)
+    if store is not None:
+        store.close()
+
+
+@atexit.register
+def close_stores():
+    """Flush and close every open global store."""
+    for path in list(_stores):
+        _stores.pop(path).close()
+
+
+###################
+# COLLATION
+# Global nodes are stored under byte string keys made from the global name
+# (terminated by a zero byte) followed by each subscript. Subscripts collate
+# in MUMPS order: canonical numbers first, in numeric order, then all other
+# strings in code point order. Each subscript is encoded as a type byte and
+# a payload with a terminator, so no encoded subscript is a prefix of
+# another and the keys of every descendant of a node begin with the key of
+# that node.
+#
+# Numbers are encoded as a decimal exponent and their significant digits,
+# complemented for negative numbers so that larger magnitudes sort first.
+# Exponents are two bytes; the few numbers with more digits than that can
+# count (only ever seen in local arrays, as global keys are far shorter)
+# have the first or last two byte value followed by a four byte exponent,
+# so they collate before or after all of the others.
+# Strings are UTF-8 with zero bytes escaped as 00 FF and end with 00 01.
+#
+# Local arrays are ordered by the same encoding of each subscript, so local
+# and global subscripts always collate alike.
+###################
+_NEGATIVE = 0x10
+_ZERO = 0x11
+_POSITIVE = 0x12
+_STRING = 0x20
+
+_exponent = struct.Struct('>H')
+_exponent_bias = 0x8000
+_wide_exponent = struct.Struct('>I')
+_wide_exponent_bias = 0x80000000
+
+_canonical_number = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]*[1-9])?\Z')
+_positive_integer = re.compile(r'[1-9][0-9]*\Z')
+
+
+def encode_key(name, subscripts=(), max_key=_max_key):
+    """Return the key for the node of global `name` (without the `^`) with
+    the given subscript strings, which may be no longer than `max_key`
+    bytes (if it is not None)."""
+    key = bytearray(name.encode('utf-8'))
+    key.append(0)
+    for sub in subscripts:
+        _encode_subscript(key, sub)
+
+    if max_key is not None and len(key) > max_key:
+        raise mumpy.MUMPSSyntaxError("Global subscripts exceed the maximum "
+                                     "key length.", err_type="KEY TOO LONG")
+    return bytes(key)
+
+
+def subscript_key(sub):
+    """Return the collation key of the subscript string `sub`, which is its
+    encoding in global keys. Collation keys compare byte by byte in MUMPS
+    collation order. The null subscript (which holds the value of a node
+    in a local array) has the empty key, which collates first."""
+    if sub == "":
+        return b""
+    key = bytearray()
+    _encode_subscript(key, sub)
+    return bytes(key)
+
+
+def is_canonical_number(sub):
+    """Return True if the subscript string `sub` is a canonical number,
+    which collates as a number rather than as a string."""
+    return _canonical_number.match(sub) is not None and sub != "-0"
+
+
+def _merged_key(dst, src, key, max_key=_max_key):
+    """Return the key beneath `dst` for the copy of the key `key` beneath
+    `src`, which may be no longer than `max_key` bytes (if it is not
+    None)."""
+    key = dst + key[len(src):]
+    if max_key is not None and len(key) > max_key:
+        raise mumpy.MUMPSSyntaxError("Global subscripts exceed the maximum "
+                                     "key length.", err_type="KEY TOO LONG")
+    return key
+
+
+def decode_subscripts(key):
+    """Return the global name and the list of subscript strings for the
+    node stored under `key`."""
+    end = key.index(0)
+    return key[:end].decode('utf-8'), list(_relative_subscripts(key, end+1))
+
+
+def _relative_subscripts(key, pos):
+    """Return the tuple of subscript strings encoded in `key` from `pos`."""
+    subs = []
+    while pos < len(key):
+        sub, pos = _decode_subscript(key, pos)
+        subs.append(sub)
+    return tuple(subs)
+
+
+def _encode_subscript(key, sub):
+    """Append the encoding of the subscript string `sub` to `key`."""
+    if sub == "":
+        raise mumpy.MUMPSSyntaxError("Null subscript given for identifier.",
+                                     err_type="NULL SUBSCRIPT")
+
+    # Positive integers are the most common subscripts by far
+    if (len(sub) + _exponent_bias < 0xFFFF and
+            _positive_integer.match(sub) is not None):
+        key.append(_POSITIVE)
+        key.extend(_exponent.pack(len(sub) + _exponent_bias))
+        key.extend(sub.rstrip('0').encode('ascii'))
+        key.append(0x00)
+        return
+
+    if _canonical_number.match(sub) is None or sub == "-0":
+        key.append(_STRING)
+        key.extend(sub.encode('utf-8').replace(b'\x00', b'\x00\xff'))
+        key.extend(b'\x00\x01')
+        return
+
+    neg = sub.startswith('-')
+    ipart, _, fpart = sub.lstrip('-').partition('.')
+    ipart = ipart.lstrip('0')
+    if ipart:
+        exp = len(ipart)
+    else:
+        exp = len(fpart.lstrip('0')) - len(fpart)
+    digits = (ipart + fpart).strip('0')
+
+    if not digits:
+        key.append(_ZERO)
+    elif neg:
+        key.append(_NEGATIVE)
+        key.extend(0xFF - b for b in _pack_exponent(exp))
+        key.extend(0xFF - d for d in digits.encode('ascii'))
+        key.append(0xFF)
+    else:
+        key.append(_POSITIVE)
+        key.extend(_pack_exponent(exp))
+        key.extend(digits.encode('ascii'))
+        key.append(0x00)
+
+
+def _pack_exponent(exp):
+    """Return the encoding of the decimal exponent `exp` of a number."""
+    biased = exp + _exponent_bias
+    if 0 < biased < 0xFFFF:
+        return _exponent.pack(biased)
+    return (_exponent.pack(0 if biased <= 0 else 0xFFFF) +
+            _wide_exponent.pack(exp + _wide_exponent_bias))
+
+
+def _decode_subscript(key, pos):
+    """Return the subscript string encoded in `key` at `pos` and the
+    position after it."""
+    t = key[pos]
+    if t == _ZERO:
+        return "0", pos + 1
+    elif t == _STRING:
+        end = pos + 1
+        while not (key[end] == 0 and key[end+1] == 1):
+            end += 2 if key[end] == 0 else 1
+        raw = key[pos+1:end].replace(b'\x00\xff', b'\x00')
+        return raw.decode('utf-8'), end + 2
+
+    neg = t == _NEGATIVE
+    exp, start = _unpack_exponent(key, pos + 1, neg)
+    if neg:
+        end = key.index(0xFF, start)
+        digits = bytes(0xFF - d for d in key[start:end]).decode('ascii')
+    else:
+        end = key.index(0x00, start)
+        digits = key[start:end].decode('ascii')
+
+    if exp <= 0:
+        num = "0.{}{}".format("0" * -exp, digits)
+    elif exp >= len(digits):
+        num = "{}{}".format(digits, "0" * (exp - len(digits)))
+    else:
+        num = "{}.{}".format(digits[:exp], digits[exp:])
+    return "-" + num if neg else num, end + 1
+
+
+def _unpack_exponent(key, pos, neg):
+    """Return the decimal exponent encoded in `key` at `pos` (complemented
+    if its number is negative) and the position after it."""
+    biased, = _exponent.unpack_from(key, pos)
+    if neg:
+        biased = 0xFFFF - biased
+    if 0 < biased < 0xFFFF:
+        return biased - _exponent_bias, pos + 2
+
+    wide, = _wide_exponent.unpack_from(key, pos + 2)
+    if neg:
+        wide = 0xFFFFFFFF - wide
+    return wide - _wide_exponent_bias, pos + 6
+
+
+###################
+# PAGES
+# Page 0 of the database file is the header. Every other page is a B+tree
+# leaf or internal node, a page of an overflow value, or a free page.
+###################
+_MAGIC = b'MUMPYDB1'
+_FORMAT = 2
+
+_LEAF = 1
+_INTERNAL = 2
+_OVERFLOW = 3
+_FREE = 4
+
+# Magic, format, page size, root page, page count, first free page and
+# the number of commits made by processes sharing the file
+_header = struct.Struct('>8sIIIIIQ')
+
+# Node page type, entry count, next and previous leaf pages
+_node = struct.Struct('>BHII')
+
+# Leaf entry key length, overflow flag and value length
+_entry = struct.Struct('>HBI')
+
+# Internal node key length
+_keylen = struct.Struct('>H')
+
+# Page number (of a child node or an overflow page)
+_pageno = struct.Struct('>I')
+
+# Overflow page type, next overflow page and length of data in the page
+_overflow = struct.Struct('>BII')
+
+# Free page type and next free page
+_free = struct.Struct('>BI')
+
+
+class _Leaf:
+    """A B+tree leaf page. Values are stored as bytes, or as a pair of the
+    first overflow page and length for values too long to store inline.
+    Leaves are linked in key order."""
+    __slots__ = ('id', 'keys', 'values', 'next', 'prev', 'size')
+
+    def __init__(self, page, keys=None, values=None, nxt=0, prev=0):
+        self.id = page
+        self.keys = [] if keys is None else keys
+        self.values = [] if values is None else values
+        self.next = nxt
+        self.prev = prev
+        self.size = _node.size + sum(_leaf_entry_size(k, v)
+                                     for k, v in zip(self.keys, self.values))
+
+
+class _Internal:
+    """A B+tree internal page. Child `i` holds the keys from `keys[i-1]`
+    up to (but not including) `keys[i]`."""
+    __slots__ = ('id', 'keys', 'children')
+
+    def __init__(self, page, keys=None, children=None):
+        self.id = page
+        self.keys = [] if keys is None else keys
+        self.children = [] if children is None else children
+
+    @property
+    def size(self):
+        return (_node.size + _pageno.size +
+                sum(_keylen.size + len(k) + _pageno.size for k in self.keys))
+
+
+class _MappedLeaf:
+    """A B+tree leaf page read in place from the mapped database file. The
+    keys are read when the leaf is loaded, so that they can be searched,
+    but only the position of each value is; values are copied out of the
+    mapping as they are accessed. Mapped leaves are read only, and are
+    replaced by a decoded leaf (_Leaf) before they are modified."""
+    __slots__ = ('id', 'keys', 'values', 'next', 'prev')
+
+    def __init__(self, store, page):
+        m = store._map
+        pos = page * store._page_size
+        _, count, self.next, self.prev = _node.unpack_from(m, pos)
+        pos += _node.size
+
+        keys, values = [], []
+        for _ in range(count):
+            klen, flag, vlen = _entry.unpack_from(m, pos)
+            pos += _entry.size
+            keys.append(m[pos:pos+klen])
+            pos += klen
+            if flag:
+                values.append((_pageno.unpack_from(m, pos)[0], vlen))
+                pos += _pageno.size
+            else:
+                values.append(slice(pos, pos+vlen))
+                pos += vlen
+
+        self.id = page
+        self.keys = keys
+        self.values = _MappedValues(store, values)
+
+
+class _MappedValues(collections.abc.Sequence):
+    """The values of a mapped leaf, given by their positions in the mapped
+    database file of `store`. Overflow values are given as a pair of their
+    first overflow page and length, as they are in decoded leaves."""
+    __slots__ = ('_store', '_spans')
+
+    def __init__(self, store, spans):
+        self._store = store
+        self._spans = spans
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, i):
+        span = self._spans[i]
+        if type(span) is slice:
+            return self._store._map[span]
+        return span
+
+
+class _Raw:
+    """A page which is not a B+tree node (an overflow or free page), held as
+    its contents."""
+    __slots__ = ('id', 'data')
+
+    def __init__(self, page, data):
+        self.id = page
+        self.data = data
+
+
+def _leaf_entry_size(key, value):
+    """Return the number of bytes used by a leaf entry."""
+    vlen = len(value) if isinstance(value, bytes) else _pageno.size
+    return _entry.size + len(key) + vlen
+
+
+def _encode_page(node):
+    """Return the page contents for the node `node`."""
+    if isinstance(node, _Raw):
+        return node.data
+    elif isinstance(node, _Leaf):
+        out = [_node.pack(_LEAF, len(node.keys), node.next, node.prev)]
+        for k, v in zip(node.keys, node.values):
+            if isinstance(v, bytes):
+                out.append(_entry.pack(len(k), 0, len(v)))
+                out.append(k)
+                out.append(v)
+            else:
+                out.append(_entry.pack(len(k), 1, v[1]))
+                out.append(k)
+                out.append(_pageno.pack(v[0]))
+    else:
+        out = [_node.pack(_INTERNAL, len(node.keys), 0, 0),
+               _pageno.pack(node.children[0])]
+        for k, c in zip(node.keys, node.children[1:]):
+            out.append(_keylen.pack(len(k)))
+            out.append(k)
+            out.append(_pageno.pack(c))
+    return b''.join(out)
+
+
+def _decode_page(page, data):
+    """Return the node stored in the page `page` with contents `data`."""
+    t, count, nxt, prev = _node.unpack_from(data, 0)
+    pos = _node.size
+    if t == _LEAF:
+        keys, values = [], []
+        for _ in range(count):
+            klen, flag, vlen = _entry.unpack_from(data, pos)
+            pos += _entry.size
+            keys.append(bytes(data[pos:pos+klen]))
+            pos += klen
+            if flag:
+                values.append((_pageno.unpack_from(data, pos)[0], vlen))
+                pos += _pageno.size
+            else:
+                values.append(bytes(data[pos:pos+vlen]))
+                pos += vlen
+        return _Leaf(page, keys, values, nxt, prev)
+    elif t == _INTERNAL:
+        children = [_pageno.unpack_from(data, pos)[0]]
+        pos += _pageno.size
+        keys = []
+        for _ in range(count):
+            klen, = _keylen.unpack_from(data, pos)
+            pos += _keylen.size
+            keys.append(bytes(data[pos:pos+klen]))
+            pos += klen
+            children.append(_pageno.unpack_from(data, pos)[0])
+            pos += _pageno.size
+        return _Internal(page, keys, children)
+
+    raise MUMPSStorageError("Page {} is not a B+tree node.".format(page))
+
+
+###################
+# JOURNAL
+# The journal is a sequence of records, each holding a checksum, the record
+# type and two byte strings. Changes are journaled as SET (key and value)
+# and KILL (first and last key of the range) records; the changes of a
+# transaction are journaled between TSTART and TCOMMIT records and are only
+# replayed if both are present. A checkpoint writes a
+# PAGE record (page number and contents) for each page it will write to the
+# database file, followed by a CHECKPOINT record. Records are only read up
+# to the first one which is incomplete or does not match its checksum.
+###################
+_SET = 1
+_KILL = 2
+_PAGE = 3
+_CHECKPOINT = 4
+_TSTART = 5
+_TCOMMIT = 6
+
+# Checksum, record type and lengths of the two byte strings
+_record = struct.Struct('>IBII')
+
+
+class MUMPSJournal:
+    """The write-ahead journal of a global store. Records are written to the
+    journal file as they are appended, but are only forced to disk when the
+    journal is committed, which happens every `commit_records` records or
+    `commit_interval` milliseconds (if it is not 0)."""
+    def __init__(self, path, commit_records=_commit_records,
+                 commit_interval=_commit_interval):
+        self.path = path
+        self._commit_records = max(1, commit_records)
+        self._commit_interval = commit_interval / 1000
+
+        self._f = open(path, mode='a+b')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+        # Commit records left pending while no more are being appended
+        self._closed = threading.Event()
+        if self._commit_interval > 0:
+            t = threading.Thread(target=self._commit_timer, daemon=True)
+            t.start()
+
+    def __repr__(self):
+        return "MUMPSJournal({path}, {records}, {interval})".format(
+            path=self.path,
+            records=self._commit_records,
+            interval=int(self._commit_interval * 1000),
+        )
+
+    def append(self, rtype, a, b=b''):
+        """Append a record to the journal, committing the journal if enough
+        records are pending or enough time has passed."""
+        with self._lock:
+            self._write(rtype, a, b)
+            self._pending += 1
+            if (self._pending >= self._commit_records or
+                    (self._commit_interval > 0 and
+                     time.monotonic() - self._last_commit >=
+                     self._commit_interval)):
+                self._commit()
+
+    def checkpoint(self, images):
+        """Append and commit the page images of a checkpoint, a list of page
+        numbers and page contents."""
+        with self._lock:
+            for page, data in images:
+                self._write(_PAGE, _pageno.pack(page), data)
+            self._write(_CHECKPOINT, b'', b'')
+            self._pending += len(images) + 1
+            self._commit()
+
+    def commit(self):
+        """Force every record appended so far to disk."""
+        with self._lock:
+            self._commit()
+
+    def records(self):
+        """Generate the type and byte strings of each complete record in the
+        journal."""
+        with self._lock:
+            self._f.flush()
+            self._f.seek(0)
+            data = self._f.read()
+
+        pos = 0
+        while pos + _record.size <= len(data):
+            crc, rtype, alen, blen = _record.unpack_from(data, pos)
+            start = pos + _record.size
+            end = start + alen + blen
+            if end > len(data):
+                return
+            if zlib.crc32(data[pos+4:end]) & 0xFFFFFFFF != crc:
+                return
+            yield rtype, data[start:start+alen], data[start+alen:end]
+            pos = end
+
+    def reset(self):
+        """Discard every record in the journal."""
+        with self._lock:
+            self._f.flush()
+            self._f.truncate(0)
+            os.fsync(self._f.fileno())
+            self._pending = 0
+            self._last_commit = time.monotonic()
+
+    def lock(self, exclusive=True):
+        """Wait for a lock on the journal file, which the processes sharing
+        a database hold while they use it. Shared locks are only available
+        where the platform supports them; elsewhere every lock is
+        exclusive."""
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(),
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        else:
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def unlock(self):
+        """Release the lock on the journal file."""
+        if fcntl is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+        else:
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def empty(self):
+        """Return True if the journal file holds no records."""
+        with self._lock:
+            self._f.flush()
+            return os.fstat(self._f.fileno()).st_size == 0
+
+    def close(self):
+        """Commit and close the journal."""
+        self._closed.set()
+        with self._lock:
+            if not self._f.closed:
+                self._commit()
+                self._f.close()
+
+    def _write(self, rtype, a, b):
+        """Write a record to the journal file."""
+        rec = _record.pack(0, rtype, len(a), len(b))[4:] + a + b
+        self._f.write(_pageno.pack(zlib.crc32(rec) & 0xFFFFFFFF))
+        self._f.write(rec)
+
+    def _commit(self):
+        """Force the journal file to disk, if any records are pending."""
+        self._last_commit = time.monotonic()
+        if self._pending == 0:
+            return
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = 0
+
+    def _commit_timer(self):
+        """Commit pending records every commit interval until the journal is
+        closed."""
+        while not self._closed.wait(self._commit_interval):
+            with self._lock:
+                if self._f.closed:
+                    return
+                if self._pending:
+                    self._commit()
+
+
+###################
+# GLOBAL STORE
+###################
+class _GlobalNodes:
+    """Operations on global nodes, in terms of the key operations (`get`,
+    `set`, `delete_range`, `next_key` and `prev_key`) of a global store or
+    transaction. Nodes are given by the global name (without the `^`) and a
+    sequence of subscript strings. Values are always stored as strings."""
+    # The length limit of keys, which must fit in a database page
+    _max_key = _max_key
+
+    def _key(self, name, subscripts=()):
+        """Return the key of the given node."""
+        return encode_key(name, subscripts, self._max_key)
+
+    def get_node(self, name, subscripts=()):
+        """Return the value of the given node, or None if it has no value."""
+        return self.get(self._key(name, subscripts))
+
+    def set_node(self, name, subscripts, value):
+        """Set the value of the given node."""
+        self.set(self._key(name, subscripts), value)
+
+    def kill_node(self, name, subscripts=()):
+        """Delete the given node and all of its descendants."""
+        key = self._key(name, subscripts)
+        self.delete_range(key, key + b'\xff')
+
+    def exists(self, name):
+        """Return True if any node of the global `name` is defined."""
+        key = encode_key(name)
+        nxt = self.next_key(key)
+        return nxt is not None and nxt.startswith(key)
+
+    def data(self, name, subscripts=()):
+        """Return the `$DATA` value of the given node."""
+        key = self._key(name, subscripts)
+        nxt = self.next_key(key)
+        if nxt is None or not nxt.startswith(key):
+            return 0
+
+        value = int(nxt == key)
+        if value:
+            nxt = self.next_key(key + b'\x00')
+        return value + (10 if nxt is not None and nxt.startswith(key) else 0)
+
+    def order(self, name, subscripts, rev=1):
+        """Return the subscript after (or before, if `rev` is negative) the
+        last of the given subscripts at its level of the global, or null
+        if there is none. The null subscript starts from the first (or
+        last) subscript at that level."""
+        parent = self._key(name, subscripts[:-1])
+        last = subscripts[-1]
+        if last != "":
+            node = bytearray(parent)
+            _encode_subscript(node, last)
+            node = bytes(node)
+
+        if rev >= 0:
+            if last == "":
+                key = self.next_key(parent + b'\x00')
+            else:
+                key = self.next_key(node + b'\xff')
+        else:
+            if last == "":
+                key = self.prev_key(parent + b'\xff')
+            else:
+                key = self.prev_key(node)
+
+        if key is None or len(key) <= len(parent) or not key.startswith(parent):
+            return ""
+        return _decode_subscript(key, len(parent))[0]
+
+    def order_iter(self, name, subscripts, rev=1):
+        """Generate each subscript following the last of the given subscripts
+        at its level of the global (or preceding it, if `rev` is negative),
+        as repeated `order` calls would return them."""
+        subscripts = list(subscripts)
+        while True:
+            sub = self.order(name, subscripts, rev=rev)
+            if sub == "":
+                return
+            yield sub
+            subscripts[-1] = sub
+
+    def query(self, name, subscripts=()):
+        """Return the tuple of subscripts of the first node of the global
+        after the given node which has a value, in the order of a
+        depth-first walk, or None if there is none. Keys are stored in that
+        order, so this is the next key after the key of the node."""
+        prefix = encode_key(name)
+        key = self.next_key(self._key(name, subscripts) + b'\x00')
+        if key is None or not key.startswith(prefix):
+            return None
+        return _relative_subscripts(key, len(prefix))
+
+    def nodes(self, name, subscripts=()):
+        """Generate the subscripts (relative to the given node) and value of
+        the given node and each of its descendants which has a value, in
+        collation order."""
+        key = self._key(name, subscripts)
+        for k, value in self._items(key, key + b'\xff'):
+            yield _relative_subscripts(k, len(key)), value
+
+    def set_nodes(self, name, subscripts, nodes):
+        """Set each of the (relative subscripts, value) pairs `nodes` beneath
+        the given node."""
+        subscripts = tuple(subscripts)
+        for subs, value in nodes:
+            self.set_node(name, subscripts + tuple(subs), str(value))
+
+    def merge_nodes(self, name, subscripts, src_name, src_subscripts):
+        """Copy the value and descendants of the node `src_name` with the
+        subscripts `src_subscripts` beneath the given node."""
+        dst = self._key(name, subscripts)
+        src = self._key(src_name, src_subscripts)
+        for key, value in list(self._items(src, src + b'\xff')):
+            self.set(_merged_key(dst, src, key, self._max_key), value)
+
+    def _items(self, low, high):
+        """Generate each key from `low` up to (but not including) `high`
+        and its value, in order."""
+        key = self.next_key(low)
+        while key is not None and key < high:
+            yield key, self.get(key)
+            key = self.next_key(key + b'\x00')
+
+
+class _StoreLock:
+    """Holds the database file of a shared store while it is read (or, if
+    `exclusive`, changed). Locks may be nested, in which case the outermost
+    lock holds the file; an exclusive lock may not be nested in a shared
+    one. The store is brought up to date when the file is locked, and its
+    changes are checkpointed before the file is unlocked."""
+    __slots__ = ('_store', '_exclusive')
+
+    def __init__(self, store, exclusive):
+        self._store = store
+        self._exclusive = exclusive
+
+    def __enter__(self):
+        store = self._store
+        if store._lock_depth == 0:
+            journal = store._journal
+            journal.lock(self._exclusive)
+            try:
+                # Only a process holding the file exclusively may recover
+                # the changes of a process which exited while changing it
+                if not self._exclusive and not journal.empty():
+                    journal.unlock()
+                    journal.lock(True)
+                store._refresh()
+            except BaseException:
+                journal.unlock()
+                raise
+        store._lock_depth += 1
+
+    def __exit__(self, *exc):
+        store = self._store
+        store._lock_depth -= 1
+        if store._lock_depth == 0:
+            try:
+                store._publish()
+            finally:
+                store._journal.unlock()
+
+
+class MUMPSGlobalStore(_GlobalNodes):
+    """A database file of global nodes, stored in a B+tree, and its
+    write-ahead journal. If `shared` is True, the store is shared with
+    other processes using the same file."""
+    def __init__(self, path, cache_pages=_cache_pages,
+                 commit_records=_commit_records,
+                 commit_interval=_commit_interval, shared=False):
+        self.path = path
+        self._cache_pages = cache_pages
+
+        # Unmodified pages, in least recently used order, and the pages
+        # which have been modified since the last checkpoint
+        self._cache = collections.OrderedDict()
+        self._dirty = {}
+        self._map = None
+
+        # Open transactions, the number of changes made to the store and
+        # the key ranges written by each change made while any transaction
+        # was open, to check transactions for conflicts when they commit
+        self._transactions = []
+        self._version = 0
+        self._history = []
+
+        self._journal = MUMPSJournal(path + '.jnl',
+                                     commit_records=commit_records,
+                                     commit_interval=commit_interval)
+
+        # Stores which are not shared need no locks; shared stores note
+        # how deeply their locks are nested
+        self._shared = False
+        self._read_lock = self._write_lock = contextlib.nullcontext()
+        self._lock_depth = 0
+        if shared:
+            self._share()
+
+        # Shared stores are opened (or created) while the file is locked
+        with self._write_lock:
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                self._f = open(path, mode='r+b')
+                self._read_header(self._f.read(_header.size))
+                self._map_file()
+                self._recover()
+            else:
+                # A journal left without its database cannot be replayed
+                self._journal.reset()
+                self._f = open(path, mode='w+b')
+                self._page_size = _page_size
+                self._root = 1
+                self._npages = 2
+                self._free_head = 0
+                self._commits = 0
+                self._header_dirty = True
+                self._map_file()
+                self._mark(_Leaf(1))
+                self.flush()
+
+    def __repr__(self):
+        return "MUMPSGlobalStore({path}, {pages})".format(
+            path=self.path,
+            pages=self._npages,
+        )
+
+    ###################
+    # KEYS
+    ###################
+    def get(self, key):
+        """Return the value stored under `key`, or None."""
+        with self._read_lock:
+            leaf = self._find_leaf(key)
+            i = bisect.bisect_left(leaf.keys, key)
+            if i < len(leaf.keys) and leaf.keys[i] == key:
+                return self._read_value(leaf.values[i]).decode('utf-8')
+            return None
+
+    def set(self, key, value):
+        """Store the string `value` under `key`."""
+        value = str(value).encode('utf-8')
+        with self._write_lock:
+            self._journal.append(_SET, key, value)
+            self._set(key, value)
+            self._written(((key, key + b'\x00'),))
+            self._checkpoint_if_full()
+
+    def delete(self, key):
+        """Delete the value stored under `key`, if there is one."""
+        self.delete_range(key, key + b'\x00')
+
+    def delete_range(self, low, high):
+        """Delete every key from `low` up to (but not including) `high`."""
+        with self._write_lock:
+            self._journal.append(_KILL, low, high)
+            self._delete_range(low, high)
+            self._written(((low, high),))
+            self._checkpoint_if_full()
+
+    def next_key(self, key):
+        """Return the first key greater than or equal to `key`, or None."""
+        with self._read_lock:
+            _, leaf, i = self._seek(key)
+            return leaf.keys[i] if i < len(leaf.keys) else None
+
+    def prev_key(self, key):
+        """Return the last key less than `key`, or None."""
+        with self._read_lock:
+            leaf = self._find_leaf(key)
+            i = bisect.bisect_left(leaf.keys, key)
+            if i > 0:
+                return leaf.keys[i-1]
+            if leaf.prev:
+                return self._load(leaf.prev).keys[-1]
+            return None
+
+    ###################
+    # TRANSACTIONS
+    ###################
+    def begin(self):
+        """Start and return a new transaction on the store."""
+        with self._read_lock:
+            txn = MUMPSTransaction(self, self._version)
+        self._transactions.append(txn)
+        return txn
+
+    def apply(self, changes):
+        """Apply a list of changes as one batch, which is journaled and
+        committed together so that it is replayed in full or not at all.
+        Each change is a SET record type with a key and string value, or a
+        KILL record type with the first and last key of the range."""
+        with self._write_lock:
+            self._journal.append(_TSTART, b'')
+            written = []
+            for rtype, a, b in changes:
+                if rtype == _SET:
+                    b = b.encode('utf-8')
+                    self._journal.append(_SET, a, b)
+                    self._set(a, b)
+                    written.append((a, a + b'\x00'))
+                else:
+                    self._journal.append(_KILL, a, b)
+                    self._delete_range(a, b)
+                    written.append((a, b))
+            self._journal.append(_TCOMMIT, b'')
+            self._journal.commit()
+            self._written(written)
+            self._checkpoint_if_full()
+
+    def merge_nodes(self, name, subscripts, src_name, src_subscripts):
+        """Copy the value and descendants of the node `src_name` with the
+        subscripts `src_subscripts` beneath the given node. The source keys
+        are read in one pass over the leaves, and the copies are journaled
+        and committed as one batch."""
+        dst = encode_key(name, subscripts)
+        src = encode_key(src_name, src_subscripts)
+        with self._write_lock:
+            items = [(_merged_key(dst, src, key), value)
+                     for key, value in self._leaf_items(src, src + b'\xff')]
+            if not items:
+                return
+
+            self._journal.append(_TSTART, b'')
+            for key, value in items:
+                self._journal.append(_SET, key, value)
+                self._set(key, value)
+            self._journal.append(_TCOMMIT, b'')
+            self._journal.commit()
+            self._written(((dst, dst + b'\xff'),))
+            self._checkpoint_if_full()
+
+    def _items(self, low, high):
+        """Generate each key from `low` up to (but not including) `high`
+        and its value, in order. A shared store reads every item while the
+        file is locked, since other processes may change it in between."""
+        items = self._leaf_items(low, high)
+        if self._shared:
+            with self._read_lock:
+                items = list(items)
+        for key, value in items:
+            yield key, value.decode('utf-8')
+
+    def _leaf_items(self, low, high):
+        """Generate each key from `low` up to (but not including) `high`
+        and its value bytes, walking along the linked leaves."""
+        _, leaf, i = self._seek(low)
+        while True:
+            keys = leaf.keys
+            while i < len(keys):
+                if keys[i] >= high:
+                    return
+                yield keys[i], self._read_value(leaf.values[i])
+                i += 1
+            if not leaf.next:
+                return
+            leaf, i = self._load(leaf.next), 0
+
+    def _written(self, ranges):
+        """Note a change to the store which wrote the key ranges `ranges`,
+        or None if another process made it and the ranges are unknown."""
+        self._version += 1
+        if self._transactions:
+            self._history.append((self._version, ranges))
+
+    def _end(self, txn):
+        """Forget the finished transaction `txn`, and any changes which no
+        open transaction needs to check for conflicts."""
+        self._transactions.remove(txn)
+        if not self._transactions:
+            self._history = []
+            return
+
+        oldest = min(t.version for t in self._transactions)
+        while self._history and self._history[0][0] <= oldest:
+            self._history.pop(0)
+
+    ###################
+    # B+TREE
+    ###################
+    def _set(self, key, value):
+        """Store the bytes `value` under `key`."""
+        value = self._write_value(value)
+        path, leaf = self._find_path(key)
+        leaf = self._modify(leaf)
+
+        i = bisect.bisect_left(leaf.keys, key)
+        if i < len(leaf.keys) and leaf.keys[i] == key:
+            old = leaf.values[i]
+            self._free_value(old)
+            leaf.values[i] = value
+            leaf.size += (_leaf_entry_size(key, value) -
+                          _leaf_entry_size(key, old))
+        else:
+            leaf.keys.insert(i, key)
+            leaf.values.insert(i, value)
+            leaf.size += _leaf_entry_size(key, value)
+        self._mark(leaf)
+
+        if leaf.size > self._page_size:
+            self._split(path, leaf)
+
+    def _delete_range(self, low, high):
+        """Delete every key from `low` up to (but not including) `high`."""
+        while True:
+            path, leaf, i = self._seek(low)
+            n = len(leaf.keys)
+            if i >= n:
+                return
+
+            j = bisect.bisect_left(leaf.keys, high, i)
+            if j <= i:
+                return
+
+            leaf = self._modify(leaf)
+            for v in leaf.values[i:j]:
+                self._free_value(v)
+            leaf.size -= sum(_leaf_entry_size(k, v) for k, v in
+                             zip(leaf.keys[i:j], leaf.values[i:j]))
+            del leaf.keys[i:j]
+            del leaf.values[i:j]
+            self._mark(leaf)
+
+            if not leaf.keys:
+                self._remove_leaf(path, leaf)
+
+            # Stop unless the range continues into the next leaf
+            if j < n:
+                return
+
+    def _find_leaf(self, key):
+        """Return the leaf which would hold `key`."""
+        node = self._load(self._root)
+        while isinstance(node, _Internal):
+            node = self._load(node.children[bisect.bisect_right(node.keys,
+                                                                key)])
+        return node
+
+    def _find_path(self, key):
+        """Return the list of (internal node, child index) pairs on the path
+        to the leaf which would hold `key`, and that leaf."""
+        path = []
+        node = self._load(self._root)
+        while isinstance(node, _Internal):
+            i = bisect.bisect_right(node.keys, key)
+            path.append((node, i))
+            node = self._load(node.children[i])
+        return path, node
+
+    def _seek(self, key):
+        """Return the path to the leaf holding the first key greater than or
+        equal to `key`, that leaf and the index of the key in the leaf. The
+        index is past the end of the leaf if there is no such key."""
+        path, leaf = self._find_path(key)
+        i = bisect.bisect_left(leaf.keys, key)
+        if i == len(leaf.keys) and leaf.next:
+            # Leaves are never empty, so the next key is the first key of
+            # the next leaf
+            key = self._load(leaf.next).keys[0]
+            path, leaf = self._find_path(key)
+            i = bisect.bisect_left(leaf.keys, key)
+        return path, leaf, i
+
+    def _split(self, path, leaf):
+        """Split the overfull leaf `leaf`, whose ancestors are given by
+        `path`, and any ancestors which overflow as a result."""
+        # Split the leaf in half by size
+        half = (leaf.size - _node.size) // 2
+        used = 0
+        for mid, (k, v) in enumerate(zip(leaf.keys, leaf.values)):
+            used += _leaf_entry_size(k, v)
+            if used >= half:
+                break
+        mid = min(max(mid, 0) + 1, len(leaf.keys) - 1)
+
+        right = _Leaf(self._alloc(), leaf.keys[mid:], leaf.values[mid:],
+                      nxt=leaf.next, prev=leaf.id)
+        del leaf.keys[mid:]
+        del leaf.values[mid:]
+        leaf.size -= right.size - _node.size
+        if leaf.next:
+            nxt = self._modify(self._load(leaf.next))
+            nxt.prev = right.id
+            self._mark(nxt)
+        leaf.next = right.id
+        self._mark(leaf)
+        self._mark(right)
+
+        # Insert the new leaf into its parent, splitting internal nodes
+        # up the tree as they overflow
+        sep, child = right.keys[0], right.id
+        for node, i in reversed(path):
+            node.keys.insert(i, sep)
+            node.children.insert(i+1, child)
+            self._mark(node)
+            if node.size <= self._page_size:
+                return
+
+            mid = len(node.keys) // 2
+            new = _Internal(self._alloc(), node.keys[mid+1:],
+                            node.children[mid+1:])
+            sep, child = node.keys[mid], new.id
+            del node.keys[mid:]
+            del node.children[mid+1:]
+            self._mark(new)
+
+        # The root split, so the tree grows a level
+        root = _Internal(self._alloc(), [sep], [self._root, child])
+        self._mark(root)
+        self._root = root.id
+        self._header_dirty = True
+
+    def _remove_leaf(self, path, leaf):
+        """Remove the empty leaf `leaf` from the tree. Internal nodes left
+        with no children are removed as well, and the root is collapsed
+        while it has a single child. Nodes are otherwise allowed to be
+        underfull, so removals never need to move keys between nodes."""
+        if not path:
+            return
+
+        if leaf.prev:
+            prev = self._modify(self._load(leaf.prev))
+            prev.next = leaf.next
+            self._mark(prev)
+        if leaf.next:
+            nxt = self._modify(self._load(leaf.next))
+            nxt.prev = leaf.prev
+            self._mark(nxt)
+        self._free_page(leaf.id)
+
+        for node, i in reversed(path):
+            del node.children[i]
+            if node.keys:
+                del node.keys[i-1 if i > 0 else 0]
+            self._mark(node)
+            if node.children:
+                break
+            if node.id == self._root:
+                # The tree is empty again
+                self._free_page(node.id)
+                root = _Leaf(self._alloc())
+                self._mark(root)
+                self._root = root.id
+                self._header_dirty = True
+                return
+            self._free_page(node.id)
+
+        root = self._load(self._root)
+        while isinstance(root, _Internal) and len(root.children) == 1:
+            self._free_page(root.id)
+            self._root = root.children[0]
+            self._header_dirty = True
+            root = self._load(self._root)
+
+    ###################
+    # VALUES
+    ###################
+    def _write_value(self, data):
+        """Return the leaf value for `data`, writing it to a chain of
+        overflow pages if it is too long to store in a leaf."""
+        if len(data) <= _max_inline:
+            return data
+
+        chunk = self._page_size - _overflow.size
+        pages = [self._alloc() for _ in range(0, len(data), chunk)]
+        for n, page in enumerate(pages):
+            part = data[n*chunk:(n+1)*chunk]
+            nxt = pages[n+1] if n+1 < len(pages) else 0
+            self._mark(_Raw(page, _overflow.pack(_OVERFLOW, nxt,
+                                                 len(part)) + part))
+        return pages[0], len(data)
+
+    def _read_value(self, value):
+        """Return the bytes of the leaf value `value`."""
+        if isinstance(value, bytes):
+            return value
+
+        page, out = value[0], []
+        while page:
+            data = self._raw(page)
+            _, page, n = _overflow.unpack_from(data, 0)
+            out.append(data[_overflow.size:_overflow.size+n])
+        return b''.join(out)
+
+    def _free_value(self, value):
+        """Free any overflow pages used by the leaf value `value`."""
+        if isinstance(value, bytes):
+            return
+
+        page = value[0]
+        while page:
+            nxt = _overflow.unpack_from(self._raw(page), 0)[1]
+            self._free_page(page)
+            page = nxt
+
+    ###################
+    # PAGE CACHE
+    ###################
+    def _load(self, page):
+        """Return the node stored in page `page`. Leaves which have not been
+        modified are read in place from the mapped file."""
+        node = self._dirty.get(page)
+        if node is not None:
+            return node
+
+        try:
+            node = self._cache[page]
+            self._cache.move_to_end(page)
+            return node
+        except KeyError:
+            pass
+
+        if self._map[page * self._page_size] == _LEAF:
+            node = _MappedLeaf(self, page)
+        else:
+            node = _decode_page(page, self._read_page(page))
+        self._cache[page] = node
+        self._evict()
+        return node
+
+    def _modify(self, node):
+        """Return `node` in a form which can be modified, decoding it from
+        the mapped file if it was read in place."""
+        if isinstance(node, _MappedLeaf):
+            node = _decode_page(node.id, self._read_page(node.id))
+            self._cache[node.id] = node
+        return node
+
+    def _mark(self, node):
+        """Mark `node` as modified, so it is written to the file at the next
+        checkpoint."""
+        self._cache.pop(node.id, None)
+        self._dirty[node.id] = node
+
+    def _evict(self):
+        """Evict the least recently used unmodified pages while the cache is
+        full. Modified pages are only released by a checkpoint."""
+        while len(self._cache) > self._cache_pages:
+            self._cache.popitem(last=False)
+
+    def _raw(self, page):
+        """Return the current contents of page `page`."""
+        node = self._dirty.get(page)
+        if node is not None:
+            return _encode_page(node)
+        return self._read_page(page)
+
+    def _alloc(self):
+        """Return the number of an unused page."""
+        self._header_dirty = True
+        if self._free_head:
+            page = self._free_head
+            self._free_head = _free.unpack_from(self._raw(page), 0)[1]
+            return page
+
+        page = self._npages
+        self._npages += 1
+        if self._npages * self._page_size > len(self._map):
+            self._map_file()
+        return page
+
+    def _free_page(self, page):
+        """Return page `page` to the free list."""
+        self._mark(_Raw(page, _free.pack(_FREE, self._free_head)))
+        self._free_head = page
+        self._header_dirty = True
+
+    ###################
+    # FILE
+    ###################
+    def _read_header(self, data):
+        """Read the database parameters from the header page `data`."""
+        try:
+            (magic, fmt, size, root, npages, free,
+             commits) = _header.unpack_from(data)
+        except struct.error:
+            magic = None
+
+        if magic != _MAGIC or fmt != _FORMAT:
+            raise MUMPSStorageError("'{}' is not a MUMPy global "
+                                    "database.".format(self.path))
+
+        self._page_size = size
+        self._root = root
+        self._npages = npages
+        self._free_head = free
+        self._commits = commits
+        self._header_dirty = False
+
+    def _map_file(self, npages=None):
+        """Map the database file into memory, first growing it if it is too
+        small to hold `npages` pages (or every page). Nothing may hold a view
+        of the old mapping when it is replaced."""
+        npages = self._npages if npages is None else npages
+        grow = max(_grow_pages, npages // 4)
+        size = max(os.fstat(self._f.fileno()).st_size,
+                   (npages + grow) * self._page_size)
+        size -= size % self._page_size
+
+        if self._map is not None:
+            self._map.close()
+        self._f.truncate(size)
+        self._map = mmap.mmap(self._f.fileno(), size)
+
+    def _read_page(self, page):
+        """Return the contents of page `page`."""
+        pos = page * self._page_size
+        return self._map[pos:pos+self._page_size]
+
+    def _write_page(self, page, data):
+        """Write `data` to page `page`."""
+        if len(data) > self._page_size:
+            raise MUMPSStorageError("Page {} overflowed.".format(page))
+        pos = page * self._page_size
+        if pos + len(data) > len(self._map):
+            self._map_file(page + 1)
+        self._map[pos:pos+len(data)] = data
+
+    def _write_images(self, images):
+        """Write the page images `images`, a list of page numbers and page
+        contents, to the database file and force them to disk."""
+        for page, data in images:
+            self._write_page(page, data)
+        self._map.flush()
+        os.fsync(self._f.fileno())
+
+    ###################
+    # CHECKPOINTS AND RECOVERY
+    ###################
+    def _checkpoint_if_full(self):
+        """Checkpoint the store if too many pages have been modified."""
+        if len(self._dirty) > self._cache_pages:
+            self.flush()
+
+    def flush(self):
+        """Checkpoint the store, writing every modified page and the header
+        to the database file. The page images are written to the journal
+        before the database file is modified, so that a crash part way
+        through the checkpoint does not leave a corrupt database."""
+        images = [(page, _encode_page(node))
+                  for page, node in sorted(self._dirty.items())]
+        if self._header_dirty:
+            images.insert(0, (0, _header.pack(_MAGIC, _FORMAT,
+                                              self._page_size, self._root,
+                                              self._npages,
+                                              self._free_head,
+                                              self._commits)))
+        if not images:
+            self._journal.commit()
+            return
+
+        self._journal.checkpoint(images)
+        self._write_images(images)
+        self._journal.reset()
+
+        for page, node in self._dirty.items():
+            if not isinstance(node, _Raw):
+                self._cache[page] = node
+        self._dirty.clear()
+        self._header_dirty = False
+        self._evict()
+
+    def _recover(self):
+        """Bring the database file up to date with its journal after the
+        store was not closed cleanly. The page images of a checkpoint which
+        was completely journaled are written to the database file, and the
+        changes journaled after that checkpoint are replayed."""
+        records = list(self._journal.records())
+        if not records:
+            self._journal.reset()
+            return
+
+        # Only the last checkpoint may have been cut short; the journal is
+        # reset after each one that completes
+        last = None
+        for i, (rtype, _, _) in enumerate(records):
+            if rtype == _CHECKPOINT:
+                last = i
+
+        if last is not None:
+            first = last
+            while first > 0 and records[first-1][0] == _PAGE:
+                first -= 1
+            self._write_images([(_pageno.unpack(a)[0], b)
+                                for _, a, b in records[first:last]])
+            self._read_header(self._read_page(0))
+            self._map_file()
+            records = records[last+1:]
+
+        # Changes journaled by a transaction are held until its TCOMMIT
+        batch = None
+        for rtype, a, b in records:
+            if rtype == _TSTART:
+                batch = []
+            elif rtype == _TCOMMIT:
+                for change in batch or ():
+                    self._replay(*change)
+                batch = None
+            elif batch is not None:
+                batch.append((rtype, a, b))
+            else:
+                self._replay(rtype, a, b)
+        self.flush()
+        self._journal.reset()
+
+    def _replay(self, rtype, a, b):
+        """Replay a journaled change."""
+        if rtype == _SET:
+            self._set(a, b)
+        elif rtype == _KILL:
+            self._delete_range(a, b)
+
+    ###################
+    # SHARING
+    ###################
+    def share(self):
+        """Share the store with other processes using the same database
+        file from now on. Changes made so far are checkpointed first, so
+        that the processes which share the file can read them."""
+        if not self._shared:
+            self.flush()
+            self._share()
+
+    def _share(self):
+        """Lock the database file whenever the store is used."""
+        self._shared = True
+        self._read_lock = _StoreLock(self, False)
+        self._write_lock = _StoreLock(self, True)
+
+    def _refresh(self):
+        """Bring the store up to date with the database file when it has
+        just been locked. Cached pages are discarded if another process has
+        committed changes since this one last held the file. A process
+        which exits while changing the file leaves records in the journal,
+        which is otherwise always empty while the file is not locked, so
+        its changes are recovered first."""
+        if self._map is None:
+            return
+
+        if not self._journal.empty():
+            self._cache.clear()
+            self._read_header(self._read_page(0))
+            self._map_file()
+            self._recover()
+            self._header_dirty = True
+            self._written(None)
+            return
+
+        commits = _header.unpack_from(self._map, 0)[-1]
+        if commits == self._commits:
+            return
+        self._cache.clear()
+        self._read_header(self._read_page(0))
+        if self._npages * self._page_size > len(self._map):
+            self._map_file()
+        self._written(None)
+
+    def _publish(self):
+        """Checkpoint the changes made while the database file was locked,
+        counting a commit so that other processes re-read their pages."""
+        if self._dirty or self._header_dirty:
+            self._commits += 1
+            self._header_dirty = True
+            self.flush()
+
+    def sync(self):
+        """Commit the journal, so every change made so far is durable."""
+        self._journal.commit()
+
+    def close(self):
+        """Checkpoint the store and close the database file."""
+        if self._f.closed:
+            return
+        self.flush()
+        self._journal.close()
+        self._map.close()
+        self._f.close()
+
+
+class MUMPSTransaction(_GlobalNodes):
+    """A transaction on a global store. Changes made in a transaction are
+    held in its write set until it commits, when they are applied to the
+    store as one batch. Reads see the write set over the contents of the
+    store.
+
+    Transactions are optimistic: every range of keys read is noted, and a
+    transaction conflicts (and cannot commit) if any change made to the
+    store after it began wrote to a range it read. The ranges written by
+    other processes sharing the database file are not known, so if any of
+    them committed since the transaction began, each read of the store is
+    repeated at commit and the transaction conflicts if one gives a
+    different result."""
+    def __init__(self, store, version):
+        self._store = store
+        self.version = version
+
+        # Changes in the order they were made, the values set (and their
+        # keys, in order) and the key ranges killed
+        self._changes = []
+        self._values = {}
+        self._keys = []
+        self._kills = []
+
+        # Key ranges read, with None for the end of the key space, and
+        # each read of the store as a (method, key, result) triple
+        self._reads = []
+        self._seen = []
+
+    def __repr__(self):
+        return "MUMPSTransaction({store}, {version}, {changes})".format(
+            store=self._store,
+            version=self.version,
+            changes=len(self._changes),
+        )
+
+    ###################
+    # KEYS
+    ###################
+    def get(self, key):
+        """Return the value stored under `key`, or None."""
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        if self._killed(key) is not None:
+            return None
+        self._reads.append((key, key + b'\x00'))
+        return self._read(self._store.get, key)
+
+    def set(self, key, value):
+        """Store the string `value` under `key`."""
+        value = str(value)
+        if key not in self._values:
+            bisect.insort(self._keys, key)
+        self._values[key] = value
+        self._changes.append((_SET, key, value))
+
+    def delete_range(self, low, high):
+        """Delete every key from `low` up to (but not including) `high`."""
+        i = bisect.bisect_left(self._keys, low)
+        j = bisect.bisect_left(self._keys, high)
+        for key in self._keys[i:j]:
+            del self._values[key]
+        del self._keys[i:j]
+        self._kills.append((low, high))
+        self._changes.append((_KILL, low, high))
+
+    def next_key(self, key):
+        """Return the first key greater than or equal to `key`, or None."""
+        i = bisect.bisect_left(self._keys, key)
+        ours = self._keys[i] if i < len(self._keys) else None
+
+        # Skip any keys in the store which the transaction killed
+        nxt = key
+        while True:
+            theirs = self._read(self._store.next_key, nxt)
+            killed = None if theirs is None else self._killed(theirs)
+            if killed is None:
+                break
+            nxt = killed[1]
+
+        self._reads.append((key, None if theirs is None
+                            else theirs + b'\x00'))
+        if ours is None or (theirs is not None and theirs < ours):
+            return theirs
+        return ours
+
+    def prev_key(self, key):
+        """Return the last key less than `key`, or None."""
+        i = bisect.bisect_left(self._keys, key)
+        ours = self._keys[i-1] if i > 0 else None
+
+        prev = key
+        while True:
+            theirs = self._read(self._store.prev_key, prev)
+            killed = None if theirs is None else self._killed(theirs)
+            if killed is None:
+                break
+            prev = killed[0]
+
+        self._reads.append((b'' if theirs is None else theirs, key))
+        if ours is None or (theirs is not None and theirs > ours):
+            return theirs
+        return ours
+
+    def _read(self, method, key):
+        """Return the result of reading `key` from the store with `method`,
+        noting it so that the read can be repeated at commit."""
+        result = method(key)
+        self._seen.append((method, key, result))
+        return result
+
+    def _killed(self, key):
+        """Return the last range killed by the transaction which contains
+        `key`, or None if it killed none."""
+        for low, high in reversed(self._kills):
+            if low <= key < high:
+                return low, high
+        return None
+
+    ###################
+    # COMMIT AND ROLLBACK
+    ###################
+    def commit(self):
+        """Apply the changes made in the transaction to the store. Return
+        False, without changing the store, if the transaction conflicts
+        with a change made since it began. A shared database file stays
+        locked from the check until the changes are applied."""
+        try:
+            with self._store._write_lock:
+                if self._conflicts():
+                    return False
+                if self._changes:
+                    self._store.apply(self._changes)
+                return True
+        finally:
+            self._store._end(self)
+
+    def rollback(self):
+        """Discard the changes made in the transaction."""
+        self._store._end(self)
+
+    def _conflicts(self):
+        """Return True if a change made to the store since the transaction
+        began wrote to a range of keys the transaction read, or if another
+        process has committed since and a read now gives another result."""
+        repeated = False
+        for version, ranges in self._store._history:
+            if version <= self.version:
+                continue
+            if ranges is None:
+                if not repeated and any(method(key) != result for
+                                        method, key, result in self._seen):
+                    return True
+                repeated = True
+                continue
+            for low, high in ranges:
+                for start, end in self._reads:
+                    if start < high and (end is None or low < end):
+                        return True
+        return False
+
+
+###################
+# NODE MAPS
+###################
+class MUMPSNodeMap(_GlobalNodes):
+    """An in-memory map of node keys to values, which provides the node
+    operations of a global store without a database file. The keys are
+    kept in one sorted list, so descendants of a node are a contiguous
+    range of keys: `$DATA` is found from the keys next to the node and a
+    node and its descendants are deleted as one slice. Values are stored
+    as they are given rather than as strings. Keys are not limited in
+    length, since they are never written to a page."""
+    _max_key = None
+
+    def __init__(self):
+        self._keys = blist.sortedlist()
+        self._values = {}
+
+    def __repr__(self):
+        return "MUMPSNodeMap({n})".format(n=len(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, key):
+        """Return the value stored under `key`, or None."""
+        return self._values.get(key)
+
+    def set(self, key, value):
+        """Store `value` under `key`."""
+        if key not in self._values:
+            self._keys.add(key)
+        self._values[key] = value
+
+    def delete_range(self, low, high):
+        """Delete every key from `low` up to (but not including) `high`."""
+        i = self._keys.bisect_left(low)
+        j = self._keys.bisect_left(high)
+        for key in self._keys[i:j]:
+            del self._values[key]
+        del self._keys[i:j]
+
+    def next_key(self, key):
+        """Return the first key greater than or equal to `key`, or None."""
+        i = self._keys.bisect_left(key)
+        return self._keys[i] if i < len(self._keys) else None
+
+    def prev_key(self, key):
+        """Return the last key less than `key`, or None."""
+        i = self._keys.bisect_left(key)
+        return self._keys[i-1] if i > 0 else None
+
+    def _items(self, low, high):
+        """Generate each key from `low` up to (but not including) `high`
+        and its value, in order."""
+        i = self._keys.bisect_left(low)
+        j = self._keys.bisect_left(high)
+        for key in self._keys[i:j]:
+            yield key, self._values[key]
+
+
+class MUMPSGlobal:
+    """A global variable. Globals provide the same interface as local
+    variables (MUMPSLocal), but operate on the nodes of the global in a
+    global store rather than holding their own values."""
+    def __init__(self, store, name):
+        self._store = store
+        self._name = str(name).lstrip('^')
+
+    def __repr__(self):
+        return "MUMPSGlobal(^{name}, {store})".format(
+            name=self._name,
+            store=self._store,
+        )
+
+    def __str__(self):
+        """Return the value of the root node."""
+        v = self._store.get_node(self._name)
+        return "" if v is None else v
+
+    def get(self, ident):
+        """Return the value given by the input identifier, or null if the
+        node has no value."""
+        v = self._store.get_node(self._name, ident_subscripts(ident))
+        return mumpy.mumps_null() if v is None else v
+
+    def set(self, ident, value):
+        """Set the value at the given identifier."""
+        self._store.set_node(self._name, ident_subscripts(ident),
+                             str(value))
+
+    def delete(self, ident):
+        """Delete the node at the given identifier and its descendants."""
+        self._store.kill_node(self._name, ident_subscripts(ident))
+
+    def data(self, ident):
+        """Return the `$DATA` value of the node at the given identifier."""
+        return self._store.data(self._name, ident_subscripts(ident))
+
+    def order(self, ident, rev=1):
+        """Return the next subscript after the last subscript of the given
+        identifier, or the previous subscript if `rev` is -1."""
+        subs = ident_subscripts(ident, last_null=True)
+        if not subs:
+            raise mumpy.MUMPSSyntaxError("Cannot $ORDER over a scalar value.",
+                                         err_type="INVALID $ORDER PARAM")
+        return self._store.order(self._name, subs, rev=rev)
+
+    def order_iter(self, ident, rev=1):
+        """Generate each subscript following the last subscript of the given
+        identifier at its level (or preceding it, if `rev` is -1)."""
+        subs = ident_subscripts(ident, last_null=True)
+        if not subs:
+            raise mumpy.MUMPSSyntaxError("Cannot $ORDER over a scalar value.",
+                                         err_type="INVALID $ORDER PARAM")
+        return self._store.order_iter(self._name, subs, rev=rev)
+
+    def query(self, ident):
+        """Return the tuple of subscripts of the first node after the given
+        identifier with a value, in the order of a depth-first walk of the
+        global, or None if there is no such node."""
+        subs = ident_subscripts(ident, last_null=True)
+        if subs and subs[-1] == "":
+            subs.pop()
+        return self._store.query(self._name, subs)
+
+    def nodes(self, ident):
+        """Generate the subscripts (relative to the given identifier) and
+        value of the node at the given identifier and of each descendant."""
+        return self._store.nodes(self._name, ident_subscripts(ident))
+
+    def merge(self, ident, src, src_ident):
+        """Copy the value and descendants of `src_ident` in the variable `src`
+        (a local or global variable) beneath the given identifier. Nodes of
+        another global are copied as a range of keys in the store."""
+        subs = ident_subscripts(ident)
+        if isinstance(src, MUMPSGlobal) and src._store is self._store:
+            self._store.merge_nodes(self._name, subs,
+                                    src._name, ident_subscripts(src_ident))
+        else:
+            self._store.set_nodes(self._name, subs, src.nodes(src_ident))
+
+
+def ident_subscripts(ident, last_null=False):
+    """Return the list of subscript strings of the identifier `ident`, which
+    may also be a variable name without subscripts. Null subscripts are
+    only allowed as the last subscript if `last_null` is True."""
+    subs = ident.subscripts() if not isinstance(ident, str) else None
+    if subs is None:
+        return []
+
+    subs = [str(s) for s in subs]
+    if "" in (subs[:-1] if last_null else subs):
+        raise mumpy.MUMPSSyntaxError("Null subscript given for identifier.",
+                                     err_type="NULL SUBSCRIPT")
+    return subs
+
+
+def node_reference(name, subscripts):
+    """Return the reference to the node of the variable `name` with the
+    given subscript strings. Subscripts which are not canonical numbers are
+    quoted."""
+    if not subscripts:
+        return name
+    return "{name}({subs})".format(name=name, subs=",".join(
+        sub if is_canonical_number(sub)
+        else '"{}"'.format(sub.replace('"', '""'))
+        for sub in subscripts
+    ))
+
+
+class MUMPSStorageError(Exception):
+    """Raised if a global database file is invalid or corrupt."""
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return "STORAGE ERROR: {msg}".format(msg=self.msg)
@@ -62,6 +62,14 @@ class MUMPSLexer:
         'job': 'JOB',
         'k': 'KILL',
         'kill': 'KILL',
+        'tc': 'TCOMMIT',
+        'tcommit': 'TCOMMIT',
+        'tre': 'TRESTART',
+        'trestart': 'TRESTART',
+        'tro': 'TROLLBACK',
+        'trollback': 'TROLLBACK',
+        'ts': 'TSTART',
+        'tstart': 'TSTART',
         'u': 'USE',
         'use': 'USE',
         'v': 'VIEW',
@@ -141,6 +149,10 @@ class MUMPSLexer:
         '$principal': 'PIECE_PRINCIPAL',
         '$t': 'TEST_TEXT',
         '$test': 'TEST',
+        '$tl': 'DOLLARTL',
+        '$tlevel': 'DOLLARTL',
+        '$tre': 'DOLLARTRE',
+        '$trestart': 'DOLLARTRE',
         '$x': 'DOLLARX',
         '$y': 'DOLLARY',
         '$zj': 'ZJOB',
@@ -208,10 +220,7 @@ class MUMPSLexer:
     @lex.TOKEN(r'(\d+(\.\d+)?|(\.\d+))')
     def t_command_NUMBER(self, t):
         """Match a NUMBER token in command mode."""
-        if float(t.value).is_integer():
-            t.value = int(t.value)
-        else:
-            t.value = float(t.value)
+        t.value = mumpy.lang._to_mumps_number(t.value)
         return t
 
     @lex.TOKEN(r'([%a-zA-Z]+[%a-zA-Z0-9]*)')
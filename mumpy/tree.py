@@ -0,0 +1,821 @@
+"""MUMPy Syntax Tree
+
+The nodes in this file form an abstract syntax tree for MUMPS code, which
+the parser assembles from each line of input. Unlike the language
+components in `mumpy.lang`, syntax tree nodes never store a reference to a
+MUMPS environment or parser. A parsed line may therefore be cached, shared
+between environments and processes, or written out by the compiler and
+read back in later.
+
+A tree is bound to an environment only when it is executed. Binding a node
+produces the language components (commands, expressions, identifiers and
+calls) which perform the actual work against that environment.
+
+Licensed under a BSD license. See LICENSE for more information.
+
+Author: Christopher Rink"""
+import functools
+import operator
+import mumpy
+import mumpy.lang as lang
+import mumpy.runtime as rt
+
+
+###################
+# EVALUATOR
+# The evaluator binds syntax trees to a given environment (and the parser
+# which is executing code in that environment). Bound trees are made up of
+# the deferred language components in `mumpy.lang`, so a tree only needs
+# to be bound once per environment and may be executed any number of times.
+###################
+def bind(item, env, parser):
+    """Bind a syntax tree node (or any structure of tuples and dicts
+    containing syntax tree nodes) to the environment `env` and the parser
+    `parser`, returning the equivalent language components."""
+    if isinstance(item, MUMPSNode):
+        return item.bind(env, parser)
+    elif isinstance(item, tuple):
+        return tuple(bind(i, env, parser) for i in item)
+    elif isinstance(item, dict):
+        return {k: bind(v, env, parser) for k, v in item.items()}
+    return item
+
+
+def restart_command(prior):
+    """Return the index of the command from which a transaction started by
+    a TSTART command following the commands `prior` on its line restarts.
+    That is the TSTART itself, unless it is inside a FOR loop on the line,
+    in which case the whole loop is run again."""
+    for i, cmd in enumerate(prior):
+        if cmd.name == 'FOR':
+            return i
+    return len(prior)
+
+
+def execute(line, env, parser):
+    """Execute the line syntax tree `line` in the environment `env`,
+    returning the control flow signal returned by its commands (if any)."""
+    return bind(line, env, parser).execute()
+
+
+def evaluate(expr, env, parser):
+    """Return the string value of the expression syntax tree `expr`
+    evaluated in the environment `env`."""
+    return str(bind(expr, env, parser))
+
+
+###################
+# SYNTAX TREE NODES
+# Each node lists the names of its fields in `_fields`, in the same order
+# as its constructor arguments. The representation of a node is therefore
+# a valid constructor call, which allows trees to be serialized as Python
+# source code.
+###################
+class MUMPSNode:
+    """Base class for MUMPS syntax tree nodes."""
+    _fields = ()
+
+    def __repr__(self):
+        """Return a representation of this node as a constructor call."""
+        return "{cls}({fields})".format(
+            cls=self.__class__.__name__,
+            fields=", ".join(repr(getattr(self, f)) for f in self._fields),
+        )
+
+    def bind(self, env, parser):
+        """Return the language component for this node in `env`."""
+        raise NotImplementedError
+
+
+class LineNode(MUMPSNode):
+    """A full line of MUMPS commands. Comment lines have no commands."""
+    _fields = ('commands',)
+
+    def __init__(self, commands=()):
+        self.commands = tuple(commands)
+
+    def bind(self, env, parser):
+        line = None
+        for i, cmd in enumerate(self.commands):
+            line = lang.MUMPSLine(cmd.bind(env, parser, self.commands[:i]),
+                                  line)
+        return line if line is not None else lang.MUMPSLine(None)
+
+
+class CommandNode(MUMPSNode):
+    """A single MUMPS command given by its keyword `name` (such as 'SET'),
+    with an argument structure and an optional post-conditional."""
+    _fields = ('name', 'args', 'post')
+
+    def __init__(self, name, args=None, post=None):
+        if name not in _commands:
+            raise lang.MUMPSSyntaxError("Unknown command '{}'.".format(name),
+                                        err_type="INVALID COMMAND")
+
+        self.name = name
+        self.args = args
+        self.post = post
+
+    def bind(self, env, parser, prior=()):
+        """Bind the command, which follows the commands `prior` on its
+        line."""
+        # XECUTE commands are performed by the parser itself
+        if self.name == 'XECUTE':
+            cmd = parser._parse_xecute
+        else:
+            table = _commands if parser.exceptions else _status_commands
+            with_args, no_args = table[self.name]
+            cmd = with_args if self.args is not None else no_args
+
+        # Transactions restart from their TSTART command
+        if self.name == 'TSTART':
+            restart = parser._bind_line
+            if restart is not None:
+                restart += (restart_command(prior),)
+            cmd = functools.partial(cmd, restart=restart)
+
+        # Note when a line writes to the principal device, so the REPL
+        # can emit a trailing newline
+        if self.name == 'WRITE' and (self.args is None or
+                                     str(env.current_device()) ==
+                                     str(env.default_device())):
+            parser.output = True
+
+        return lang.MUMPSCommand(cmd, bind(self.args, env, parser), env,
+                                 post=bind(self.post, env, parser))
+
+
+class ArgumentListNode(MUMPSNode):
+    """A comma delimited list of command or function arguments."""
+    _fields = ('items',)
+
+    def __init__(self, items):
+        self.items = tuple(items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, item):
+        return self.items[item]
+
+    def append(self, item):
+        """Return a new argument list with `item` added to the end."""
+        return ArgumentListNode(self.items + (item,))
+
+    def bind(self, env, parser):
+        if not self.items:
+            return None
+        return lang.MUMPSArgumentList.from_items(
+            bind(item, env, parser) for item in self.items
+        )
+
+
+class LiteralNode(MUMPSNode):
+    """A string or numeric literal value."""
+    _fields = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def bind(self, env, parser):
+        return lang.MUMPSExpression(self.value)
+
+
+class VariableNode(MUMPSNode):
+    """A reference to a (possibly subscripted) variable. READ arguments may
+    also give a maximum number of characters and a timeout."""
+    _fields = ('name', 'subscripts', 'max', 'timeout')
+
+    def __init__(self, name, subscripts=None, max=None, timeout=None):
+        self.name = str(name)
+        self.subscripts = subscripts
+        self.max = max
+        self.timeout = timeout
+
+    def bind(self, env, parser):
+        ident = lang.MUMPSIdentifier(self.name, env,
+                                     subscripts=bind(self.subscripts,
+                                                     env, parser))
+        if self.max is not None:
+            ident.set_max(bind(self.max, env, parser))
+        if self.timeout is not None:
+            ident.set_timeout(bind(self.timeout, env, parser))
+        return ident
+
+
+class ValueNode(MUMPSNode):
+    """The value of a variable used in an expression."""
+    _fields = ('var',)
+
+    def __init__(self, var):
+        self.var = var
+
+    def bind(self, env, parser):
+        return lang.MUMPSExpression(self.var.bind(env, parser))
+
+
+class PointerNode(MUMPSNode):
+    """A variable passed by reference to a function or subroutine."""
+    _fields = ('name',)
+
+    def __init__(self, name):
+        self.name = str(name)
+
+    def bind(self, env, parser):
+        return lang.MUMPSPointerIdentifier(self.name, env)
+
+
+class UnaryNode(MUMPSNode):
+    """A unary operator (NOT, PLUS or MINUS) applied to an expression."""
+    _fields = ('op', 'operand')
+
+    def __init__(self, op, operand):
+        if op not in _unary_ops:
+            raise lang.MUMPSSyntaxError("Unknown operator '{}'.".format(op),
+                                        err_type="INVALID OPERATOR")
+
+        self.op = op
+        self.operand = operand
+
+    def bind(self, env, parser):
+        return bind_closure(self, env, parser)
+
+
+class BinaryNode(MUMPSNode):
+    """A binary operator applied to two expressions. The operators are
+    named by their tokens, except for SORTS_AFTER (`]]`)."""
+    _fields = ('op', 'left', 'right')
+
+    def __init__(self, op, left, right):
+        if op not in _binary_ops:
+            raise lang.MUMPSSyntaxError("Unknown operator '{}'.".format(op),
+                                        err_type="INVALID OPERATOR")
+
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def bind(self, env, parser):
+        return bind_closure(self, env, parser)
+
+
+class IntrinsicNode(MUMPSNode):
+    """An intrinsic function call (such as $PIECE) named by its token, with
+    a tuple of arguments. Omitted optional arguments are given as None."""
+    _fields = ('name', 'args')
+
+    def __init__(self, name, args):
+        if name not in _intrinsics:
+            raise lang.MUMPSSyntaxError("Function does not exist.",
+                                        err_type="FN DOES NOT EXIST")
+
+        self.name = name
+        self.args = tuple(args)
+
+    def bind(self, env, parser):
+        return bind_closure(self, env, parser)
+
+
+class SetTargetNode(MUMPSNode):
+    """An intrinsic function (such as $PIECE) on the left side of a SET
+    command, which sets part of the value of the variable `var`. The tuple
+    `args` gives the other arguments of the function."""
+    _fields = ('name', 'var', 'args')
+
+    def __init__(self, name, var, args):
+        if name not in _rt_set_targets:
+            raise lang.MUMPSSyntaxError("Function cannot be SET.",
+                                        err_type="INVALID SET TARGET")
+
+        self.name = name
+        self.var = var
+        self.args = tuple(args)
+
+    def bind(self, env, parser):
+        return lang.MUMPSSetTarget(getattr(rt, _rt_set_targets[self.name]),
+                                   self.var.bind(env, parser), env,
+                                   args=bind(self.args, env, parser))
+
+
+class SpecialVarNode(MUMPSNode):
+    """A special variable (such as $HOROLOG) provided by the environment."""
+    _fields = ('name',)
+
+    def __init__(self, name):
+        if name not in _special_vars:
+            raise lang.MUMPSSyntaxError("Special variable does not exist.",
+                                        err_type="INVALID SVN")
+
+        self.name = name
+
+    def bind(self, env, parser):
+        return _special_vars[self.name](env)
+
+
+class ColumnNode(MUMPSNode):
+    """The `?N` format code, which advances output to column N."""
+    _fields = ('offset',)
+
+    def __init__(self, offset):
+        self.offset = offset
+
+    def bind(self, env, parser):
+        return lang.MUMPSExpression(
+            lambda o=bind(self.offset, env, parser), e=env: (
+                lang._column(o, e.device_x())
+            )
+        )
+
+
+class CallNode(MUMPSNode):
+    """A function or subroutine call (or GOTO target) to `tag^rou`. Calls
+    without parentheses have `args` of None; calls with empty parentheses
+    have an empty tuple of arguments."""
+    _fields = ('tag', 'rou', 'args', 'is_func', 'post')
+
+    def __init__(self, tag, rou=None, args=None, is_func=False, post=None):
+        self.tag = str(tag)
+        self.rou = None if rou is None else str(rou)
+        self.args = args
+        self.is_func = is_func
+        self.post = post
+
+        # The call site shared by every binding of this node
+        self._site = None
+
+    def bind(self, env, parser):
+        if self._site is None:
+            self._site = rt.call_site(
+                self.tag, self.rou, self.is_func,
+                None if self.args is None else len(self.args))
+        call = lang.MUMPSFuncSubCall(
+            lang.MUMPSIdentifier(self.tag, env), env, parser,
+            args=bind(self.args, env, parser),
+            is_func=self.is_func,
+            rou=self.rou,
+            post=True if self.post is None else bind(self.post, env, parser),
+            site=self._site,
+        )
+        return lang.MUMPSExpression(call) if self.is_func else call
+
+
+###################
+# EXPRESSION CLOSURES
+# Compound expressions are flattened into a single closure of the
+# environment and parser which computes a plain value through the functions
+# in `mumpy.runtime`, rather than bound into a chain of deferred
+# MUMPSExpressions which converts every intermediate value to a string and
+# back again. Closures are built once per syntax tree node.
+#
+# Where the type of an operand is known when its closure is built, the
+# closure uses it without coercion: numeric literals and the results of
+# arithmetic are always canonical numbers, and string literals and
+# concatenations are always strings. Operations on constants are folded.
+###################
+NUM = 'num'
+STR = 'str'
+
+# Marks a closure whose value is not constant
+_NOT_CONST = object()
+
+
+def closure(node):
+    """Return a function of the environment and parser which computes the
+    plain value of the expression syntax tree `node`."""
+    try:
+        return node._closure
+    except AttributeError:
+        f = node._closure = _closure(node)[0]
+        return f
+
+
+def bind_closure(node, env, parser):
+    """Bind the expression `node` to `env` and `parser` as a deferred
+    expression evaluating the closure for the node."""
+    f = closure(node)
+    return lang.MUMPSExpression(lambda: f(env, parser))
+
+
+def _const(v):
+    """Return the closure tuple for the constant value `v`."""
+    t = type(v)
+    if (t is int or t is lang.MUMPSDecimal or
+            (t is float and not v.is_integer())):
+        kind = NUM
+    elif t is str:
+        kind = STR
+    else:
+        kind = None
+    return (lambda env, p: v), kind, v
+
+
+def _closure(node):
+    """Return a tuple of the closure for the expression `node`, the kind of
+    value it computes (NUM, STR or None if unknown) and its value if the
+    expression is constant (otherwise _NOT_CONST)."""
+    if isinstance(node, LiteralNode):
+        return _const(node.value)
+    elif isinstance(node, ValueNode):
+        return _value_closure(node.var), None, _NOT_CONST
+    elif isinstance(node, UnaryNode):
+        return _unary_closure(node)
+    elif isinstance(node, BinaryNode):
+        return _binary_closure(node)
+    elif isinstance(node, IntrinsicNode):
+        return _intrinsic_closure(node)
+    elif isinstance(node, SpecialVarNode):
+        return _closure_special_vars[node.name], None, _NOT_CONST
+    elif isinstance(node, CallNode) and node.is_func:
+        return _call_closure(node), None, _NOT_CONST
+
+    # Anything else is evaluated through its bound language component
+    return (lambda env, p: rt.value(bind(node, env, p))), None, _NOT_CONST
+
+
+def _ident_closure(var):
+    """Return a closure computing the identifier of the variable `var`."""
+    if var.subscripts is None:
+        ident = rt.ident(var.name)
+        return lambda env, p: ident
+
+    name = var.name
+    subs = tuple(closure(s) for s in var.subscripts)
+    return lambda env, p: rt.ident(name, *[s(env, p) for s in subs])
+
+
+def _value_closure(var):
+    """Return a closure computing the value of the variable `var`."""
+    if var.subscripts is None:
+        ident = rt.ident(var.name)
+        return lambda env, p: rt.value(env.get(ident))
+
+    ident = _ident_closure(var)
+    return lambda env, p: rt.get(env, ident(env, p))
+
+
+def _fold(func, *args):
+    """Return the closure tuple for the constant `func(*args)`, or None if
+    it raises an error (which must instead be raised at run time)."""
+    try:
+        return _const(func(*args))
+    except (lang.MUMPSSyntaxError, ValueError, IndexError):
+        return None
+
+
+def _unary_closure(node):
+    """Return the closure tuple for a unary operator."""
+    f, kind, const = _closure(node.operand)
+    func = getattr(rt, _rt_unary_ops[node.op])
+    if const is not _NOT_CONST:
+        folded = _fold(func, const)
+        if folded is not None:
+            return folded
+
+    if node.op == 'PLUS' and kind is NUM:
+        return f, NUM, _NOT_CONST
+    elif node.op == 'MINUS' and kind is NUM:
+        return (lambda env, p: -f(env, p)), NUM, _NOT_CONST
+    return (lambda env, p: func(f(env, p))), NUM, _NOT_CONST
+
+
+def _binary_closure(node):
+    """Return the closure tuple for a binary operator, using a fast path
+    for operands of a known kind where the operator has one."""
+    op = node.op
+    l, lkind, lconst = _closure(node.left)
+    r, rkind, rconst = _closure(node.right)
+    func = getattr(rt, _rt_binary_ops[op])
+    kind = STR if op == 'CONCAT' else NUM
+
+    if (lconst is not _NOT_CONST and rconst is not _NOT_CONST and
+            op not in _unfolded_ops):
+        folded = _fold(func, lconst, rconst)
+        if folded is not None:
+            return folded
+
+    if op in _numeric_ops:
+        pyop, result = _numeric_ops[op]
+
+        # Numeric operands are used directly, without coercion
+        if rconst is not _NOT_CONST:
+            c = rt.num(rconst)
+            if lkind is NUM:
+                f = lambda env, p: result(pyop(l(env, p), c))
+            else:
+                f = lambda env, p: result(pyop(rt.num(l(env, p)), c))
+            return f, kind, _NOT_CONST
+        elif lkind is NUM and rkind is NUM:
+            f = lambda env, p: result(pyop(l(env, p), r(env, p)))
+            return f, kind, _NOT_CONST
+    elif op == 'CONCAT':
+        # String operands are used directly, without conversion
+        if rconst is not _NOT_CONST:
+            c = rt.string(rconst)
+            if lkind is STR:
+                f = lambda env, p: l(env, p) + c
+            else:
+                f = lambda env, p: rt.string(l(env, p)) + c
+            return f, kind, _NOT_CONST
+        elif lkind is STR and rkind is STR:
+            f = lambda env, p: l(env, p) + r(env, p)
+            return f, kind, _NOT_CONST
+    elif op == 'EQUALS' and rconst is not _NOT_CONST:
+        c = rt.string(rconst)
+        if lkind is STR:
+            f = lambda env, p: int(l(env, p) == c)
+        else:
+            f = lambda env, p: int(rt.string(l(env, p)) == c)
+        return f, kind, _NOT_CONST
+
+    return (lambda env, p: func(l(env, p), r(env, p))), kind, _NOT_CONST
+
+
+def _intrinsic_closure(node):
+    """Return the closure tuple for an intrinsic function call."""
+    name, args = node.name, node.args
+    kind = _closure_intrinsic_kinds.get(name)
+    if name == 'CHAR':
+        codes = tuple(closure(a) for a in args[0])
+        f = lambda env, p: rt.char(*[c(env, p) for c in codes])
+        return f, kind, _NOT_CONST
+    elif name == 'DATA':
+        ident = _ident_closure(args[0])
+        return (lambda env, p: rt.data(env, ident(env, p))), kind, _NOT_CONST
+    elif name == 'GET':
+        ident = _ident_closure(args[0])
+        if args[1] is None:
+            f = lambda env, p: rt.get_defined(env, ident(env, p))
+        else:
+            default = closure(args[1])
+            f = lambda env, p: rt.get_defined(env, ident(env, p),
+                                              default(env, p))
+        return f, kind, _NOT_CONST
+    elif name == 'NAME':
+        return _const(args[0].name)
+    elif name == 'ORDER':
+        ident = _ident_closure(args[0])
+        if args[1] is None:
+            f = lambda env, p: rt.order(env, ident(env, p))
+        else:
+            rev = closure(args[1])
+            f = lambda env, p: rt.order(env, ident(env, p), rev(env, p))
+        return f, kind, _NOT_CONST
+    elif name == 'QUERY':
+        ident = _ident_closure(args[0])
+        return (lambda env, p: rt.query(env, ident(env, p))), kind, _NOT_CONST
+    elif name == 'SELECT':
+        pairs = tuple((closure(c), closure(v)) for c, v in args[0])
+
+        def f(env, p):
+            for c, v in pairs:
+                if rt.truth(c(env, p)):
+                    return v(env, p)
+            return rt.select_error()
+        return f, kind, _NOT_CONST
+
+    # Omitted optional arguments are not passed to the runtime function
+    args = list(args)
+    while args and args[-1] is None:
+        args.pop()
+    func = getattr(rt, _rt_intrinsics[name])
+    parts = [_closure(a) for a in args]
+
+    if name != 'RANDOM' and all(c is not _NOT_CONST for _, _, c in parts):
+        folded = _fold(func, *(c for _, _, c in parts))
+        if folded is not None:
+            return folded
+
+    fs = tuple(f for f, _, _ in parts)
+    if len(fs) == 1:
+        a, = fs
+        f = lambda env, p: func(a(env, p))
+    elif len(fs) == 2:
+        a, b = fs
+        f = lambda env, p: func(a(env, p), b(env, p))
+    else:
+        f = lambda env, p: func(*[a(env, p) for a in fs])
+    return f, kind, _NOT_CONST
+
+
+def _call_closure(node):
+    """Return the closure for an extrinsic function call."""
+    nargs = None if node.args is None else len(node.args)
+    site = rt.call_site(node.tag, node.rou, True, nargs)
+    if not node.args:
+        args = node.args
+        return lambda env, p: rt.call(env, p, site, args)
+
+    fs = tuple(
+        (lambda env, p, ptr=rt.pointer(a.name): ptr)
+        if isinstance(a, PointerNode) else closure(a)
+        for a in node.args
+    )
+    return lambda env, p: rt.call(env, p, site,
+                                  tuple(f(env, p) for f in fs))
+
+
+###################
+# NODE TABLES
+###################
+# Command functions for each command keyword, given as a pair of the
+# function called with an argument list and the function called without
+# one. XECUTE commands are executed by the parser.
+_commands = {
+    'CLOSE': (lang.close_dev, None),
+    'DO': (lang.do_cmd, None),
+    'ELSE': (None, lang.else_cmd),
+    'FOR': (lang.for_start, lang.for_start),
+    'GOTO': (lang.goto_cmd, None),
+    'HALT': (None, lang.halt),
+    'HANG': (lang.hang, None),
+    'IF': (lang.if_cmd, lang.if_no_args),
+    'JOB': (lang.job_cmd, None),
+    'KILL': (lang.kill, lang.kill_all),
+    'LOCK': (lang.lock, lang.unlock_all),
+    'MERGE': (lang.merge, None),
+    'NEW': (lang.new_var, None),
+    'OPEN': (lang.open_dev, None),
+    'QUIT': (lang.quit_cmd, lang.quit_cmd),
+    'READ': (lang.read, None),
+    'SET': (lang.set_var, None),
+    'TCOMMIT': (None, lang.tcommit),
+    'TRESTART': (None, lang.trestart),
+    'TROLLBACK': (None, lang.trollback),
+    'TSTART': (None, lang.tstart),
+    'USE': (lang.use_dev, None),
+    'VIEW': (lang.view_cmd, None),
+    'WRITE': (lang.write, lang.write_symbols),
+    'XECUTE': (None, None),
+}
+
+# Command functions for parsers which do not use exceptions for control flow,
+# whose control flow commands return their signal for the parser
+_status_commands = dict(
+    _commands,
+    ELSE=(None, lang.else_status),
+    FOR=(lang.for_status, lang.for_status),
+    GOTO=(lang.goto_status, None),
+    IF=(lang.if_status, lang.if_no_args_status),
+    QUIT=(lang.quit_status, lang.quit_status),
+)
+
+# Unary operators
+_unary_ops = {
+    'NOT': operator.invert,
+    'PLUS': operator.pos,
+    'MINUS': operator.neg,
+}
+
+# Binary operators
+_binary_ops = {
+    'PLUS': operator.add,
+    'MINUS': operator.sub,
+    'TIMES': operator.mul,
+    'DIVIDE': operator.truediv,
+    'IDIVIDE': operator.floordiv,
+    'MODULUS': operator.mod,
+    'EXPONENT': operator.pow,
+    'AND': operator.and_,
+    'OR': operator.or_,
+    'GREATER_THAN': operator.gt,
+    'LESS_THAN': operator.lt,
+    'EQUALS': operator.eq,
+    'CONCAT': lambda l, r: l.concat(r),
+    'CONTAINS': lambda l, r: l.contains(r),
+    'FOLLOWS': lambda l, r: l.follows(r),
+    'SORTS_AFTER': lambda l, r: l.sorts_after(r),
+}
+
+# Intrinsic functions
+_intrinsics = {
+    'ASCII': lang.intrinsic_ascii,
+    'CHAR': lang.intrinsic_char,
+    'DATA': lang.intrinsic_data,
+    'EXTRACT': lang.intrinsic_extract,
+    'FIND': lang.intrinsic_find,
+    'GET': lang.intrinsic_get,
+    'JUSTIFY': lang.intrinsic_justify,
+    'LENGTH': lang.intrinsic_length,
+    'NAME': lang.intrinsic_name,
+    'ORDER': lang.intrinsic_order,
+    'PIECE': lang.intrinsic_piece,
+    'QUERY': lang.intrinsic_query,
+    'RANDOM': lang.intrinsic_random,
+    'REVERSE': lang.intrinsic_reverse,
+    'SELECT': lang.intrinsic_select,
+    'TRANSLATE': lang.intrinsic_translate,
+}
+
+# Special variables, each given as a function of the environment
+_special_vars = {
+    'HOROLOG': lambda env: lang.horolog(),
+    'IO': lambda env: lang.MUMPSExpression(
+        lambda e=env: str(e.current_device())
+    ),
+    'JOB': lambda env: lang.current_job(),
+    'PRINCIPAL': lambda env: env.default_device(),
+    'TEST': lambda env: lang.MUMPSExpression(lambda e=env: e.get("$T")),
+    'TLEVEL': lambda env: lang.MUMPSExpression(lambda e=env: e.tlevel()),
+    'TRESTART': lambda env: lang.MUMPSExpression(lambda e=env: e.trestarts()),
+    'X': lambda env: lang.MUMPSExpression(lambda e=env: e.device_x()),
+    'Y': lambda env: lang.MUMPSExpression(lambda e=env: e.device_y()),
+    'ZJOB': lambda env: lang.MUMPSExpression(lambda e=env: e.get("$ZJ")),
+}
+
+
+# Runtime functions for each operator and intrinsic function, by the name
+# of the function in `mumpy.runtime`
+_rt_unary_ops = {
+    'NOT': 'not_',
+    'PLUS': 'num',
+    'MINUS': 'neg',
+}
+
+_rt_binary_ops = {
+    'PLUS': 'add',
+    'MINUS': 'sub',
+    'TIMES': 'mul',
+    'DIVIDE': 'div',
+    'IDIVIDE': 'idiv',
+    'MODULUS': 'mod',
+    'EXPONENT': 'power',
+    'AND': 'and_',
+    'OR': 'or_',
+    'GREATER_THAN': 'gt',
+    'LESS_THAN': 'lt',
+    'EQUALS': 'eq',
+    'CONCAT': 'concat',
+    'CONTAINS': 'contains',
+    'FOLLOWS': 'follows',
+    'SORTS_AFTER': 'sorts_after',
+}
+
+_rt_intrinsics = {
+    'ASCII': 'ascii',
+    'EXTRACT': 'extract',
+    'FIND': 'find',
+    'JUSTIFY': 'justify',
+    'LENGTH': 'length',
+    'PIECE': 'piece',
+    'RANDOM': 'rand',
+    'REVERSE': 'reverse',
+    'TRANSLATE': 'translate',
+}
+
+# Runtime functions for the intrinsic functions which may be the target
+# of a SET command
+_rt_set_targets = {
+    'EXTRACT': 'set_extract',
+    'PIECE': 'set_piece',
+}
+
+# Numeric operators with a fast path for numeric operands, given as a pair
+# of the Python operator and the function applied to its result
+_numeric_ops = {
+    'PLUS': (operator.add, rt._canonical),
+    'MINUS': (operator.sub, rt._canonical),
+    'TIMES': (operator.mul, rt._canonical),
+    'DIVIDE': (lang._divide, rt._canonical),
+    'IDIVIDE': (lang._idivide, rt._canonical),
+    'MODULUS': (lang._modulo, rt._canonical),
+    'GREATER_THAN': (operator.gt, int),
+    'LESS_THAN': (operator.lt, int),
+}
+
+# Operators which are never folded, since they may raise an error which
+# must only be raised if the expression is evaluated
+_unfolded_ops = ('DIVIDE', 'IDIVIDE', 'MODULUS', 'EXPONENT')
+
+# The kind of value computed by each intrinsic function, where it is known
+_closure_intrinsic_kinds = {
+    'ASCII': NUM,
+    'CHAR': STR,
+    'DATA': NUM,
+    'EXTRACT': STR,
+    'FIND': NUM,
+    'JUSTIFY': STR,
+    'LENGTH': NUM,
+    'NAME': STR,
+    'PIECE': STR,
+    'QUERY': STR,
+    'RANDOM': NUM,
+    'REVERSE': STR,
+    'TRANSLATE': STR,
+}
+
+# Closures computing each special variable
+_closure_special_vars = {
+    'HOROLOG': lambda env, p: rt.horolog(),
+    'IO': lambda env, p: str(env.current_device()),
+    'JOB': lambda env, p: rt.job(),
+    'PRINCIPAL': lambda env, p: str(env.default_device()),
+    'TEST': lambda env, p: rt.value(env.get("$T")),
+    'TLEVEL': lambda env, p: env.tlevel(),
+    'TRESTART': lambda env, p: env.trestarts(),
+    'X': lambda env, p: env.device_x(),
+    'Y': lambda env, p: env.device_y(),
+    'ZJOB': lambda env, p: rt.value(env.get("$ZJ")),
+}